@@ -1,20 +1,39 @@
-import hashlib
+import argparse
 import os
+from search_engine import DuplicateDetector, list_class_documents, \
+    NEAR_DUPLICATE_THRESHOLD
 
-class_directories = ["entertainment", "politics", "sport", "business", "tech"]
+# Report exact and near duplicate documents across all class directories.
+# Files are only removed when --delete is given, and only the later copy of
+# each duplicate pair is removed.
 
-def remove_duplicates(dir_path):
-    unique_docs = []
-    for document in os.listdir(dir_path):
-        doc_path = os.path.join(dir_path, document)
-        document_hash = hashlib.md5(open(doc_path,
-                                         "rb").read()).digest()
-        if document_hash not in unique_docs:
-            unique_docs.append(document_hash)
-        else:
-            os.remove(doc_path)
 
-for class_dir in class_directories:
-    current_dir = os.getcwd()
-    doc_path = os.path.join(current_dir, "documents", class_dir)
-    remove_duplicates(doc_path)
\ No newline at end of file
+def find_duplicates(directory, threshold):
+    detector = DuplicateDetector(threshold)
+    for doc_path, class_ in sorted(list_class_documents(directory)):
+        detector.add_file(doc_path, class_)
+    return detector
+
+
+parser = argparse.ArgumentParser(
+    description="Report duplicate documents of the corpus")
+parser.add_argument("--directory", default="documents")
+parser.add_argument("--threshold", type=float,
+                    default=NEAR_DUPLICATE_THRESHOLD,
+                    help="Similarity from which documents are near "
+                         "duplicates")
+parser.add_argument("--report", default="duplicates.tsv")
+parser.add_argument("--delete", choices=["exact", "near"],
+                    help="Remove exact duplicates, or exact and near "
+                         "duplicates")
+args = parser.parse_args()
+
+detector = find_duplicates(args.directory, args.threshold)
+detector.write_report(args.report)
+print(detector.summary())
+print("Report written to {}".format(args.report))
+if args.delete:
+    for duplicate in detector.duplicates:
+        if args.delete == "near" or duplicate[2] == "exact":
+            os.remove(duplicate[0])
+            print("Removed {}".format(duplicate[0]))
@@ -8,10 +8,42 @@ from nltk.stem import PorterStemmer
 import operator
 import pandas as pd
 import pickle
+import mmap
+import json
+import struct
+import shutil
+import tempfile
+import threading
+import weakref
+import tarfile
+import zipfile
+import zlib
+import hashlib
+import lzma
+import re
+import heapq
+import time
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left
+from collections import OrderedDict
+from array import array
+from scipy.sparse import csr_matrix
 from sklearn.metrics import f1_score, precision_score, recall_score, \
     accuracy_score
 from sklearn.model_selection import StratifiedShuffleSplit
 
+CLASS_VALUES = ["business", "sport", "politics", "entertainment", "tech"]
+UNKNOWN_CLASS_CODE = 255
+SPIMI_MEMORY_BUDGET = 256 * 1024 * 1024
+DOCUMENT_STORE_MAGIC = b"IRDOCS\0\0"
+DOCUMENT_STORE_VERSION = 1
+DOCUMENT_STORE_HEADER = struct.Struct("<8sIIIIQ")
+DOCUMENT_STORE_COMPRESSORS = {"zlib": (0, zlib.compress, zlib.decompress),
+                              "lzma": (1, lzma.compress, lzma.decompress)}
+RUN_RECORD = struct.Struct("<IQ")
+MAX_SEGMENTS = 8
+segment_lock = threading.RLock()
+
 
 """
     Stores term weight, term frequency and document ids for
@@ -19,290 +51,3119 @@ from sklearn.model_selection import StratifiedShuffleSplit
 """
 
 
-class Document:
-    def __init__(self, document_id, *args, store_term_weights=False):
-        """
-        Stores document_id, position if store_term_weights is False and
-        term weights if chosen to be stored
-        :param document_id: Unique ID of each document
-        :param args: Position of a term if term weights are not stored
-        :param store_term_weights: Store term weights or positions
-        """
-        self.id = document_id
-        self.positions = []
-        if store_term_weights is True:
-            self.term_weight = 1
-        else:
-            self.positions = []
-            self.add_position(args[0])
+class Document:
+    def __init__(self, document_id, *args, store_term_weights=False):
+        """
+        Stores document_id, position if store_term_weights is False and
+        term weights if chosen to be stored
+        :param document_id: Unique ID of each document
+        :param args: Position of a term if term weights are not stored
+        :param store_term_weights: Store term weights or positions
+        """
+        self.id = document_id
+        self.positions = []
+        if store_term_weights is True:
+            self.term_weight = 1
+        else:
+            self.positions = []
+            self.add_position(args[0])
+
+    def add_position(self, position):
+        """
+        Add another position of a term to storage
+        :param position: Position of the term
+        :return: None
+        """
+        self.positions.append(position)
+
+    def increment_frequency(self):
+        """
+        Increment term frequency of the document
+        :return: None
+        """
+        self.term_weight += 1
+
+
+def encode_varints(values, output):
+    """
+    Append unsigned integers to a byte array using variable byte encoding,
+    7 bits per byte with the high bit set on every byte except the last.
+    :param values: Iterable of non negative integers
+    :param output: bytearray the encoded bytes are appended to
+    :return: None
+    """
+    for value in values:
+        while value >= 0x80:
+            output.append((value & 0x7F) | 0x80)
+            value >>= 7
+        output.append(value)
+
+
+def decode_varints(data, offset, count):
+    """
+    Decode a number of variable byte encoded integers.
+    :param data: Bytes like object holding the encoded integers
+    :param offset: Position of the first encoded byte
+    :param count: Number of integers to decode
+    :return: Tuple of decoded integers as a list and offset after the last
+    decoded byte
+    """
+    values = []
+    for _ in range(count):
+        value = 0
+        shift = 0
+        byte = data[offset]
+        while byte & 0x80:
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            offset += 1
+            byte = data[offset]
+        values.append(value | (byte << shift))
+        offset += 1
+    return values, offset
+
+
+def delta_encode(values):
+    """
+    Replace sorted integers with the gaps between consecutive values.
+    :param values: Sorted integers
+    :return: List of gaps, the first value is kept as it is
+    """
+    previous = 0
+    gaps = []
+    for value in values:
+        gaps.append(value - previous)
+        previous = value
+    return gaps
+
+
+def delta_decode(gaps):
+    """
+    Rebuild sorted integers from the gaps between consecutive values.
+    :param gaps: Gaps produced by delta_encode
+    :return: List of sorted integers
+    """
+    total = 0
+    values = []
+    for gap in gaps:
+        total += gap
+        values.append(total)
+    return values
+
+
+""" Postings list of a single term backed by typed arrays instead of one
+Document per posting. Document ids are kept in ascending order. Positional
+postings keep every position of the term in one array with per document
+offsets, weighted postings keep the raw term frequency and term weight.
+A postings list can be packed into delta and variable byte encoded bytes
+which is how it is pickled and how rarely used terms are kept in memory.
+"""
+
+
+class PostingsList:
+    __slots__ = ("store_term_weights", "packed", "packed_length", "_doc_ids",
+                 "_frequencies", "_term_weights", "_position_offsets",
+                 "_positions")
+
+    def __init__(self, store_term_weights=False):
+        """
+        Create an empty postings list.
+        :param store_term_weights: Store term weights or positions
+        """
+        self.store_term_weights = store_term_weights
+        self.packed = None
+        self._doc_ids = array("i")
+        if store_term_weights:
+            self._frequencies = array("i")
+            self._term_weights = array("d")
+        else:
+            self._position_offsets = array("i", [0])
+            self._positions = array("i")
+
+    def from_documents(documents, store_term_weights=False):
+        """
+        Convert a list of Document objects into a postings list.
+        :param documents: Documents sorted on document id
+        :param store_term_weights: If documents hold term weights
+        :return: Postings list with the same postings
+        """
+        postings_list = PostingsList(store_term_weights)
+        for document in documents:
+            if store_term_weights:
+                postings_list.append(document.id, frequency=1,
+                                     term_weight=document.term_weight)
+            else:
+                postings_list.append(document.id, document.positions)
+        return postings_list
+    from_documents = staticmethod(from_documents)
+
+    @property
+    def doc_ids(self):
+        if self.packed is not None:
+            self.unpack()
+        return self._doc_ids
+
+    @property
+    def frequencies(self):
+        if self.packed is not None:
+            self.unpack()
+        return self._frequencies
+
+    @property
+    def term_weights(self):
+        if self.packed is not None:
+            self.unpack()
+        return self._term_weights
+
+    @property
+    def positions(self):
+        if self.packed is not None:
+            self.unpack()
+        return self._positions
+
+    @property
+    def position_offsets(self):
+        if self.packed is not None:
+            self.unpack()
+        return self._position_offsets
+
+    def append(self, document_id, positions=None, frequency=1,
+               term_weight=None):
+        """
+        Add a posting for a document with a higher id than any existing one
+        :param document_id: Unique ID of the document
+        :param positions: Positions of the term in the document
+        :param frequency: Number of occurrences of the term in the document
+        :param term_weight: Weight of the term, defaults to the frequency
+        :return: None
+        """
+        self.doc_ids.append(document_id)
+        if self.store_term_weights:
+            self._frequencies.append(frequency)
+            self._term_weights.append(
+                frequency if term_weight is None else term_weight)
+        else:
+            self._positions.extend(positions)
+            self._position_offsets.append(len(self._positions))
+
+    def extend(self, other):
+        """
+        Append all postings of a postings list whose document ids come after
+        the document ids of this one.
+        :param other: PostingsList with the same kind of postings
+        :return: None
+        """
+        self.doc_ids.extend(other.doc_ids)
+        if self.store_term_weights:
+            self._frequencies.extend(other.frequencies)
+            self._term_weights.extend(other.term_weights)
+        else:
+            shift = len(self._positions)
+            self._positions.extend(other.positions)
+            self._position_offsets.extend(
+                offset + shift for offset in other.position_offsets[1:])
+
+    def set_term_weights(self, term_weights):
+        """
+        Replace the term weights of all postings
+        :param term_weights: NumPy array of weights in posting order
+        :return: None
+        """
+        if self.packed is not None:
+            self.unpack()
+        self._term_weights = array(
+            "d", np.asarray(term_weights, dtype=np.float64).tobytes())
+
+    def get_positions(self, index):
+        """
+        Positions of the term in the document at an index of the list
+        :param index: Index of the posting
+        :return: Array of positions
+        """
+        offsets = self.position_offsets
+        return self._positions[offsets[index]:offsets[index + 1]]
+
+    def seek(self, doc_id, start=0):
+        """
+        Galloping search for the first posting at or after an index whose
+        document id is not smaller than doc_id. Steps of doubling size find a
+        range that holds it and a binary search finishes inside that range,
+        so advancing by d postings costs O(log d).
+        :param doc_id: Document id to look for
+        :param start: Index to start searching from
+        :return: Index of the posting, len(self) if there is none
+        """
+        doc_ids = self.doc_ids
+        length = len(doc_ids)
+        if start >= length or doc_ids[start] >= doc_id:
+            return start
+        step = 1
+        low = start
+        high = start + 1
+        while high < length and doc_ids[high] < doc_id:
+            low = high
+            step *= 2
+            high = low + step
+        return bisect_left(doc_ids, doc_id, low + 1, min(high, length))
+
+    def select(self, indices):
+        """
+        Build a new postings list from some of the postings of this one.
+        :param indices: Ascending indices of the postings to keep
+        :return: Postings list containing the selected postings
+        """
+        selected = PostingsList(self.store_term_weights)
+        doc_ids = self.doc_ids
+        for index in indices:
+            if self.store_term_weights:
+                selected.append(doc_ids[index], frequency=self._frequencies[
+                    index], term_weight=self._term_weights[index])
+            else:
+                selected.append(doc_ids[index], self.get_positions(index))
+        return selected
+
+    def __len__(self):
+        if self.packed is not None:
+            return self.packed_length
+        return len(self._doc_ids)
+
+    def __getitem__(self, index):
+        """
+        Build a Document for one posting, kept for code that still works on
+        Document objects.
+        :param index: Index of the posting
+        :return: Document
+        """
+        if index < 0:
+            index += len(self)
+        if self.store_term_weights:
+            document = Document(self.doc_ids[index], store_term_weights=True)
+            document.term_weight = self._term_weights[index]
+        else:
+            document = Document(self.doc_ids[index], 0)
+            document.positions = list(self.get_positions(index))
+        return document
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def nbytes(self):
+        """
+        Approximate memory used by the postings
+        :return: Number of bytes
+        """
+        if self.packed is not None:
+            return len(self.packed)
+        arrays = [self._doc_ids]
+        if self.store_term_weights:
+            arrays += [self._frequencies, self._term_weights]
+        else:
+            arrays += [self._position_offsets, self._positions]
+        return sum(len(values) * values.itemsize for values in arrays)
+
+    def encode(self, include_term_weights=True):
+        """
+        Encode the postings as bytes: document id gaps and, for positional
+        postings, the number of positions and position gaps of each document
+        as variable byte integers. Weighted postings store the frequencies
+        as variable byte integers followed by the term weights as doubles.
+        :param include_term_weights: If term weights are part of the output,
+        they are stored separately in index files
+        :return: Encoded bytes
+        """
+        if self.packed is not None:
+            if include_term_weights or not self.store_term_weights:
+                return self.packed
+            self.unpack()
+        output = bytearray()
+        encode_varints([len(self._doc_ids)], output)
+        encode_varints(delta_encode(self._doc_ids), output)
+        if self.store_term_weights:
+            encode_varints(self._frequencies, output)
+            if include_term_weights:
+                output.extend(self._term_weights.tobytes())
+        else:
+            for index in range(len(self._doc_ids)):
+                positions = self.get_positions(index)
+                encode_varints([len(positions)], output)
+                encode_varints(delta_encode(positions), output)
+        return bytes(output)
+
+    def decode(data, store_term_weights=False, term_weights=None):
+        """
+        Rebuild a postings list from bytes produced by encode.
+        :param data: Encoded bytes
+        :param store_term_weights: If the postings hold term weights
+        :param term_weights: Term weights when they were encoded separately
+        :return: Postings list
+        """
+        postings_list = PostingsList(store_term_weights)
+        postings_list.load_encoded(data, term_weights)
+        return postings_list
+    decode = staticmethod(decode)
+
+    def load_encoded(self, data, term_weights=None):
+        """
+        Replace the arrays of this postings list with encoded postings.
+        :param data: Encoded bytes
+        :param term_weights: Term weights when they were encoded separately,
+        any buffer of doubles such as a memoryview is used without copying
+        :return: None
+        """
+        (length,), offset = decode_varints(data, 0, 1)
+        gaps, offset = decode_varints(data, offset, length)
+        self._doc_ids = array("i", delta_decode(gaps))
+        if self.store_term_weights:
+            frequencies, offset = decode_varints(data, offset, length)
+            self._frequencies = array("i", frequencies)
+            if term_weights is not None:
+                self._term_weights = term_weights
+            else:
+                self._term_weights = array("d")
+                self._term_weights.frombytes(
+                    bytes(data[offset:offset + 8 * length]))
+        else:
+            self._position_offsets = array("i", [0])
+            self._positions = array("i")
+            for _ in range(length):
+                (count,), offset = decode_varints(data, offset, 1)
+                gaps, offset = decode_varints(data, offset, count)
+                self._positions.extend(delta_decode(gaps))
+                self._position_offsets.append(len(self._positions))
+
+    def pack(self):
+        """
+        Keep only the encoded postings in memory. They are decoded again
+        the next time the postings are accessed.
+        :return: None
+        """
+        if self.packed is None:
+            self.packed_length = len(self._doc_ids)
+            self.packed = self.encode()
+            self._doc_ids = None
+            if self.store_term_weights:
+                self._frequencies = self._term_weights = None
+            else:
+                self._position_offsets = self._positions = None
+
+    def unpack(self):
+        """
+        Decode packed postings back into arrays.
+        :return: None
+        """
+        packed = self.packed
+        self.packed = None
+        self.load_encoded(packed)
+
+    def __getstate__(self):
+        return {"store_term_weights": self.store_term_weights,
+                "packed": self.encode(), "packed_length": len(self)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+INDEX_FILE_MAGIC = b"IRINDEX\0"
+INDEX_FORMAT_VERSION = 1
+(METADATA_SECTION, TERM_OFFSETS_SECTION, TERMS_SECTION,
+ POSTINGS_OFFSETS_SECTION, POSTINGS_SECTION, WEIGHT_OFFSETS_SECTION,
+ WEIGHTS_SECTION, DOC_LENGTHS_SECTION, DOCUMENT_OFFSETS_SECTION,
+ DOCUMENTS_SECTION) = range(10)
+NUM_INDEX_SECTIONS = 10
+INDEX_HEADER = struct.Struct("<8sII" + "QQ" * NUM_INDEX_SECTIONS)
+
+
+def open_replacement(filename):
+    """
+    Open a temporary file in the directory of a file, to be moved over it
+    with finish_replacement once it is complete. Processes that memory
+    mapped the old file keep reading its inode, and the file is never seen
+    partly written.
+    :param filename: Path of the file to replace
+    :return: Binary file object and path of the temporary file
+    """
+    handle, temp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)),
+        prefix="." + os.path.basename(filename) + ".", suffix=".tmp")
+    mode = os.stat(filename).st_mode if os.path.exists(filename) else 0o644
+    os.chmod(temp_filename, mode & 0o777)
+    return os.fdopen(handle, "w+b"), temp_filename
+
+
+def finish_replacement(handle, temp_filename, filename):
+    """
+    Close a file opened with open_replacement and move it over the file it
+    replaces
+    :param handle: File object of the temporary file
+    :param temp_filename: Path of the temporary file
+    :param filename: Path of the file to replace
+    :return: None
+    """
+    handle.close()
+    os.replace(temp_filename, filename)
+
+
+def discard_replacement(handle, temp_filename):
+    """
+    Close and remove a file opened with open_replacement, leaving the file
+    it was to replace as it is
+    :param handle: File object of the temporary file
+    :param temp_filename: Path of the temporary file
+    :return: None
+    """
+    handle.close()
+    if os.path.exists(temp_filename):
+        os.remove(temp_filename)
+
+
+""" Writes the binary index format. The file starts with a header holding the
+format version and the offset and length of every section, followed by the
+sections themselves:
+    metadata            JSON with purpose and number of documents
+    term offsets        uint64 offset of each term in the terms section
+    terms               UTF-8 terms in sorted order
+    postings offsets    uint64 offset of each term's encoded postings
+    postings            PostingsList.encode output without term weights
+    weight offsets      uint64 index of each term's first term weight
+    weights             float64 term weights of all postings
+    document lengths    float64 length of each document vector
+    document offsets    uint64 offset of each document's text
+    documents           UTF-8 document texts
+Terms have to be added in sorted order, which lets the postings be written
+straight to the file while the small tables are kept until close. The file is
+written next to its destination and moved over it when it is closed.
+"""
+
+
+class IndexFileWriter:
+    def __init__(self, filename, purpose, num_documents, deleted_ids=(),
+                 document_store=None):
+        """
+        Create the index file and reserve space for the header.
+        :param filename: Path of the index file
+        :param purpose: If the index is used for boolean search or vector
+        space model
+        :param num_documents: Number of documents in the index
+        :param deleted_ids: Ids of deleted documents, which have no postings
+        :param document_store: Path of the DocumentStore holding the
+        document texts, which are then not written to the index file
+        """
+        self.purpose = purpose
+        self.num_documents = num_documents
+        self.deleted_ids = sorted(deleted_ids)
+        self.document_store = None
+        if document_store is not None:
+            self.document_store = os.path.relpath(
+                os.path.abspath(document_store),
+                os.path.dirname(os.path.abspath(filename)))
+        self.filename = filename
+        self.handle, self.temp_filename = open_replacement(filename)
+        self.handle.write(bytes(INDEX_HEADER.size))
+        self.sections = [(0, 0)] * NUM_INDEX_SECTIONS
+        self.term_offsets = array("Q", [0])
+        self.terms = bytearray()
+        self.postings_offsets = array("Q", [0])
+        self.weight_offsets = array("Q", [0])
+        self.weights = tempfile.TemporaryFile()
+        self.doc_lengths = np.zeros(0)
+        self.documents = None
+        self.last_term = None
+        self.postings_start = self.handle.tell()
+
+    def add_term(self, term, postings_list):
+        """
+        Write a term and its postings list
+        :param term: Term, greater than every term added before
+        :param postings_list: PostingsList of the term
+        :return: None
+        """
+        if self.last_term is not None and term <= self.last_term:
+            raise ValueError("Terms must be added in sorted order: {} after "
+                             "{}".format(term, self.last_term))
+        self.last_term = term
+        self.terms.extend(term.encode("utf-8"))
+        self.term_offsets.append(len(self.terms))
+        encoded = postings_list.encode(include_term_weights=False)
+        self.handle.write(encoded)
+        self.postings_offsets.append(self.postings_offsets[-1] + len(encoded))
+        if postings_list.store_term_weights:
+            self.weights.write(postings_list.term_weights.tobytes())
+            self.weight_offsets.append(self.weight_offsets[-1] +
+                                       len(postings_list))
+        else:
+            self.weight_offsets.append(self.weight_offsets[-1])
+
+    def set_doc_lengths(self, doc_lengths):
+        """
+        Set the lengths of the document vectors
+        :param doc_lengths: Array of lengths indexed by document id
+        :return: None
+        """
+        self.doc_lengths = np.asarray(doc_lengths, dtype=np.float64)
+
+    def set_documents(self, documents):
+        """
+        Set the document texts, written when the file is closed
+        :param documents: Sequence of document texts indexed by document id
+        :return: None
+        """
+        self.documents = documents
+
+    def write_section(self, section, data):
+        """
+        Write a section at the current end of the file, aligned to 8 bytes
+        :param section: Section number
+        :param data: Bytes like object
+        :return: None
+        """
+        self.handle.write(bytes(-self.handle.tell() % 8))
+        self.sections[section] = (self.handle.tell(), len(data))
+        self.handle.write(data)
+
+    def close(self):
+        """
+        Write the remaining sections and the header, and close the file.
+        :return: None
+        """
+        self.sections[POSTINGS_SECTION] = (
+            self.postings_start, self.postings_offsets[-1])
+        metadata = {"purpose": self.purpose,
+                    "num_documents": self.num_documents,
+                    "deleted_ids": self.deleted_ids,
+                    "document_store": self.document_store}
+        self.write_section(METADATA_SECTION,
+                           json.dumps(metadata).encode("utf-8"))
+        self.write_section(TERM_OFFSETS_SECTION, self.term_offsets.tobytes())
+        self.write_section(TERMS_SECTION, bytes(self.terms))
+        self.write_section(POSTINGS_OFFSETS_SECTION,
+                           self.postings_offsets.tobytes())
+        self.write_section(WEIGHT_OFFSETS_SECTION,
+                           self.weight_offsets.tobytes())
+        self.handle.write(bytes(-self.handle.tell() % 8))
+        weights_start = self.handle.tell()
+        self.weights.seek(0)
+        shutil.copyfileobj(self.weights, self.handle)
+        self.weights.close()
+        self.sections[WEIGHTS_SECTION] = (
+            weights_start, self.handle.tell() - weights_start)
+        self.write_section(DOC_LENGTHS_SECTION, self.doc_lengths.tobytes())
+        document_offsets = array("Q", [0])
+        document_start = None
+        if self.documents is not None:
+            self.handle.write(bytes(-self.handle.tell() % 8))
+            document_start = self.handle.tell()
+            for document in self.documents:
+                encoded = (document or "").encode("utf-8")
+                self.handle.write(encoded)
+                document_offsets.append(document_offsets[-1] + len(encoded))
+            self.sections[DOCUMENTS_SECTION] = (document_start,
+                                                document_offsets[-1])
+        self.write_section(DOCUMENT_OFFSETS_SECTION,
+                           document_offsets.tobytes())
+        section_values = [value for section in self.sections
+                          for value in section]
+        self.handle.seek(0)
+        self.handle.write(INDEX_HEADER.pack(INDEX_FILE_MAGIC,
+                                            INDEX_FORMAT_VERSION,
+                                            NUM_INDEX_SECTIONS,
+                                            *section_values))
+        finish_replacement(self.handle, self.temp_filename, self.filename)
+
+    def discard(self):
+        """
+        Remove the partly written file, leaving any previous index file in
+        place
+        :return: None
+        """
+        self.weights.close()
+        discard_replacement(self.handle, self.temp_filename)
+
+
+def write_index_file(filename, index, document_store=None):
+    """
+    Write an inverted index or search engine in the binary index format.
+    Segments and deleted documents are merged into the postings lists, and
+    the texts of deleted documents are left empty.
+    :param filename: Path of the index file
+    :param index: InvertedIndex or SearchEngine
+    :param document_store: Path of a DocumentStore with the document texts,
+    referenced from the index file instead of writing the texts into it
+    :return: None
+    """
+    if getattr(index, "pending_changes", False):
+        index.refresh()
+    num_documents = getattr(index, "num_documents", len(index.documents))
+    deleted_ids = getattr(index, "deleted_ids", set())
+    writer = IndexFileWriter(filename, index.purpose, num_documents,
+                             deleted_ids, document_store)
+    try:
+        if index.is_segmented():
+            for term in sorted(index.all_terms()):
+                postings_list = index.live_postings_list(term, cache=False)
+                if len(postings_list) > 0:
+                    writer.add_term(term, postings_list)
+        else:
+            for term in sorted(index.terms):
+                writer.add_term(term, index.get_postings_list(term))
+        if index.purpose == "vsm":
+            writer.set_doc_lengths(index.docLengths)
+        if document_store is None:
+            if deleted_ids or num_documents != len(index.documents):
+                writer.set_documents(["" if doc_id in deleted_ids else
+                                      index.documents[doc_id]
+                                      for doc_id in range(num_documents)])
+            else:
+                writer.set_documents(index.documents)
+        writer.close()
+    except BaseException:
+        writer.discard()
+        raise
+
+
+def is_index_file(filename):
+    """
+    Check if a file is in the binary index format rather than a pickle.
+    :param filename: Path of the file
+    :return: True / False
+    """
+    with open(filename, "rb") as handle:
+        return handle.read(len(INDEX_FILE_MAGIC)) == INDEX_FILE_MAGIC
+
+
+""" Read only sequence of strings stored in a memory mapped index file, with
+an offset table giving the start of each string.
+"""
+
+
+class MappedStrings:
+    def __init__(self, buffer, offsets):
+        """
+        :param buffer: memoryview of the strings section
+        :param offsets: memoryview of uint64 offsets, one more than the
+        number of strings
+        """
+        self.buffer = buffer
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return str(self.buffer[self.offsets[index]:self.offsets[index + 1]],
+                   "utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+""" Sequence of strings that can be appended to, made of a read only
+sequence such as MappedStrings followed by a list of added strings.
+"""
+
+
+class AppendableStrings:
+    def __init__(self, base):
+        """
+        :param base: Read only sequence of strings
+        """
+        self.base = base
+        self.added = list()
+
+    def __len__(self):
+        return len(self.base) + len(self.added)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < len(self.base):
+            return self.base[index]
+        return self.added[index - len(self.base)]
+
+    def __iter__(self):
+        for string in self.base:
+            yield string
+        for string in self.added:
+            yield string
+
+    def append(self, string):
+        self.added.append(string)
+
+    def extend(self, strings):
+        self.added.extend(strings)
+
+
+""" Document texts compressed in blocks of consecutive documents in a single
+file. The header is followed by an offset table of the compressed blocks,
+the start and length of each document inside its uncompressed block, and
+the blocks. The file is memory mapped, a document is read by decompressing
+its block, and the most recently used decompressed blocks are cached.
+"""
+
+
+class DocumentStore:
+    def __init__(self, filename, cache_blocks=32):
+        """
+        Open a document store
+        :param filename: Path of the document store file
+        :param cache_blocks: Number of decompressed blocks kept in memory
+        """
+        self.filename = os.path.abspath(filename)
+        self.cache_blocks = cache_blocks
+        with open(filename, "rb") as handle:
+            self.mapping = mmap.mmap(handle.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        magic, version, compression, self.docs_per_block, \
+            self.num_documents, num_blocks = \
+            DOCUMENT_STORE_HEADER.unpack_from(self.mapping, 0)
+        if magic != DOCUMENT_STORE_MAGIC:
+            raise ValueError("{} is not a document store".format(filename))
+        if version != DOCUMENT_STORE_VERSION:
+            raise ValueError("Unsupported document store version {} in "
+                             "{}".format(version, filename))
+        self.decompress = [decompress for code, _, decompress in
+                           DOCUMENT_STORE_COMPRESSORS.values()
+                           if code == compression][0]
+        view = memoryview(self.mapping)
+        start = DOCUMENT_STORE_HEADER.size
+        self.block_offsets = view[start:start + 8 * (num_blocks + 1)].cast(
+            "Q")
+        start += 8 * (num_blocks + 1)
+        self.doc_offsets = view[start:start + 4 * self.num_documents].cast(
+            "I")
+        start += 4 * self.num_documents
+        self.doc_lengths = view[start:start + 4 * self.num_documents].cast(
+            "I")
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def write(filename, documents, docs_per_block=16, compression="zlib"):
+        """
+        Write document texts to a document store file
+        :param filename: Path of the document store file
+        :param documents: Sequence of document texts indexed by document id
+        :param docs_per_block: Number of documents compressed together
+        :param compression: "zlib" or "lzma"
+        :return: None
+        """
+        code, compress, _ = DOCUMENT_STORE_COMPRESSORS[compression]
+        num_documents = len(documents)
+        num_blocks = -(-num_documents // docs_per_block)
+        block_offsets = array("Q", [0])
+        doc_offsets = array("I")
+        doc_lengths = array("I")
+        with tempfile.TemporaryFile() as blocks:
+            for first in range(0, num_documents, docs_per_block):
+                block = bytearray()
+                for doc_id in range(first, min(first + docs_per_block,
+                                               num_documents)):
+                    encoded = (documents[doc_id] or "").encode("utf-8")
+                    doc_offsets.append(len(block))
+                    doc_lengths.append(len(encoded))
+                    block.extend(encoded)
+                compressed = compress(bytes(block))
+                blocks.write(compressed)
+                block_offsets.append(block_offsets[-1] + len(compressed))
+            handle, temp_filename = open_replacement(filename)
+            try:
+                handle.write(DOCUMENT_STORE_HEADER.pack(
+                    DOCUMENT_STORE_MAGIC, DOCUMENT_STORE_VERSION, code,
+                    docs_per_block, num_documents, num_blocks))
+                handle.write(block_offsets.tobytes())
+                handle.write(doc_offsets.tobytes())
+                handle.write(doc_lengths.tobytes())
+                blocks.seek(0)
+                shutil.copyfileobj(blocks, handle)
+            except BaseException:
+                discard_replacement(handle, temp_filename)
+                raise
+            finish_replacement(handle, temp_filename, filename)
+    write = staticmethod(write)
+
+    def get_block(self, block):
+        """
+        Decompressed bytes of a block, from the cache when possible
+        :param block: Block number
+        :return: Bytes of the documents of the block
+        """
+        with self.lock:
+            if block in self.blocks:
+                self.blocks.move_to_end(block)
+                return self.blocks[block]
+        data_start = DOCUMENT_STORE_HEADER.size + \
+            8 * len(self.block_offsets) + 8 * self.num_documents
+        data = self.decompress(self.mapping[
+            data_start + self.block_offsets[block]:
+            data_start + self.block_offsets[block + 1]])
+        with self.lock:
+            self.blocks[block] = data
+            if len(self.blocks) > self.cache_blocks:
+                self.blocks.popitem(last=False)
+        return data
+
+    def __len__(self):
+        return self.num_documents
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        data = self.get_block(index // self.docs_per_block)
+        start = self.doc_offsets[index]
+        return str(data[start:start + self.doc_lengths[index]], "utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getstate__(self):
+        """
+        Pickle the store by its absolute file name, the file is mapped
+        again when it is unpickled from any working directory.
+        :return: Dictionary of attributes
+        """
+        return {"filename": self.filename, "cache_blocks": self.cache_blocks}
+
+    def __setstate__(self, state):
+        """
+        Open the store again from its file
+        :param state: Pickled attributes
+        :return: None
+        """
+        self.__init__(state["filename"], state["cache_blocks"])
+
+
+""" Term dictionary of a memory mapped index file. Terms are stored in sorted
+order so a term id is found with a binary search, without loading the
+vocabulary into memory.
+"""
+
+
+class MappedTermIds:
+    def __init__(self, terms):
+        """
+        :param terms: MappedStrings holding the sorted terms
+        """
+        self.terms = terms
+
+    def get(self, term, default=None):
+        term_id = bisect_left(self.terms, term)
+        if term_id < len(self.terms) and self.terms[term_id] == term:
+            return term_id
+        return default
+
+    def __getitem__(self, term):
+        term_id = self.get(term)
+        if term_id is None:
+            raise KeyError(term)
+        return term_id
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+
+""" Postings lists of a memory mapped index file, decoded when a term is used.
+The most recently used decoded lists are cached, and term weights are read in
+place from the mapped file.
+"""
+
+
+class MappedPostings:
+    def __init__(self, buffer, offsets, weights, weight_offsets,
+                 store_term_weights, cache_lists=4096):
+        """
+        :param buffer: memoryview of the postings section
+        :param offsets: memoryview of uint64 postings offsets
+        :param weights: memoryview of float64 term weights
+        :param weight_offsets: memoryview of uint64 weight offsets
+        :param store_term_weights: If the postings hold term weights
+        :param cache_lists: Number of decoded postings lists kept in memory
+        """
+        self.buffer = buffer
+        self.offsets = offsets
+        self.weights = weights
+        self.weight_offsets = weight_offsets
+        self.store_term_weights = store_term_weights
+        self.cache_lists = cache_lists
+        self.decoded = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, term_id):
+        with self.lock:
+            if term_id in self.decoded:
+                self.decoded.move_to_end(term_id)
+                return self.decoded[term_id]
+        term_weights = None
+        if self.store_term_weights:
+            term_weights = self.weights[
+                self.weight_offsets[term_id]:
+                self.weight_offsets[term_id + 1]]
+        postings_list = PostingsList.decode(
+            self.buffer[self.offsets[term_id]:self.offsets[term_id + 1]],
+            self.store_term_weights, term_weights)
+        with self.lock:
+            self.decoded[term_id] = postings_list
+            if len(self.decoded) > self.cache_lists:
+                self.decoded.popitem(last=False)
+        return postings_list
+
+    def __iter__(self):
+        for term_id in range(len(self)):
+            yield self[term_id]
+
+
+def open_index_file(filename):
+    """
+    Memory map an index file written by IndexFileWriter. Only the header and
+    metadata are read, everything else is used in place from the mapping.
+    :param filename: Path of the index file
+    :return: Dictionary of attributes shared by InvertedIndex and SearchEngine
+    """
+    with open(filename, "rb") as handle:
+        mapping = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    header = INDEX_HEADER.unpack_from(mapping, 0)
+    magic, version, num_sections = header[:3]
+    if magic != INDEX_FILE_MAGIC:
+        raise ValueError("{} is not an index file".format(filename))
+    if version != INDEX_FORMAT_VERSION:
+        raise ValueError("Unsupported index format version {} in {}".format(
+            version, filename))
+    view = memoryview(mapping)
+    sections = [view[header[3 + 2 * i]:header[3 + 2 * i] + header[4 + 2 * i]]
+                for i in range(num_sections)]
+    metadata = json.loads(str(sections[METADATA_SECTION], "utf-8"))
+    store_term_weights = metadata["purpose"] == "vsm"
+    terms = MappedStrings(sections[TERMS_SECTION],
+                          sections[TERM_OFFSETS_SECTION].cast("Q"))
+    if metadata.get("document_store"):
+        documents = DocumentStore(os.path.join(
+            os.path.dirname(os.path.abspath(filename)),
+            metadata["document_store"]))
+    else:
+        documents = MappedStrings(sections[DOCUMENTS_SECTION],
+                                  sections[DOCUMENT_OFFSETS_SECTION]
+                                  .cast("Q"))
+    return {
+        "purpose": metadata["purpose"],
+        "num_documents": metadata["num_documents"],
+        "deleted_ids": set(metadata.get("deleted_ids", [])),
+        "terms": terms,
+        "term_ids": MappedTermIds(terms),
+        "posting_lists": MappedPostings(
+            sections[POSTINGS_SECTION],
+            sections[POSTINGS_OFFSETS_SECTION].cast("Q"),
+            sections[WEIGHTS_SECTION].cast("d"),
+            sections[WEIGHT_OFFSETS_SECTION].cast("Q"), store_term_weights),
+        "docLengths": np.frombuffer(sections[DOC_LENGTHS_SECTION],
+                                    dtype=np.float64),
+        "documents": documents,
+    }
+
+
+""" Tokenizes, removes stop words and stems text for indexing, training and
+queries. The stop word set and stemmer are built once, and stems are kept in
+a bounded least recently used cache keyed on the lowercase token since news
+text repeats the same few thousand words.
+"""
+
+
+class PreprocessingPipeline:
+    def __init__(self, stem_cache_size=100000):
+        """
+        :param stem_cache_size: Maximum number of cached stems
+        """
+        self.stop_words = None
+        self.stemmer = PorterStemmer()
+        self.stem_cache = OrderedDict()
+        self.stem_cache_size = stem_cache_size
+        self.stem_cache_lock = threading.Lock()
+
+    def __getstate__(self):
+        """
+        Pickled attributes, without the lock of the stem cache
+        :return: Dictionary of attributes
+        """
+        state = self.__dict__.copy()
+        del state["stem_cache_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.stem_cache_lock = threading.Lock()
+
+    def get_stop_words(self):
+        """
+        Stop words and punctuation removed from tokens, built on first use
+        :return: Set of stop words
+        """
+        if self.stop_words is None:
+            self.stop_words = set(stopwords.words('english') +
+                                  list(punctuation))
+        return self.stop_words
+
+    def stem(self, word):
+        """
+        Stem a lowercase token, using the cached stem if there is one. The
+        cache is shared by the threads of the web app, so it is only read
+        and changed while holding its lock.
+        :param word: Lowercase token
+        :return: Stemmed token
+        """
+        stem_cache = self.stem_cache
+        with self.stem_cache_lock:
+            stemmed_word = stem_cache.get(word)
+            if stemmed_word is not None:
+                stem_cache.move_to_end(word)
+                return stemmed_word
+        stemmed_word = self.stemmer.stem(word)
+        with self.stem_cache_lock:
+            stem_cache[word] = stemmed_word
+            if len(stem_cache) > self.stem_cache_size:
+                stem_cache.popitem(last=False)
+        return stemmed_word
+
+    def tokenize(self, document_content):
+        """
+        Split text into lowercase tokens
+        :param document_content: Entire document text
+        :return: Lowercase tokens
+        """
+        return [word.lower() for word in nltk.word_tokenize(document_content)]
+
+    def normalize(self, tokens, remove_stopwords=False, stemming=True):
+        """
+        Remove stopwords and stem lowercase tokens
+        :param tokens: Lowercase tokens
+        :param remove_stopwords: If stop words should be removed
+        :param stemming: If tokens should be stemmed
+        :return: Processed tokens
+        """
+        if remove_stopwords:
+            stop_words = self.get_stop_words()
+            tokens = [word for word in tokens if word not in stop_words]
+        if stemming:
+            stem = self.stem
+            tokens = [stem(word) for word in tokens]
+        return tokens
+
+    def process(self, document_content, remove_stopwords=False,
+                stemming=True):
+        """
+        Tokenize, remove stopwords, stem tokens
+        :param document_content: Entire document text
+        :param remove_stopwords: If stop words should be removed
+        :param stemming: If tokens should be stemmed
+        :return: Processed tokens
+        """
+        return self.normalize(self.tokenize(document_content),
+                              remove_stopwords, stemming)
+
+    def save_stem_cache(self, filename):
+        """
+        Save cached stems as a pickled object
+        :param filename: Absolute path of destination with intended name
+        :return: None
+        """
+        with self.stem_cache_lock:
+            stems = list(self.stem_cache.items())
+        with open(filename, "wb") as handle:
+            pickle.dump(stems, handle)
+
+    def load_stem_cache(self, filename):
+        """
+        Load stems saved with save_stem_cache into the cache
+        :param filename: Absolute path of pickled stems
+        :return: None
+        """
+        with open(filename, "rb") as handle:
+            stems = pickle.load(handle)
+        with self.stem_cache_lock:
+            for word, stemmed_word in stems:
+                self.stem_cache[word] = stemmed_word
+            while len(self.stem_cache) > self.stem_cache_size:
+                self.stem_cache.popitem(last=False)
+
+
+preprocessing_pipeline = PreprocessingPipeline()
+
+
+""" Parent class for InvertedIndex and SearchEngine.
+Deals with pre-processing queries and document text as well as retrieving
+posting lists."""
+
+
+class DocumentProcessing():
+
+    def pre_process(self, document_content, remove_stopwords=False,
+                    stemming=True):
+        """
+        Tokenize, remove stopwords, stem tokens
+        :param document_content: Entire document text
+        :param remove_stopwords: If stop words should be removed
+        :param stemming: If tokens should be stemmed
+        :return: Processed tokens
+        """
+        return preprocessing_pipeline.process(document_content,
+                                              remove_stopwords, stemming)
+
+    def get_postings_list(self, term):
+        """
+        Retrieve postings list of a particular term
+        :param term: Term whose postings list is required
+        :return: Postings list of term supplied
+        """
+        if self.is_segmented():
+            return self.live_postings_list(term)
+        term_index = self.term_ids[term]
+        return self.posting_lists[term_index]
+
+    def check_existence(self, term):
+        """
+        Check if a term exists in memory
+        :param term: Term to be searched for
+        :return: True / False based on whether it exists
+        """
+        if self.is_segmented():
+            return len(self.live_postings_list(term)) > 0
+        return term in self.term_ids
+
+    def is_segmented(self):
+        """
+        Check if postings are spread over segments or include deleted
+        documents, so postings lists have to be merged before use.
+        :return: True / False
+        """
+        return bool(getattr(self, "segments", None)) or \
+            bool(getattr(self, "tombstones", None))
+
+    def document_count(self):
+        """
+        Number of documents that have not been deleted
+        :return: Number of documents
+        """
+        return getattr(self, "num_documents", len(self.documents)) - \
+            len(getattr(self, "deleted_ids", ()))
+
+    def all_terms(self):
+        """
+        Terms of the main postings lists followed by the terms first seen in
+        segments, including terms whose documents were all deleted.
+        :return: List of terms
+        """
+        terms = list(self.terms)
+        segment_terms = dict()
+        for segment in getattr(self, "segments", []):
+            for term in segment.terms:
+                if term not in self.term_ids:
+                    segment_terms[term] = True
+        return terms + list(segment_terms)
+
+    def postings_parts(self, term):
+        """
+        Postings lists of a term in the main postings lists and in each
+        segment, in document id order.
+        :param term: Term
+        :return: List of PostingsList
+        """
+        parts = []
+        if term in self.term_ids:
+            parts.append(self.posting_lists[self.term_ids[term]])
+        for segment in getattr(self, "segments", []):
+            if term in segment.term_ids:
+                parts.append(segment.posting_lists[segment.term_ids[term]])
+        return parts
+
+    def live_postings_list(self, term, cache=True):
+        """
+        Postings list of a term merged over segments, without deleted
+        documents. Term weights are calculated from the raw frequencies with
+        the idf of the documents that remain.
+        :param term: Term
+        :param cache: Keep the merged postings list for later queries
+        :return: PostingsList, empty if no document contains the term
+        """
+        if getattr(self, "live_postings", None) is None:
+            self.live_postings = dict()
+        if term in self.live_postings:
+            return self.live_postings[term]
+        store_term_weights = self.purpose == "vsm"
+        postings_list = PostingsList(store_term_weights)
+        for part in self.postings_parts(term):
+            postings_list.extend(part)
+        tombstones = getattr(self, "tombstones", None)
+        if tombstones and len(postings_list) > 0:
+            deleted = np.isin(np.frombuffer(postings_list.doc_ids,
+                                            dtype=np.int32),
+                              np.fromiter(tombstones, dtype=np.int64))
+            if deleted.any():
+                postings_list = postings_list.select(
+                    np.flatnonzero(~deleted))
+        if store_term_weights and len(postings_list) > 0:
+            postings_list.set_term_weights(tfidf_weights(
+                np.frombuffer(postings_list.frequencies, dtype=np.int32),
+                len(postings_list), self.document_count()))
+        if cache:
+            self.live_postings[term] = postings_list
+        return postings_list
+
+    def build_term_dictionary(self):
+        """
+        Build term dictionary mapping each term to its term id, which is
+        the position of its postings list in posting_lists.
+        :return: None
+        """
+        self.term_ids = {term: term_id for term_id, term in
+                         enumerate(self.terms)}
+
+    def __setstate__(self, state):
+        """
+        Restore pickled object. Objects pickled before the term dictionary
+        was introduced only have the terms list, so the dictionary is rebuilt
+        from it, their lists of Document objects are converted into
+        postings lists and their dictionary of document lengths into an array
+        indexed by document id.
+        :param state: Pickled attributes of the object
+        :return: None
+        """
+        self.__dict__.update(state)
+        if isinstance(state.get("docLengths"), dict):
+            self.docLengths = np.array(
+                [state["docLengths"].get(doc_id, 0.0)
+                 for doc_id in range(len(self.documents))])
+        if "terms" in state and "term_ids" not in state:
+            self.build_term_dictionary()
+        posting_lists = state.get("posting_lists")
+        if posting_lists and isinstance(posting_lists[0], list):
+            store_term_weights = self.purpose == "vsm"
+            self.posting_lists = [
+                PostingsList.from_documents(documents, store_term_weights)
+                for documents in posting_lists]
+
+
+def list_class_documents(directory):
+    """
+    List the documents of a directory holding one sub directory per class
+    value.
+    :param directory: Location of documents relative to working directory
+    :return: List of document path and class value pairs
+    """
+    class_documents = []
+    doc_directory = os.path.join(os.getcwd(), directory)
+    for class_ in os.listdir(doc_directory):
+        class_docs_loc = os.path.join(doc_directory, class_)
+        if os.path.isdir(class_docs_loc):
+            for class_document in os.listdir(class_docs_loc):
+                if not class_document.startswith("."):
+                    class_documents.append(
+                        (os.path.join(class_docs_loc, class_document), class_))
+    return class_documents
+
+
+def directory_records(directory):
+    """
+    Read the documents of a directory holding one sub directory per class
+    value, one at a time.
+    :param directory: Location of documents relative to working directory
+    :return: Generator of (path, class value, text, location) records
+    """
+    for doc_location, class_ in list_class_documents(directory):
+        try:
+            with open(doc_location, "r") as doc:
+                text = doc.read()
+        except:
+            print("Error reading file: {}".format(doc_location))
+            continue
+        yield doc_location, class_, text, ("file", doc_location)
+
+
+def jsonl_records(filename, id_field="id", class_field="class",
+                  text_field="text"):
+    """
+    Read documents from a file holding one JSON object per line, one line
+    at a time.
+    :param filename: Path of the JSONL file
+    :param id_field: Field holding the document id
+    :param class_field: Field holding the class value
+    :param text_field: Field holding the text
+    :return: Generator of (id, class value, text, location) records
+    """
+    filename = os.path.abspath(filename)
+    with open(filename, "rb") as handle:
+        offset = 0
+        for line in handle:
+            if line.strip():
+                record = json.loads(line)
+                yield (record.get(id_field), record.get(class_field),
+                       record[text_field],
+                       ("jsonl", filename, offset, len(line), text_field))
+            offset += len(line)
+
+
+def archive_records(filename):
+    """
+    Read the documents of a tar or zip archive, one member at a time. The
+    class value of a document is the name of the directory holding it, as
+    in documents/<class>/<name>.txt. Members of uncompressed tar archives
+    are located by their offset in the archive, members of compressed tar
+    archives have no location and are spooled.
+    :param filename: Path of the archive
+    :return: Generator of (member name, class value, text, location)
+    records
+    """
+    filename = os.path.abspath(filename)
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                yield (info.filename, archive_member_class(info.filename),
+                       archive.read(info).decode("utf-8"),
+                       ("zip", filename, info.filename))
+        return
+    try:
+        archive = tarfile.open(filename, "r:")
+        compressed = False
+    except tarfile.ReadError:
+        archive = tarfile.open(filename, "r:*")
+        compressed = True
+    with archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            text = archive.extractfile(member).read().decode("utf-8")
+            location = None if compressed else \
+                ("span", filename, member.offset_data, member.size)
+            yield (member.name, archive_member_class(member.name), text,
+                   location)
+
+
+def archive_member_class(name):
+    """
+    Class value of an archive member, the name of its directory
+    :param name: Path of the member in the archive
+    :return: Class value, None for members at the top of the archive
+    """
+    return os.path.basename(os.path.dirname(name)) or None
+
+
+NEAR_DUPLICATE_THRESHOLD = 0.8
+MINHASH_PERMUTATIONS = 128
+SHINGLE_SIZE = 4
+MINHASH_PRIME = 4294967291
+
+""" Finds exact and near duplicate documents as they are read. Exact
+duplicates are found with the MD5 digests of the texts of every document
+added, each mapped to the document kept in its place. Near duplicates
+are found with MinHash signatures over word shingles, and signatures are
+split into bands that are hashed into buckets so that only documents sharing
+a bucket are compared. Every document is checked against all documents seen
+before it, whatever their class value, and the duplicates are kept in a
+report.
+"""
+
+
+class DuplicateDetector:
+    def __init__(self, threshold=NEAR_DUPLICATE_THRESHOLD,
+                 num_permutations=MINHASH_PERMUTATIONS,
+                 shingle_size=SHINGLE_SIZE, seed=7):
+        """
+        :param threshold: Estimated Jaccard similarity of the shingle sets
+        from which two documents are near duplicates
+        :param num_permutations: Number of hash functions in a signature
+        :param shingle_size: Number of consecutive words in a shingle
+        :param seed: Seed of the random hash functions
+        """
+        self.threshold = threshold
+        self.num_permutations = num_permutations
+        self.shingle_size = shingle_size
+        random_state = np.random.RandomState(seed)
+        self.multipliers = random_state.randint(
+            1, MINHASH_PRIME, num_permutations, dtype=np.int64).astype(
+            np.uint64)
+        self.increments = random_state.randint(
+            0, MINHASH_PRIME, num_permutations, dtype=np.int64).astype(
+            np.uint64)
+        self.num_bands, self.band_rows = DuplicateDetector.band_shape(
+            threshold, num_permutations)
+        self.buckets = [dict() for _ in range(self.num_bands)]
+        self.digests = dict()
+        self.signatures = list()
+        self.keys = list()
+        self.class_values = list()
+        self.duplicates = list()
+        self.num_documents = 0
+
+    def band_shape(threshold, num_permutations):
+        """
+        Number of bands and rows per band. Documents more similar than
+        (1 / bands) ** (1 / rows) are likely to share a bucket, the shape
+        with the highest such similarity below the threshold is used so
+        that few near duplicates are missed, and candidates less similar
+        than the threshold are left out when their signatures are compared.
+        :param threshold: Similarity threshold
+        :param num_permutations: Length of the signatures
+        :return: Tuple of number of bands and rows per band
+        """
+        shapes = [(num_permutations // rows, rows)
+                  for rows in range(1, num_permutations + 1)
+                  if num_permutations % rows == 0]
+        return max(shapes, key=lambda shape: (
+            (1 / shape[0]) ** (1 / shape[1]) <= threshold,
+            (1 / shape[0]) ** (1 / shape[1])))
+    band_shape = staticmethod(band_shape)
+
+    def shingle_hashes(self, text):
+        """
+        Hashes of the word shingles of a text
+        :param text: Document text
+        :return: uint64 array of distinct shingle hashes below
+        MINHASH_PRIME
+        """
+        words = re.findall(r"\w+", text.lower())
+        count = max(1, len(words) - self.shingle_size + 1)
+        return np.unique(np.array(
+            [zlib.crc32(" ".join(words[i:i + self.shingle_size])
+                        .encode("utf-8")) % MINHASH_PRIME
+             for i in range(count)], dtype=np.uint64))
+
+    def signature(self, text):
+        """
+        MinHash signature of a text
+        :param text: Document text
+        :return: uint32 array of num_permutations minimum hashes
+        """
+        hashes = (np.outer(self.shingle_hashes(text), self.multipliers) +
+                  self.increments) % np.uint64(MINHASH_PRIME)
+        return hashes.min(axis=0).astype(np.uint32)
+
+    def add(self, key, text, class_value=None):
+        """
+        Check a document against the documents added before it and add it
+        if it is not a duplicate
+        :param key: Name of the document, such as its path
+        :param text: Document text
+        :param class_value: Class value of the document
+        :return: None if the document is new, otherwise a tuple of "exact"
+        or "near", the key of the document it duplicates and their
+        estimated similarity. A copy of an earlier near duplicate is an
+        exact duplicate of the document kept in its place, with the
+        similarity of the near duplicate.
+        """
+        self.num_documents += 1
+        digest = hashlib.md5(text.encode("utf-8")).digest()
+        if digest in self.digests:
+            document_index, similarity = self.digests[digest]
+            return self.record_duplicate(key, class_value, "exact",
+                                         document_index, similarity)
+        signature = self.signature(text)
+        band_keys = [signature[band * self.band_rows:
+                               (band + 1) * self.band_rows].tobytes()
+                     for band in range(self.num_bands)]
+        candidates = set()
+        for buckets, band_key in zip(self.buckets, band_keys):
+            candidates.update(buckets.get(band_key, ()))
+        best_similarity = 0.0
+        best_candidate = None
+        for candidate in sorted(candidates):
+            similarity = float(np.mean(self.signatures[candidate] ==
+                                       signature))
+            if similarity > best_similarity:
+                best_similarity, best_candidate = similarity, candidate
+        if best_candidate is not None and best_similarity >= self.threshold:
+            self.digests[digest] = (best_candidate, best_similarity)
+            return self.record_duplicate(key, class_value, "near",
+                                         best_candidate, best_similarity)
+        document_index = len(self.keys)
+        self.digests[digest] = (document_index, 1.0)
+        self.signatures.append(signature)
+        self.keys.append(key)
+        self.class_values.append(class_value)
+        for buckets, band_key in zip(self.buckets, band_keys):
+            buckets.setdefault(band_key, []).append(document_index)
+        return None
+
+    def add_file(self, filename, class_value=None):
+        """
+        Check a document file against the documents added before it
+        :param filename: Path of the document
+        :param class_value: Class value of the document
+        :return: Same as add, None if the file cannot be read
+        """
+        try:
+            with open(filename, "r") as document:
+                text = document.read()
+        except:
+            print("Error reading file: {}".format(filename))
+            return None
+        return self.add(filename, text, class_value)
+
+    def record_duplicate(self, key, class_value, kind, document_index,
+                         similarity):
+        """
+        Add a duplicate to the report
+        :param key: Name of the duplicate document
+        :param class_value: Class value of the duplicate document
+        :param kind: "exact" or "near"
+        :param document_index: Position of the duplicated document
+        :param similarity: Estimated similarity of the documents
+        :return: Tuple of kind, key of the duplicated document and
+        similarity
+        """
+        self.duplicates.append((key, class_value, kind,
+                                self.keys[document_index],
+                                self.class_values[document_index],
+                                similarity))
+        return kind, self.keys[document_index], similarity
+
+    def summary(self):
+        """
+        One line summary of the duplicates found
+        :return: Summary text
+        """
+        exact = sum(1 for duplicate in self.duplicates
+                    if duplicate[2] == "exact")
+        cross_class = sum(1 for duplicate in self.duplicates
+                          if duplicate[1] != duplicate[4])
+        return ("{} documents, {} exact duplicates, {} near duplicates, {} "
+                "in a different class than the document they duplicate"
+                .format(self.num_documents, exact,
+                        len(self.duplicates) - exact, cross_class))
+
+    def write_report(self, filename):
+        """
+        Write the duplicates as tab separated lines of the duplicate, its
+        class value, the kind of duplicate, the document it duplicates, its
+        class value and their estimated similarity
+        :param filename: Path of the report
+        :return: None
+        """
+        with open(filename, "w") as report:
+            report.write("duplicate\tclass\tkind\tduplicate_of\t"
+                         "duplicate_of_class\tsimilarity\n")
+            for key, class_value, kind, original, original_class, \
+                    similarity in self.duplicates:
+                report.write("{}\t{}\t{}\t{}\t{}\t{:.3f}\n".format(
+                    key, class_value, kind, original, original_class,
+                    similarity))
+
+
+def deduplicate_records(records, detector):
+    """
+    Leave out the records that duplicate an earlier record
+    :param records: Iterable of (id, class value, text, location) records
+    :param detector: DuplicateDetector keeping the report of duplicates
+    :return: Generator of the records that are not duplicates
+    """
+    for record in records:
+        if detector.add(record[0], record[2], record[1]) is None:
+            yield record
+
+
+""" Sequence of document texts read back from their source when they are
+used. Only the location of each text is kept: a file path, the offset and
+length of a line of a JSONL file or of a span of a file, or a member of a
+zip archive. Texts that have no location, such as those of generated
+records, are appended to a spool file and located in it.
+"""
+
+
+class LazyDocuments:
+    def __init__(self, spool_filename=None):
+        """
+        Create an empty sequence
+        :param spool_filename: Path of the spool file, a temporary file is
+        created when the first text is spooled if it is None. The temporary
+        file is removed by close, or when the sequence is garbage collected
+        or the interpreter exits.
+        """
+        self.sources = list()
+        self.source_ids = dict()
+        self.names = list()
+        self.doc_sources = array("i")
+        self.offsets = array("q")
+        self.lengths = array("q")
+        self.spool_filename = spool_filename
+        self.spool = None
+        self.spool_finalizer = None
+        self.archives = dict()
+
+    def append(self, text, location=None):
+        """
+        Add a document by its location
+        :param text: Text of the document, spooled if it has no location
+        :param location: Tuple of kind and position of the text: ("file",
+        path), ("span", path, offset, length), ("jsonl", path, offset,
+        length, text_field) or ("zip", path, member)
+        :return: None
+        """
+        if location is None:
+            location = self.spool_text(text)
+        kind, path = location[0], location[1]
+        if kind == "file":
+            source = (kind, None, None)
+            offset, length = len(self.names), 0
+            self.names.append(path)
+        elif kind == "zip":
+            source = (kind, path, None)
+            offset, length = len(self.names), 0
+            self.names.append(location[2])
+        else:
+            source = (kind, path, location[4] if kind == "jsonl" else None)
+            offset, length = location[2], location[3]
+        if source not in self.source_ids:
+            self.source_ids[source] = len(self.sources)
+            self.sources.append(source)
+        self.doc_sources.append(self.source_ids[source])
+        self.offsets.append(offset)
+        self.lengths.append(length)
+
+    def extend(self, texts):
+        """
+        Add documents that have no location, spooling their texts
+        :param texts: Iterable of document texts
+        :return: None
+        """
+        for text in texts:
+            self.append(text)
+
+    def spool_text(self, text):
+        """
+        Append a text to the spool file
+        :param text: Document text
+        :return: Location of the text in the spool file
+        """
+        if self.spool is None:
+            if self.spool_filename is None:
+                handle, self.spool_filename = tempfile.mkstemp(
+                    suffix=".spool")
+                os.close(handle)
+                self.spool_finalizer = weakref.finalize(
+                    self, LazyDocuments.remove_spool, self.spool_filename)
+            self.spool = open(self.spool_filename, "ab")
+        encoded = text.encode("utf-8")
+        offset = self.spool.seek(0, os.SEEK_END)
+        self.spool.write(encoded)
+        self.spool.flush()
+        return ("span", self.spool_filename, offset, len(encoded))
+
+    def remove_spool(spool_filename):
+        """
+        Remove a temporary spool file
+        :param spool_filename: Path of the spool file
+        :return: None
+        """
+        if os.path.exists(spool_filename):
+            os.remove(spool_filename)
+    remove_spool = staticmethod(remove_spool)
+
+    def close(self):
+        """
+        Close open files and remove the spool file if it is a temporary
+        file. Spooled texts can not be read afterwards.
+        :return: None
+        """
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
+        for archive in self.archives.values():
+            archive.close()
+        self.archives = dict()
+        if getattr(self, "spool_finalizer", None) is not None:
+            self.spool_finalizer()
+            self.spool_finalizer = None
+
+    def read_span(self, path, offset, length):
+        """
+        Read bytes from a file
+        :param path: Path of the file
+        :param offset: Position of the first byte
+        :param length: Number of bytes
+        :return: Bytes read
+        """
+        with open(path, "rb") as handle:
+            handle.seek(offset)
+            return handle.read(length)
+
+    def __len__(self):
+        return len(self.doc_sources)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        kind, path, field = self.sources[self.doc_sources[index]]
+        offset, length = self.offsets[index], self.lengths[index]
+        if kind == "file":
+            with open(self.names[offset], "r") as doc:
+                return doc.read()
+        if kind == "zip":
+            if path not in self.archives:
+                self.archives[path] = zipfile.ZipFile(path)
+            return self.archives[path].read(self.names[offset]).decode(
+                "utf-8")
+        data = self.read_span(path, offset, length)
+        if kind == "jsonl":
+            return json.loads(data)[field]
+        return data.decode("utf-8")
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __getstate__(self):
+        """
+        Pickled attributes, without open files. An unpickled copy does not
+        remove the temporary spool file, which stays owned by this sequence.
+        :return: Dictionary of attributes
+        """
+        state = dict(self.__dict__)
+        state["spool"] = None
+        state["spool_finalizer"] = None
+        state["archives"] = dict()
+        return state
+
+
+def tfidf_weights(frequencies, document_frequency, num_documents):
+    """
+    Term frequency * inverted document frequency weights of a term
+    :param frequencies: Array of frequencies of the term in each document
+    :param document_frequency: Number of documents containing the term
+    :param num_documents: Number of documents in the index
+    :return: Array of term weights
+    """
+    invert_doc_frequency = np.log10(num_documents/(document_frequency*1.0))
+    return (1 + np.log10(frequencies)) * invert_doc_frequency
+
+
+def build_index_shard(shard):
+    """
+    Index a shard of documents in a worker process.
+    :param shard: Tuple of first document id, document paths, purpose of
+    the index and if stop words are removed
+    :return: Inverted Index of the shard with term weights not calculated
+    """
+    first_document_id, doc_locations, purpose, ignore_stopwords = shard
+    shard_index = InvertedIndex(purpose=purpose, auto_load=False)
+    shard_index.num_documents = first_document_id
+    for doc_location in doc_locations:
+        shard_index.parse_document(doc_location, ignore_stopwords)
+    return shard_index
+
+
+""" Inverted Index used to store contents of documents after parsing and
+preprocessing them. """
+
+
+class InvertedIndex(DocumentProcessing):
+    def __init__(self, document_loc=None, purpose="bs",
+                 is_dir=True, auto_load=True, workers=None, corpus=None,
+                 biword_threshold=None, max_segments=MAX_SEGMENTS,
+                 background_merges=False, records=None):
+        """
+        Load documents for directory, update inverted index and split into
+        testing and training set if auto load is True.
+        :param document_loc: Location of documents.
+        :param purpose: If the index will be used for boolean search
+        of vector space model.
+        :param is_dir: If the given document location is a directory.
+        :param auto_load: If the documents should be automatically loaded.
+        :param workers: Number of processes used to index a directory,
+        documents are indexed in this process if it is None.
+        :param corpus: TokenizedCorpus to load instead of a directory.
+        :param biword_threshold: Build a biword index of the word pairs found
+        in at least this many documents, for boolean search indexes.
+        :param max_segments: Number of segments of added documents kept
+        before they are merged.
+        :param background_merges: Merge segments in a background thread.
+        :param records: Iterable of (id, class, text) or (id, class, text,
+        location) records to load one at a time instead of a directory.
+        Their texts are not kept in memory and the classifier data frame is
+        left empty.
+        """
+        self.num_documents = 0
+        self.documents = list()
+        self.terms = list()
+        self.term_ids = dict()
+        self.posting_lists = list()
+        self.purpose = purpose
+        self.auto_load = auto_load
+        self.classifier_df = ClassifierDataFrame()
+        self.docLengths = np.zeros(0)
+        self.biword_threshold = biword_threshold
+        self.biword_index = None
+        self.segments = list()
+        self.tombstones = set()
+        self.deleted_ids = set()
+        self.pending_changes = False
+        self.max_segments = max_segments
+        self.background_merges = background_merges
+        self.merge_thread = None
+        self.document_keys = list()
+        self.document_classes = list()
+        if self.auto_load:
+            ignore_stopwords = self.purpose != "vsm"
+            if records is not None:
+                self.load_records(records, ignore_stopwords)
+            elif corpus is not None:
+                self.load_corpus(corpus, ignore_stopwords)
+            elif not is_dir:
+                self.load_data(document_loc, ignore_stopwords, is_text=True)
+            elif workers:
+                self.load_data_parallel(document_loc, ignore_stopwords,
+                                        workers)
+            else:
+                self.load_data(document_loc, ignore_stopwords)
+            if self.purpose == "vsm":
+                self.calculate_tfidf()
+            elif biword_threshold is not None:
+                self.build_biword_index(biword_threshold)
+            if records is None:
+                self.classifier_df.split_training_testing_set(t_size=0.1)
+
+    def save_index(self, filename, document_store=None):
+        """
+        Save Inverted Index in the binary index format to be memory mapped
+        and reused later. The classifier data frame is saved separately.
+        :param filename: Intended name for the index file including
+        absolute path
+        :param document_store: Path of a DocumentStore with the document
+        texts, which are then not copied into the index file
+        :return: None
+        """
+        write_index_file(filename, self, document_store)
+        save_biword_index(filename, self)
+
+    def load_index(filename):
+        """
+        Open a saved Inverted Index. Index files are memory mapped and read
+        lazily, so the loaded index is read only. Indexes saved as pickled
+        objects are unpickled.
+        :param filename: Absolute path of saved index
+        :return: Indexed Inverted Index.
+        """
+        if not is_index_file(filename):
+            return pickle.load(open(filename, "rb"))
+        obj = InvertedIndex(auto_load=False)
+        obj.__dict__.update(open_index_file(filename))
+        obj.biword_index = BiwordIndex.load(biword_index_file(filename))
+        return obj
+    load_index = staticmethod(load_index)
+
+    def load_data(self, directory, ignore_stopwords=True, is_text=False):
+        """
+        Go through each document in the directory specified
+        and load it into the inverted index.
+        :param directory: Location of documents or document content
+        :param ignore_stopwords: If stop words should be kept or removed.
+        :param is_text: If input is text of document location
+        :return: None
+        """
+        if is_text:
+            self.parse_document(directory, ignore_stopwords, is_text=True)
+        else:
+            for doc_location, class_ in list_class_documents(directory):
+                self.classifier_df.add_document(doc_location, class_)
+                self.parse_document(doc_location, ignore_stopwords)
+
+    def load_data_parallel(self, directory, ignore_stopwords=True,
+                           workers=None):
+        """
+        Index the documents in the directory specified using a pool of
+        processes. Documents are split into contiguous shards whose document
+        ids continue from the previous shard, so merging the partial indexes
+        in shard order keeps every postings list sorted.
+        :param directory: Location of documents
+        :param ignore_stopwords: If stop words should be kept or removed.
+        :param workers: Number of processes, defaults to number of CPUs
+        :return: None
+        """
+        workers = workers or os.cpu_count()
+        class_documents = list_class_documents(directory)
+        shard_size = max(1, -(-len(class_documents) // (workers * 4)))
+        shards = []
+        for start in range(0, len(class_documents), shard_size):
+            shard_documents = class_documents[start:start + shard_size]
+            shards.append((self.num_documents + start,
+                           [doc_location for doc_location, _ in
+                            shard_documents], self.purpose, ignore_stopwords))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for shard_index in executor.map(build_index_shard, shards):
+                self.merge_index(shard_index)
+        self.classifier_df.extend(self.documents,
+                                  [class_ for _, class_ in class_documents])
+
+    def merge_index(self, other):
+        """
+        Append the documents and postings of an index whose document ids
+        all come after the document ids of this index.
+        :param other: Inverted Index holding the following documents
+        :return: None
+        """
+        self.documents.extend(other.documents)
+        self.num_documents = max(self.num_documents, other.num_documents)
+        for term, postings_list in zip(other.terms, other.posting_lists):
+            if term not in self.term_ids:
+                self.term_ids[term] = len(self.terms)
+                self.terms.append(term)
+                self.posting_lists.append(postings_list)
+            else:
+                self.posting_lists[self.term_ids[term]].extend(postings_list)
+
+    def assign_document_id(self):
+        """
+        Assign a new unique document ID to the document
+        :return: Unique Document ID
+        """
+        self.num_documents += 1
+        return self.num_documents - 1
+
+    def parse_document(self, file_name, ignore_stopwords, is_text=False):
+        """
+        Parse a document and update inverted index with its terms.
+        :param file_name: Path to document
+        :param ignore_stopwords: If stopwords should be excluded or included
+        :param is_text: If document give in text of a path
+        :return: None
+        """
+        if is_text:
+            document_text = file_name
+        else:
+            document_text = self.read_text_file(file_name)
+        processed_tokens = self.pre_process(
+            document_text, remove_stopwords=ignore_stopwords is True,
+            stemming=True)
+        self.index_tokens(document_text, processed_tokens)
+
+    def index_tokens(self, document_text, processed_tokens):
+        """
+        Add a document that has already been preprocessed.
+        :param document_text: Content of document as text
+        :param processed_tokens: Processed tokens of the document
+        :return: Unique document ID of the document
+        """
+        document_id = self.assign_document_id()
+        self.add_document(document_text)
+        self.update_inv_index(processed_tokens, document_id)
+        return document_id
+
+    def load_corpus(self, corpus, ignore_stopwords=True):
+        """
+        Load the documents of a tokenized corpus into the inverted index.
+        :param corpus: TokenizedCorpus with class values
+        :param ignore_stopwords: If stop words should be kept or removed.
+        :return: None
+        """
+        for document_text, class_, tokens in zip(
+                corpus.documents, corpus.class_values,
+                corpus.get_tokens(remove_stopwords=ignore_stopwords)):
+            self.classifier_df.add_text(document_text, class_)
+            self.index_tokens(document_text, tokens)
+
+    def load_records(self, records, ignore_stopwords=True,
+                     spool_filename=None):
+        """
+        Load documents from an iterable of records one at a time. Only the
+        location of each text is kept, records without one have their text
+        written to a spool file. Record ids and class values are kept in
+        document_keys and document_classes, indexed by document id.
+        :param records: Iterable of (id, class, text) or (id, class, text,
+        location) records, see directory_records, jsonl_records and
+        archive_records
+        :param ignore_stopwords: If stop words should be kept or removed.
+        :param spool_filename: Path of the spool file, defaults to a
+        temporary file
+        :return: None
+        """
+        if len(self.documents) == 0:
+            self.documents = LazyDocuments(spool_filename)
+        lazy = isinstance(self.documents, LazyDocuments)
+        for record in records:
+            record_id, class_, document_text = record[:3]
+            location = record[3] if len(record) > 3 else None
+            document_id = self.assign_document_id()
+            if lazy:
+                self.documents.append(document_text, location)
+            else:
+                self.add_document(document_text)
+            self.document_keys.append(record_id)
+            self.document_classes.append(class_)
+            self.update_inv_index(self.pre_process(
+                document_text, remove_stopwords=ignore_stopwords,
+                stemming=True), document_id)
+
+    def add_document(self, document_content):
+        """
+        Add document's entire content as a whole to inverted index.
+        :param document_content: Content of document as text.
+        :return: None
+        """
+        self.documents.append(document_content)
+
+    def read_text_file(self, filename):
+        """
+        Open text file and read its contents into an entire string
+        :param filename: Path to file
+        :return: Text content of document
+        """
+        current_dir = os.getcwd()
+        doc_path = os.path.join(current_dir, filename)
+        try:
+            with open(doc_path, "r") as doc:
+                whole_doc = doc.read()
+        except:
+            print("Error reading file: {}".format(filename))
+            return None
+        return whole_doc
+
+    def update_inv_index(self, processed_tokens, document_id):
+        """
+        Update Inverted Index with new document contents. Tokens are first
+        collapsed into the positions of each distinct term so that every
+        postings list receives exactly one posting for the new document.
+        :param processed_tokens: Processed tokens of new document's content
+        :param document_id: Unique document ID of the new document
+        :return: None
+        """
+        store_term_weights = self.purpose == "vsm"
+        for term, positions in self.aggregate_tokens(processed_tokens).items():
+            if term not in self.term_ids:
+                self.term_ids[term] = len(self.terms)
+                self.terms.append(term)
+                self.posting_lists.append(PostingsList(store_term_weights))
+            postings_list = self.posting_lists[self.term_ids[term]]
+            if store_term_weights:
+                postings_list.append(document_id, frequency=len(positions))
+            else:
+                postings_list.append(document_id, positions)
+
+    def aggregate_tokens(self, processed_tokens):
+        """
+        Collapse a document's tokens into the positions of each distinct
+        term, in order of first occurrence.
+        :param processed_tokens: Processed tokens of a document
+        :return: Dictionary of term to list of positions (starting at 1)
+        """
+        term_positions = dict()
+        for token_index, token in enumerate(processed_tokens):
+            if token in term_positions:
+                term_positions[token].append(token_index + 1)
+            else:
+                term_positions[token] = [token_index + 1]
+        return term_positions
+
+    def calculate_tfidf(self):
+        """
+        Calculate term frequency * inverted document frequency for each term
+        and update each document in respective postings list with the new
+        term weight. Document lengths are kept in an array indexed by
+        document id.
+        :return: None
+        """
+        total_num_docs = len(self.documents)
+        squared_lengths = np.zeros(self.num_documents)
+        for term_posting_list in self.posting_lists:
+            frequencies = np.frombuffer(term_posting_list.frequencies,
+                                        dtype=np.int32)
+            tfidf = tfidf_weights(frequencies, len(term_posting_list),
+                                  total_num_docs)
+            term_posting_list.set_term_weights(tfidf)
+            np.add.at(squared_lengths,
+                      np.frombuffer(term_posting_list.doc_ids, dtype=np.int32),
+                      np.square(tfidf))
+        self.docLengths = np.sqrt(squared_lengths)
+
+    def add_documents(self, documents, class_values=None):
+        """
+        Index new documents into a new segment without touching the existing
+        postings lists. Segments are merged once there are more than
+        max_segments of them.
+        :param documents: Iterable of document texts
+        :param class_values: Class values of the documents, added to the
+        classifier data frame if given
+        :return: List of document ids of the new documents
+        """
+        documents = list(documents)
+        ignore_stopwords = self.purpose != "vsm"
+        if not isinstance(self.documents, (list, AppendableStrings,
+                                           LazyDocuments)):
+            self.documents = AppendableStrings(self.documents)
+        with segment_lock:
+            segment = IndexSegment(self.purpose, self.num_documents)
+            for document_text in documents:
+                segment.index_tokens(document_text, self.pre_process(
+                    document_text, remove_stopwords=ignore_stopwords,
+                    stemming=True))
+            self.documents.extend(documents)
+            self.num_documents = segment.num_documents
+            self.segments = self.segments + [segment]
+        if class_values is not None:
+            self.classifier_df.extend(documents, class_values)
+        self.mark_changed()
+        if len(self.segments) > self.max_segments:
+            if self.background_merges:
+                self.merge_thread = threading.Thread(
+                    target=self.merge_segments, daemon=True)
+                self.merge_thread.start()
+            else:
+                self.merge_segments()
+        return list(range(segment.first_document_id, segment.num_documents))
+
+    def delete_documents(self, doc_ids):
+        """
+        Mark documents as deleted. Their postings stay in place and are
+        skipped until the index is compacted.
+        :param doc_ids: Iterable of document ids
+        :return: None
+        """
+        with segment_lock:
+            for doc_id in doc_ids:
+                if 0 <= doc_id < self.num_documents and \
+                        doc_id not in self.deleted_ids:
+                    self.tombstones.add(doc_id)
+                    self.deleted_ids.add(doc_id)
+        self.mark_changed()
+
+    def mark_changed(self):
+        """
+        Drop merged postings lists and the biword index after documents were
+        added or deleted, and note that idf and document lengths need to be
+        recalculated.
+        :return: None
+        """
+        self.pending_changes = True
+        self.live_postings = dict()
+        self.biword_index = None
+
+    def refresh(self):
+        """
+        Recalculate document lengths from the raw frequencies of the main
+        postings lists and segments, with the idf of the documents that
+        have not been deleted. Search engines created afterwards see every
+        change made so far.
+        :return: None
+        """
+        with segment_lock:
+            self.live_postings = dict()
+            if self.purpose == "vsm":
+                num_documents = self.document_count()
+                squared_lengths = np.zeros(self.num_documents)
+                tombstones = np.fromiter(self.tombstones, dtype=np.int64)
+                for term in self.all_terms():
+                    parts = self.postings_parts(term)
+                    doc_ids = np.concatenate([np.frombuffer(
+                        part.doc_ids, dtype=np.int32) for part in parts])
+                    frequencies = np.concatenate([np.frombuffer(
+                        part.frequencies, dtype=np.int32) for part in parts])
+                    if len(tombstones) > 0:
+                        live = ~np.isin(doc_ids, tombstones)
+                        doc_ids, frequencies = doc_ids[live], \
+                            frequencies[live]
+                    if len(doc_ids) == 0:
+                        continue
+                    tfidf = tfidf_weights(frequencies, len(doc_ids),
+                                          num_documents)
+                    np.add.at(squared_lengths, doc_ids, np.square(tfidf))
+                self.docLengths = np.sqrt(squared_lengths)
+            self.pending_changes = False
+
+    def merge_segments(self, max_segments=None):
+        """
+        Merge neighbouring segments, the pair with the fewest documents
+        first, until at most max_segments remain. Merged segments are new
+        objects, so search engines created before keep their segments.
+        :param max_segments: Number of segments to keep, defaults to
+        self.max_segments
+        :return: None
+        """
+        if max_segments is None:
+            max_segments = self.max_segments
+        with segment_lock:
+            segments = list(self.segments)
+        merged = list(segments)
+        while len(merged) > max(1, max_segments):
+            sizes = [len(merged[i]) + len(merged[i + 1])
+                     for i in range(len(merged) - 1)]
+            smallest = sizes.index(min(sizes))
+            merged[smallest:smallest + 2] = [IndexSegment.merge(
+                merged[smallest], merged[smallest + 1])]
+        with segment_lock:
+            if self.segments[:len(segments)] == segments:
+                self.segments = merged + self.segments[len(segments):]
+
+    def compact(self):
+        """
+        Merge all segments into the main postings lists and remove the
+        postings of deleted documents. The biword index is rebuilt if the
+        index was created with one.
+        :return: None
+        """
+        if self.pending_changes:
+            self.refresh()
+        with segment_lock:
+            terms = list()
+            posting_lists = list()
+            for term in self.all_terms():
+                postings_list = self.live_postings_list(term, cache=False)
+                if len(postings_list) > 0:
+                    terms.append(term)
+                    posting_lists.append(postings_list)
+            self.terms = terms
+            self.posting_lists = posting_lists
+            self.build_term_dictionary()
+            self.segments = list()
+            self.tombstones = set()
+            self.live_postings = dict()
+        if self.purpose == "bs" and self.biword_threshold is not None:
+            self.build_biword_index(self.biword_threshold)
+
+    def __getstate__(self):
+        """
+        Pickled attributes, without the background merge thread
+        :return: Dictionary of attributes
+        """
+        state = dict(self.__dict__)
+        state.pop("merge_thread", None)
+        return state
+
+    def pack_postings(self, max_length=None):
+        """
+        Keep postings lists in their encoded form until they are next used.
+        Short postings lists belong to rare terms that are seldom queried.
+        :param max_length: Only pack lists with at most this many postings,
+        all lists are packed if it is None
+        :return: None
+        """
+        for postings_list in self.posting_lists:
+            if max_length is None or len(postings_list) <= max_length:
+                postings_list.pack()
+
+    def build_biword_index(self, min_frequency):
+        """
+        Build the biword index of a boolean search index and print how much
+        space it takes next to the positional postings.
+        :param min_frequency: Minimum number of documents containing a pair
+        :return: None
+        """
+        self.biword_index = BiwordIndex.from_inverted_index(self,
+                                                            min_frequency)
+        print("Biword index: {} word pairs, {} bytes, {:.1%} of the "
+              "positional postings".format(
+                len(self.biword_index.terms), self.biword_index.nbytes(),
+                self.biword_index.nbytes() * 1.0 /
+                max(1, self.postings_nbytes())))
+
+    def postings_nbytes(self):
+        """
+        Approximate memory used by all postings lists
+        :return: Number of bytes
+        """
+        return sum(postings_list.nbytes()
+                   for postings_list in self.posting_lists)
+
+    def __repr__(self):
+        """
+        Representable form of inverted index
+        :return: String format of object to display
+        """
+        output = ""
+        for i in range(0, len(self.terms)):
+            output += "{:>12}\t".format(self.terms[i])
+            doclist = self.posting_lists[i]
+            for j in range(0, len(doclist)):
+                output += "[{}]".format(doclist[j].id)
+                output += " <"
+                output += "{}, ".format(str(doclist[j].positions))
+                output += ">\t"
+            output += "\n"
+        return output
+
+
+""" Immutable postings of a batch of documents added to an InvertedIndex
+after it was built. Document ids continue from the documents before them,
+and texts are kept by the index the segment belongs to.
+"""
+
+
+class IndexSegment(InvertedIndex):
+    def __init__(self, purpose, first_document_id):
+        """
+        Create an empty segment
+        :param purpose: Purpose of the index the segment belongs to
+        :param first_document_id: Id of the first document of the segment
+        """
+        InvertedIndex.__init__(self, purpose=purpose, auto_load=False)
+        self.first_document_id = first_document_id
+        self.num_documents = first_document_id
+        self.classifier_df = None
+
+    def add_document(self, document_content):
+        """
+        Segments leave document texts to their index.
+        :param document_content: Content of document as text.
+        :return: None
+        """
+        pass
+
+    def merge(first, second):
+        """
+        Merge two neighbouring segments into a new one
+        :param first: Segment with the lower document ids
+        :param second: Segment that follows it
+        :return: IndexSegment
+        """
+        merged = IndexSegment(first.purpose, first.first_document_id)
+        store_term_weights = first.purpose == "vsm"
+        for segment in (first, second):
+            for term, postings_list in zip(segment.terms,
+                                           segment.posting_lists):
+                if term not in merged.term_ids:
+                    merged.term_ids[term] = len(merged.terms)
+                    merged.terms.append(term)
+                    merged.posting_lists.append(
+                        PostingsList(store_term_weights))
+                merged.posting_lists[merged.term_ids[term]].extend(
+                    postings_list)
+        merged.num_documents = second.num_documents
+        return merged
+    merge = staticmethod(merge)
+
+    def __len__(self):
+        return self.num_documents - self.first_document_id
+
+
+""" Builds an index file for corpora larger than memory with single pass in
+memory indexing (SPIMI). Documents are indexed into a block until its
+estimated size reaches the memory budget, then the block's postings lists
+are written to a temporary run file in term order. Closing the builder
+merges the runs term by term with a k-way merge straight into the binary
+index format, calculating term weights and document lengths on the way, so
+only one term's postings are in memory during the merge. Document texts are
+kept as locations in LazyDocuments.
+"""
+
+
+class SPIMIIndexBuilder(DocumentProcessing):
+    def __init__(self, filename, purpose="bs",
+                 memory_budget=SPIMI_MEMORY_BUDGET, temp_dir=None,
+                 spool_filename=None):
+        """
+        Start building an index file
+        :param filename: Path of the index file
+        :param purpose: If the index will be used for boolean search
+        of vector space model.
+        :param memory_budget: Estimated number of bytes of postings held
+        in memory before a block is written to a run file
+        :param temp_dir: Directory of the run files, defaults to the system
+        temporary directory
+        :param spool_filename: Path of the spool file of texts that have no
+        location, defaults to a temporary file
+        """
+        self.filename = filename
+        self.purpose = purpose
+        self.memory_budget = memory_budget
+        self.temp_dir = temp_dir
+        self.num_documents = 0
+        self.documents = LazyDocuments(spool_filename)
+        self.document_keys = list()
+        self.document_classes = list()
+        self.run_files = list()
+        self.num_runs = 0
+        self.block = None
+        self.block_bytes = 0
+
+    def add_records(self, records):
+        """
+        Index documents from an iterable of records one at a time.
+        :param records: Iterable of (id, class, text) or (id, class, text,
+        location) records, see directory_records, jsonl_records and
+        archive_records
+        :return: None
+        """
+        ignore_stopwords = self.purpose != "vsm"
+        for record in records:
+            record_id, class_, document_text = record[:3]
+            location = record[3] if len(record) > 3 else None
+            self.add_tokens(self.pre_process(
+                document_text, remove_stopwords=ignore_stopwords,
+                stemming=True))
+            self.documents.append(document_text, location)
+            self.document_keys.append(record_id)
+            self.document_classes.append(class_)
+
+    def add_tokens(self, processed_tokens):
+        """
+        Index the processed tokens of the next document into the current
+        block, writing the block out once it exceeds the memory budget.
+        :param processed_tokens: Processed tokens of the document
+        :return: Document id of the document
+        """
+        if self.block is None:
+            self.block = InvertedIndex(purpose=self.purpose, auto_load=False)
+        num_terms = len(self.block.terms)
+        document_id = self.num_documents
+        self.block.update_inv_index(processed_tokens, document_id)
+        self.num_documents += 1
+        new_postings = len(set(processed_tokens))
+        if self.purpose == "vsm":
+            self.block_bytes += 16 * new_postings
+        else:
+            self.block_bytes += 8 * new_postings + 4 * len(processed_tokens)
+        self.block_bytes += 200 * (len(self.block.terms) - num_terms)
+        if self.block_bytes >= self.memory_budget:
+            self.flush_block()
+        return document_id
+
+    def flush_block(self):
+        """
+        Write the postings lists of the current block to a run file in term
+        order and start a new block.
+        :return: None
+        """
+        if self.block is None or len(self.block.terms) == 0:
+            return
+        handle, run_filename = tempfile.mkstemp(suffix=".run",
+                                                dir=self.temp_dir)
+        with os.fdopen(handle, "wb") as run_file:
+            for term in sorted(self.block.terms):
+                encoded_term = term.encode("utf-8")
+                encoded = self.block.get_postings_list(term).encode(
+                    include_term_weights=False)
+                run_file.write(RUN_RECORD.pack(len(encoded_term),
+                                               len(encoded)))
+                run_file.write(encoded_term)
+                run_file.write(encoded)
+        self.run_files.append(run_filename)
+        self.num_runs += 1
+        self.block = None
+        self.block_bytes = 0
+
+    def read_run(run_index, run_filename):
+        """
+        Read the postings lists of a run file in term order.
+        :param run_index: Position of the run, which orders equal terms
+        :param run_filename: Path of the run file
+        :return: Generator of (term, run index, encoded postings)
+        """
+        with open(run_filename, "rb") as run_file:
+            while True:
+                header = run_file.read(RUN_RECORD.size)
+                if not header:
+                    return
+                term_length, postings_length = RUN_RECORD.unpack(header)
+                term = str(run_file.read(term_length), "utf-8")
+                yield term, run_index, run_file.read(postings_length)
+    read_run = staticmethod(read_run)
+
+    def close(self):
+        """
+        Merge the run files into the index file. Runs hold increasing
+        document ids, so appending a term's postings in run order keeps them
+        sorted. Term weights of vector space model indexes are calculated
+        from the merged frequencies, and the squares are added to the
+        document lengths.
+        :return: None
+        """
+        try:
+            self.flush_block()
+            self.merge_runs()
+        finally:
+            self.remove_runs()
+
+    def merge_runs(self):
+        """
+        Write the index file from the run files
+        :return: None
+        """
+        store_term_weights = self.purpose == "vsm"
+        writer = IndexFileWriter(self.filename, self.purpose,
+                                 self.num_documents)
+        try:
+            squared_lengths = np.zeros(self.num_documents)
+            runs = [self.read_run(run_index, run_filename)
+                    for run_index, run_filename in enumerate(self.run_files)]
+            current_term = None
+            postings_list = None
+            for term, run_index, encoded in heapq.merge(*runs):
+                if term != current_term:
+                    if current_term is not None:
+                        self.write_term(writer, current_term, postings_list,
+                                        squared_lengths)
+                    current_term = term
+                    postings_list = PostingsList(store_term_weights)
+                postings_list.extend(PostingsList.decode(
+                    encoded, store_term_weights, array("d")))
+            if current_term is not None:
+                self.write_term(writer, current_term, postings_list,
+                                squared_lengths)
+            if store_term_weights:
+                writer.set_doc_lengths(np.sqrt(squared_lengths))
+            writer.set_documents(self.documents)
+            writer.close()
+        except BaseException:
+            writer.discard()
+            raise
+
+    def remove_runs(self):
+        """
+        Remove the run files written so far and the temporary spool file
+        :return: None
+        """
+        for run_filename in self.run_files:
+            if os.path.exists(run_filename):
+                os.remove(run_filename)
+        self.run_files = list()
+        self.documents.close()
+
+    def write_term(self, writer, term, postings_list, squared_lengths):
+        """
+        Calculate the term weights of a merged postings list and write it
+        :param writer: IndexFileWriter of the index file
+        :param term: Term
+        :param postings_list: Postings list merged from every run
+        :param squared_lengths: Squared document lengths, updated in place
+        :return: None
+        """
+        if postings_list.store_term_weights:
+            tfidf = tfidf_weights(np.frombuffer(postings_list.frequencies,
+                                                dtype=np.int32),
+                                  len(postings_list), self.num_documents)
+            postings_list.set_term_weights(tfidf)
+            np.add.at(squared_lengths,
+                      np.frombuffer(postings_list.doc_ids, dtype=np.int32),
+                      np.square(tfidf))
+        writer.add_term(term, postings_list)
+
+
+def build_index_file(filename, records, purpose="bs",
+                     memory_budget=SPIMI_MEMORY_BUDGET, temp_dir=None):
+    """
+    Build an index file from records without holding all postings in
+    memory.
+    :param filename: Path of the index file
+    :param records: Iterable of (id, class, text) or (id, class, text,
+    location) records
+    :param purpose: If the index will be used for boolean search
+    of vector space model.
+    :param memory_budget: Estimated number of bytes of postings held in
+    memory before a block is written to a run file
+    :param temp_dir: Directory of the run files
+    :return: SPIMIIndexBuilder holding the record ids, class values and
+    number of run files written
+    """
+    builder = SPIMIIndexBuilder(filename, purpose, memory_budget, temp_dir)
+    try:
+        builder.add_records(records)
+        builder.close()
+    finally:
+        builder.remove_runs()
+    return builder
+
+
+""" Positional postings of the word pairs that appear in at least a minimum
+number of documents, keyed on "first second". The positions are those of the
+second word, where the pair ends, so a two word phrase query can be answered
+from a single list and longer phrases can be narrowed down to documents that
+contain their frequent pairs before positions are merged.
+"""
+
+
+class BiwordIndex(DocumentProcessing):
+    def __init__(self, min_frequency=None):
+        """
+        Create an empty biword index
+        :param min_frequency: Minimum number of documents containing a pair
+        """
+        self.purpose = "bs"
+        self.min_frequency = min_frequency
+        self.documents = list()
+        self.terms = list()
+        self.term_ids = dict()
+        self.posting_lists = list()
+
+    def from_inverted_index(inverted_index, min_frequency):
+        """
+        Find adjacent word pairs from the positional postings of a boolean
+        search index and keep those found in at least min_frequency
+        documents.
+        :param inverted_index: Boolean search InvertedIndex
+        :param min_frequency: Minimum number of documents containing a pair
+        :return: BiwordIndex
+        """
+        doc_ids, positions, term_ids = [], [], []
+        for term_id, postings_list in enumerate(inverted_index.posting_lists):
+            counts = np.diff(np.frombuffer(postings_list.position_offsets,
+                                           dtype=np.int32))
+            doc_ids.append(np.repeat(np.frombuffer(postings_list.doc_ids,
+                                                   dtype=np.int32), counts))
+            positions.append(np.frombuffer(postings_list.positions,
+                                           dtype=np.int32))
+            term_ids.append(np.full(len(positions[-1]), term_id))
+        biword_index = BiwordIndex(min_frequency)
+        if not doc_ids:
+            return biword_index
+        doc_ids = np.concatenate(doc_ids)
+        positions = np.concatenate(positions)
+        term_ids = np.concatenate(term_ids).astype(np.int64)
+        order = np.lexsort((positions, doc_ids))
+        doc_ids, positions, term_ids = \
+            doc_ids[order], positions[order], term_ids[order]
+        adjacent = (doc_ids[1:] == doc_ids[:-1]) & \
+            (positions[1:] == positions[:-1] + 1)
+        pair_keys = (term_ids[:-1] * len(inverted_index.terms) +
+                     term_ids[1:])[adjacent]
+        pair_doc_ids = doc_ids[1:][adjacent]
+        pair_positions = positions[1:][adjacent]
+        order = np.lexsort((pair_positions, pair_doc_ids, pair_keys))
+        pair_keys, pair_doc_ids, pair_positions = \
+            pair_keys[order], pair_doc_ids[order], pair_positions[order]
+        new_posting = np.ones(len(pair_keys), dtype=bool)
+        new_posting[1:] = (pair_keys[1:] != pair_keys[:-1]) | \
+            (pair_doc_ids[1:] != pair_doc_ids[:-1])
+        keys, key_starts = np.unique(pair_keys, return_index=True)
+        key_ends = np.append(key_starts[1:], len(pair_keys))
+        doc_frequencies = np.add.reduceat(new_posting, key_starts) \
+            if len(keys) else np.zeros(0)
+        biwords = []
+        for key, start, end in zip(keys[doc_frequencies >= min_frequency],
+                                   key_starts[doc_frequencies >=
+                                              min_frequency],
+                                   key_ends[doc_frequencies >=
+                                            min_frequency]):
+            postings_list = PostingsList()
+            posting_starts = start + np.flatnonzero(new_posting[start:end])
+            posting_ends = np.append(posting_starts[1:], end)
+            for posting_start, posting_end in zip(posting_starts,
+                                                  posting_ends):
+                postings_list.append(
+                    int(pair_doc_ids[posting_start]),
+                    pair_positions[posting_start:posting_end].tolist())
+            biwords.append((BiwordIndex.biword(
+                inverted_index.terms[key // len(inverted_index.terms)],
+                inverted_index.terms[key % len(inverted_index.terms)]),
+                postings_list))
+        biwords.sort(key=operator.itemgetter(0))
+        biword_index.terms = [biword for biword, postings_list in biwords]
+        biword_index.posting_lists = [postings_list for biword, postings_list
+                                      in biwords]
+        biword_index.build_term_dictionary()
+        return biword_index
+    from_inverted_index = staticmethod(from_inverted_index)
+
+    def biword(first, second):
+        """
+        Key of a word pair in the biword index
+        :param first: First term
+        :param second: Second term
+        :return: Biword key
+        """
+        return first + " " + second
+    biword = staticmethod(biword)
+
+    def get(self, first, second):
+        """
+        Postings list of a word pair
+        :param first: First term
+        :param second: Second term
+        :return: Posting List, None if the pair is not indexed
+        """
+        biword = self.biword(first, second)
+        if not self.check_existence(biword):
+            return None
+        return self.get_postings_list(biword)
+
+    def nbytes(self):
+        """
+        Approximate space used by the biword index
+        :return: Number of bytes
+        """
+        return sum(len(term.encode("utf-8")) for term in self.terms) + \
+            sum(postings_list.nbytes() for postings_list in
+                self.posting_lists)
+
+    def save(self, filename):
+        """
+        Save the biword index in the binary index format
+        :param filename: Path of the biword index file
+        :return: None
+        """
+        write_index_file(filename, self)
+
+    def load(filename):
+        """
+        Memory map a saved biword index
+        :param filename: Path of the biword index file
+        :return: BiwordIndex, None if the file does not exist
+        """
+        if not os.path.exists(filename):
+            return None
+        obj = BiwordIndex()
+        attributes = open_index_file(filename)
+        for name in ["terms", "term_ids", "posting_lists"]:
+            setattr(obj, name, attributes[name])
+        return obj
+    load = staticmethod(load)
+
+
+def biword_index_file(filename):
+    """
+    Path of the biword index saved next to an index file
+    :param filename: Path of the index file
+    :return: Path of the biword index file
+    """
+    return filename + ".biwords"
+
+
+def save_biword_index(filename, index):
+    """
+    Save the biword index of an inverted index or search engine next to its
+    index file, or remove a stale one if it has none.
+    :param filename: Path of the index file
+    :param index: InvertedIndex or SearchEngine
+    :return: None
+    """
+    biword_index = getattr(index, "biword_index", None)
+    if biword_index is not None:
+        biword_index.save(biword_index_file(filename))
+    elif os.path.exists(biword_index_file(filename)):
+        os.remove(biword_index_file(filename))
+
+
+SCORE_SLACK = 1e-9
+
+
+def lookup_doc_ids(doc_ids, candidates):
+    """
+    Find candidate documents in a sorted array of document ids.
+    :param doc_ids: Sorted array of document ids of a postings list
+    :param candidates: Array of document ids to look up
+    :return: Array of positions in doc_ids and boolean array of whether
+    each candidate was found there
+    """
+    indices = np.searchsorted(doc_ids, candidates)
+    found = indices < len(doc_ids)
+    found[found] = doc_ids[indices[found]] == candidates[found]
+    return indices, found
+
+
+""" Compressed set of document ids in the style of roaring bitmaps. Ids are
+grouped on their upper 16 bits into containers of the lower 16 bits: sparse
+containers are sorted numpy arrays combined with sorted list merges, and
+containers with more than ARRAY_CONTAINER_LIMIT ids are Python integers used
+as 65536 bit bitmaps, combined with word level &, | and & ~.
+"""
+
+ARRAY_CONTAINER_LIMIT = 4096
+CONTAINER_BYTES = 8192
+
+
+def popcount(bitmap):
+    """
+    Number of set bits of a bitmap container
+    :param bitmap: Python integer bitmap
+    :return: Number of bits set
+    """
+    return bin(bitmap).count("1")
+
+
+if hasattr(int, "bit_count"):
+    popcount = int.bit_count
+
+
+def array_to_bitmap(values):
+    """
+    Convert an array container to a bitmap container
+    :param values: Sorted numpy array of lower 16 bits
+    :return: Python integer bitmap
+    """
+    bits = np.zeros(1 << 16, dtype=np.uint8)
+    bits[values] = 1
+    return int.from_bytes(np.packbits(bits, bitorder="little").tobytes(),
+                          "little")
+
+
+def bitmap_bits(bitmap):
+    """
+    Expand a bitmap container into one boolean per lower 16 bit value
+    :param bitmap: Python integer bitmap
+    :return: Numpy array of 65536 booleans
+    """
+    return np.unpackbits(np.frombuffer(bitmap.to_bytes(
+        CONTAINER_BYTES, "little"), dtype=np.uint8),
+        bitorder="little").view(bool)
 
-    def add_position(self, position):
-        """
-        Add another position of a term to storage
-        :param position: Position of the term
-        :return: None
-        """
-        self.positions.append(position)
 
-    def increment_frequency(self):
-        """
-        Increment term frequency of the document
-        :return: None
-        """
-        self.term_weight += 1
+def bitmap_to_array(bitmap):
+    """
+    Convert a bitmap container to an array container
+    :param bitmap: Python integer bitmap
+    :return: Sorted numpy array of lower 16 bits
+    """
+    return np.flatnonzero(bitmap_bits(bitmap)).astype(np.uint16)
 
 
-""" Parent class for InvertedIndex and SearchEngine.
-Deals with pre-processing queries and document text as well as retrieving
-posting lists."""
+def optimize_container(container):
+    """
+    Store a container in the smaller of the two representations
+    :param container: Array or bitmap container
+    :return: Array or bitmap container, None if it is empty
+    """
+    if isinstance(container, int):
+        cardinality = popcount(container)
+        if cardinality == 0:
+            return None
+        if cardinality <= ARRAY_CONTAINER_LIMIT:
+            return bitmap_to_array(container)
+    elif len(container) == 0:
+        return None
+    elif len(container) > ARRAY_CONTAINER_LIMIT:
+        return array_to_bitmap(container)
+    return container
 
 
-class DocumentProcessing():
+def container_and(first, second):
+    """
+    Intersection of two containers
+    :param first: Array or bitmap container
+    :param second: Array or bitmap container
+    :return: Container, None if it is empty
+    """
+    if isinstance(first, int) and isinstance(second, int):
+        return optimize_container(first & second)
+    if isinstance(first, int):
+        first, second = second, first
+    if isinstance(second, int):
+        return optimize_container(first[bitmap_bits(second)[first]])
+    return optimize_container(np.intersect1d(first, second,
+                                             assume_unique=True))
 
-    def pre_process(self, document_content, remove_stopwords=False,
-                    stemming=True):
-        """
-        Tokenize, remove stopwords, stem tokens
-        :param document_content: Entire document text
-        :param remove_stopwords: If stop words should be removed
-        :param stemming: If tokens should be stemmed
-        :return: Processed tokens
-        """
-        preprocessed_tokens = nltk.word_tokenize(document_content)
-        preprocessed_tokens = [word.lower() for word in preprocessed_tokens]
-        if remove_stopwords:
-            stop_words = set(stopwords.words('english') + list(punctuation))
-            preprocessed_tokens = [word for word in preprocessed_tokens
-                                   if not word in stop_words]
-        if stemming:
-            stemmer = PorterStemmer()
-            preprocessed_tokens = [stemmer.stem(word)
-                                   for word in preprocessed_tokens]
-        return preprocessed_tokens
 
-    def get_postings_list(self, term):
-        """
-        Retrieve postings list of a particular term
-        :param term: Term whose postings list is required
-        :return: Postings list of term supplied
-        """
-        term_index = self.terms.index(term)
-        return self.posting_lists[term_index]
+def container_or(first, second):
+    """
+    Union of two containers
+    :param first: Array or bitmap container
+    :param second: Array or bitmap container
+    :return: Container
+    """
+    if isinstance(first, int) or isinstance(second, int):
+        if not isinstance(first, int):
+            first = array_to_bitmap(first)
+        if not isinstance(second, int):
+            second = array_to_bitmap(second)
+        return first | second
+    return optimize_container(np.union1d(first, second))
 
 
-""" Inverted Index used to store contents of documents after parsing and
-preprocessing them. """
+def container_andnot(first, second):
+    """
+    Values of the first container that are not in the second one
+    :param first: Array or bitmap container
+    :param second: Array or bitmap container
+    :return: Container, None if it is empty
+    """
+    if isinstance(first, int):
+        if not isinstance(second, int):
+            second = array_to_bitmap(second)
+        return optimize_container(first & ~second)
+    if isinstance(second, int):
+        return optimize_container(first[~bitmap_bits(second)[first]])
+    return optimize_container(np.setdiff1d(first, second, assume_unique=True))
 
 
-class InvertedIndex(DocumentProcessing):
-    def __init__(self, document_loc=None, purpose="bs",
-                 is_dir=True, auto_load=True):
+class DocIdBitmap:
+    def __init__(self, containers=None):
         """
-        Load documents for directory, update inverted index and split into
-        testing and training set if auto load is True.
-        :param document_loc: Location of documents.
-        :param purpose: If the index will be used for boolean search
-        of vector space model.
-        :param is_dir: If the given document location is a directory.
-        :param auto_load: If the documents should be automatically loaded.
+        Create a set of document ids
+        :param containers: Dictionary of upper 16 bits to container
         """
-        self.num_documents = 0
-        self.documents = list()
-        self.terms = list()
-        self.posting_lists = list()
-        self.purpose = purpose
-        self.auto_load = auto_load
-        self.classifier_df = ClassifierDataFrame()
-        self.docLengths = dict()
-        if self.auto_load:
-            if self.purpose == "vsm":
-                if is_dir:
-                    self.load_data(document_loc, ignore_stopwords=False)
-                else:
-                    self.load_data(document_loc,
-                                   ignore_stopwords=False, is_text=True)
-                self.calculate_tfidf()
-            else:
-                if is_dir:
-                    self.load_data(document_loc)
-                else:
-                    self.load_data(document_loc, is_text=True)
-            self.classifier_df.split_training_testing_set(t_size=0.1)
+        self.containers = containers if containers is not None else {}
 
-    def save_index(self, filename):
+    def from_doc_ids(doc_ids):
         """
-        Save Inverted Index as a pickle object to be retrieved and reused later
-        :param filename: Intended name for the pickle file including
-        absolute path
-        :return: None
+        Build a bitmap from sorted document ids
+        :param doc_ids: Sorted sequence of document ids
+        :return: DocIdBitmap
         """
-        pickle.dump(self, open(filename, "wb"))
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        keys, starts = np.unique(doc_ids >> 16, return_index=True)
+        ends = np.append(starts[1:], len(doc_ids))
+        containers = {}
+        for key, start, end in zip(keys.tolist(), starts, ends):
+            containers[key] = optimize_container(
+                (doc_ids[start:end] & 0xFFFF).astype(np.uint16))
+        return DocIdBitmap(containers)
+    from_doc_ids = staticmethod(from_doc_ids)
 
-    def load_index(filename):
+    def from_range(num_documents):
         """
-        Load Inverted Index from pickled objects
-        :param filename: Absolute path of pickled file
-        :return: Indexed Inverted Index.
+        Bitmap of all document ids below num_documents
+        :param num_documents: Number of documents
+        :return: DocIdBitmap
         """
-        obj = pickle.load(open(filename, "rb"))
-        return obj
-    load_index = staticmethod(load_index)
+        return DocIdBitmap.from_doc_ids(np.arange(num_documents))
+    from_range = staticmethod(from_range)
 
-    def load_data(self, directory, ignore_stopwords=True, is_text=False):
+    def __and__(self, other):
+        containers = {}
+        for key, container in self.containers.items():
+            if key in other.containers:
+                result = container_and(container, other.containers[key])
+                if result is not None:
+                    containers[key] = result
+        return DocIdBitmap(containers)
+
+    def __or__(self, other):
+        containers = dict(self.containers)
+        for key, container in other.containers.items():
+            if key in containers:
+                containers[key] = container_or(containers[key], container)
+            else:
+                containers[key] = container
+        return DocIdBitmap(containers)
+
+    def __sub__(self, other):
+        containers = {}
+        for key, container in self.containers.items():
+            if key in other.containers:
+                container = container_andnot(container, other.containers[key])
+            if container is not None:
+                containers[key] = container
+        return DocIdBitmap(containers)
+
+    def __len__(self):
+        return sum(popcount(container) if isinstance(container, int)
+                   else len(container)
+                   for container in self.containers.values())
+
+    def doc_ids(self):
         """
-        Go through each document in the directory specified
-        and load it into the inverted index.
-        :param directory: Location of documents or document content
-        :param ignore_stopwords: If stop words should be kept or removed.
-        :param is_text: If input is text of document location
-        :return: None
+        Document ids in the bitmap
+        :return: Sorted list of document ids
         """
-        if is_text:
-            self.parse_document(directory, ignore_stopwords, is_text=True)
-        else:
-            current_directory = os.getcwd()
-            doc_directory = os.path.join(current_directory, directory)
-            for class_ in os.listdir(doc_directory):
-                class_docs_loc = os.path.join(doc_directory, class_)
-                if os.path.isdir(class_docs_loc):
-                    for class_document in os.listdir(class_docs_loc):
-                        if not class_document.startswith("."):
-                            doc_location = os.path.join(class_docs_loc,
-                                                        class_document)
-                            self.classifier_df.add_document(doc_location,
-                                                            class_)
-                            self.parse_document(doc_location, ignore_stopwords)
+        doc_ids = []
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            if isinstance(container, int):
+                container = bitmap_to_array(container)
+            doc_ids.extend(((key << 16) | container.astype(np.int64))
+                           .tolist())
+        return doc_ids
 
-    def assign_document_id(self):
+
+""" Parses boolean queries made of terms, the upper case operators AND, OR
+and NOT, and parentheses. NOT binds tightest, then AND, then OR, and terms
+next to each other are joined with AND. The query is parsed into nested
+tuples: ("term", word), ("not", query), ("and", left, right) and
+("or", left, right).
+"""
+
+
+class BooleanQueryParser:
+    def __init__(self, query):
         """
-        Assign a new unique document ID to the document
-        :return: Unique Document ID
+        Split a query into operators, parentheses and words
+        :param query: Boolean search query
         """
-        self.num_documents += 1
-        return self.num_documents - 1
+        self.tokens = re.findall(r"\(|\)|[^\s()]+", query)
+        self.position = 0
 
-    def parse_document(self, file_name, ignore_stopwords, is_text=False):
+    def parse(query):
         """
-        Parse a document and update inverted index with its terms.
-        :param file_name: Path to document
-        :param ignore_stopwords: If stopwords should be excluded or included
-        :param is_text: If document give in text of a path
-        :return: None
+        Parse a boolean query
+        :param query: Boolean search query
+        :return: Parsed query, None if the query is empty
         """
-        document_id = self.assign_document_id()
-        if is_text:
-            document_text = file_name
-        else:
-            document_text = self.read_text_file(file_name)
-        self.add_document(document_text)
-        if ignore_stopwords is True:
-            processed_tokens = self.pre_process(document_text,
-                                                remove_stopwords=True,
-                                                stemming=True)
-        else:
-            processed_tokens = self.pre_process(document_text, stemming=True)
-        self.update_inv_index(processed_tokens, document_id)
+        parser = BooleanQueryParser(query)
+        if not parser.tokens:
+            return None
+        parsed_query = parser.parse_or()
+        if parser.position < len(parser.tokens):
+            raise ValueError("Unexpected {} in boolean query".format(
+                parser.tokens[parser.position]))
+        return parsed_query
+    parse = staticmethod(parse)
 
-    def add_document(self, document_content):
+    def peek(self):
         """
-        Add document's entire content as a whole to inverted index.
-        :param document_content: Content of document as text.
-        :return: None
+        Token at the current position
+        :return: Token, None at the end of the query
         """
-        self.documents.append(document_content)
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None
 
-    def read_text_file(self, filename):
+    def parse_or(self):
         """
-        Open text file and read its contents into an entire string
-        :param filename: Path to file
-        :return: Text content of document
+        Parse operands joined with OR
+        :return: Parsed query
         """
-        current_dir = os.getcwd()
-        doc_path = os.path.join(current_dir, filename)
-        try:
-            with open(doc_path, "r") as doc:
-                whole_doc = doc.read()
-        except:
-            print("Error reading file: {}".format(filename))
-            return None
-        return whole_doc
+        parsed_query = self.parse_and()
+        while self.peek() == "OR":
+            self.position += 1
+            parsed_query = ("or", parsed_query, self.parse_and())
+        return parsed_query
 
-    def update_inv_index(self, processed_tokens, document_id):
+    def parse_and(self):
         """
-        Update Inverted Index with new document contents
-        :param processed_tokens: Processed tokens of new document's content
-        :param document_id: Unique document ID of the new document
-        :return: None
+        Parse operands joined with AND or placed next to each other
+        :return: Parsed query
         """
-        for token_index in range(0, len(processed_tokens)):
-            if processed_tokens[token_index] not in self.terms:
-                self.terms.append(processed_tokens[token_index])
-                new_postings_list = list()
-                if self.purpose == "vsm":
-                    new_doc = Document(document_id, store_term_weights=True)
-                else:
-                    new_doc = Document(document_id, token_index + 1)
-                new_postings_list.append(new_doc)
-                self.posting_lists.append(new_postings_list)
-            else:
-                existing_posting_list = self.get_postings_list(
-                    processed_tokens[token_index])
-                doc_exists = False
-                for i in range(len(existing_posting_list)):
-                    if existing_posting_list[i].id == document_id:
-                        if self.purpose == "vsm":
-                            existing_posting_list[i].increment_frequency()
-                        else:
-                            existing_posting_list[i].add_position(
-                                token_index + 1)
-                        doc_exists = True
-                if doc_exists is False:
-                    if self.purpose == "vsm":
-                        new_doc = Document(
-                            document_id, store_term_weights=True)
-                    else:
-                        new_doc = Document(document_id, token_index + 1)
-                    existing_posting_list.append(new_doc)
+        parsed_query = self.parse_not()
+        while self.peek() is not None and self.peek() not in ("OR", ")"):
+            if self.peek() == "AND":
+                self.position += 1
+            parsed_query = ("and", parsed_query, self.parse_not())
+        return parsed_query
 
-    def calculate_tfidf(self):
+    def parse_not(self):
         """
-        Calculate term frequency * inverted document frequency for each term
-        and update each document in respective postings list with the new
-        term weight.
-        :return: None
+        Parse an operand preceded by any number of NOT
+        :return: Parsed query
         """
-        total_num_docs = len(self.documents)
-        for term in self.terms:
-            term_posting_list = self.get_postings_list(term)
-            num_docs_term = len(term_posting_list)
-            invert_doc_frequency = np.log10(total_num_docs/(num_docs_term*1.0))
-            for indiv_doc in term_posting_list:
-                tfidf = (1 + np.log10(indiv_doc.term_weight)) \
-                    * invert_doc_frequency
-                indiv_doc.term_weight = tfidf
-                if indiv_doc.id in self.docLengths.keys():
-                    self.docLengths[indiv_doc.id] += np.square(tfidf)
-                else:
-                    self.docLengths[indiv_doc.id] = np.square(tfidf)
-        for i in self.docLengths.keys():
-            self.docLengths[i] = np.sqrt(self.docLengths[i])
+        if self.peek() == "NOT":
+            self.position += 1
+            return ("not", self.parse_not())
+        return self.parse_operand()
 
-    def __repr__(self):
+    def parse_operand(self):
         """
-        Representable form of inverted index
-        :return: String format of object to display
+        Parse a word or a query in parentheses
+        :return: Parsed query
         """
-        output = ""
-        for i in range(0, len(self.terms)):
-            output += "{:>12}\t".format(self.terms[i])
-            doclist = self.posting_lists[i]
-            for j in range(0, len(doclist)):
-                output += "[{}]".format(doclist[j].id)
-                output += " <"
-                output += "{}, ".format(str(doclist[j].positions))
-                output += ">\t"
-            output += "\n"
-        return output
+        token = self.peek()
+        if token is None or token in ("AND", "OR", ")"):
+            raise ValueError("Expected a term or ( in boolean query, found "
+                             "{}".format(token or "the end of the query"))
+        self.position += 1
+        if token == "(":
+            parsed_query = self.parse_or()
+            if self.peek() != ")":
+                raise ValueError("Missing ) in boolean query")
+            self.position += 1
+            return parsed_query
+        return ("term", token)
 
 
 """Search Engine that seaches for documents matching a certain criteria and
@@ -314,20 +3175,34 @@ class SearchEngine(DocumentProcessing):
     def __init__(self, inverted_index):
         """
         Derive purpose, terms, documents, posting_lists and docLengths from
-        the inverted index supplied.
+        the inverted index supplied. Segments and deleted documents are
+        copied, so documents added to or deleted from the index later are not
+        seen by this search engine.
         :param inverted_index: Inverted Index object that contains loaded
         data.
         """
-        self.purpose = inverted_index.purpose
-        self.terms = inverted_index.terms
-        self.documents = inverted_index.documents
-        self.posting_lists = inverted_index.posting_lists
-        if self.purpose == "vsm":
-            self.docLengths = inverted_index.docLengths
+        if getattr(inverted_index, "pending_changes", False):
+            inverted_index.refresh()
+        with segment_lock:
+            self.purpose = inverted_index.purpose
+            self.terms = inverted_index.terms
+            self.term_ids = inverted_index.term_ids
+            self.documents = inverted_index.documents
+            self.posting_lists = inverted_index.posting_lists
+            if self.purpose == "vsm":
+                self.docLengths = inverted_index.docLengths
+            self.biword_index = getattr(inverted_index, "biword_index", None)
+            self.num_documents = getattr(inverted_index, "num_documents",
+                                         len(self.documents))
+            self.segments = list(getattr(inverted_index, "segments", []))
+            self.tombstones = set(getattr(inverted_index, "tombstones", ()))
+            self.deleted_ids = set(getattr(inverted_index, "deleted_ids", ()))
 
     def boolean_and_query(self, query):
         """
-        Provides documents that match the given boolean query
+        Provides documents that match the given boolean query. Terms are
+        intersected from the shortest postings list up, so each intersection
+        is driven by the smallest list seen so far.
         :param query: Boolean search query
         :return: list of documents (Document) that match the criteria
         """
@@ -363,6 +3238,93 @@ class SearchEngine(DocumentProcessing):
             return None
         return query_results
 
+    def boolean_query(self, query):
+        """
+        Provides documents that match a boolean query with AND, OR, NOT and
+        parentheses. Words are pre processed like indexed text, words that
+        are removed as stop words put no constraint on the results and words
+        missing from the index match no documents.
+        :param query: Boolean search query
+        :return: Sorted list of ids of the documents that match
+        """
+        results = self.evaluate_boolean_query(BooleanQueryParser.parse(query))
+        if results is None:
+            return []
+        return results.doc_ids()
+
+    def evaluate_boolean_query(self, parsed_query):
+        """
+        Evaluate a parsed boolean query on document id bitmaps. A term that
+        is ANDed with a negated query is combined with ANDNOT instead of
+        building the complement.
+        :param parsed_query: Query parsed by BooleanQueryParser
+        :return: DocIdBitmap, None if the query puts no constraint
+        """
+        if parsed_query is None:
+            return None
+        operator_ = parsed_query[0]
+        if operator_ == "term":
+            results = None
+            for token in self.pre_process(parsed_query[1],
+                                          remove_stopwords=True,
+                                          stemming=True):
+                term_bitmap = self.term_bitmap(token)
+                results = term_bitmap if results is None else \
+                    results & term_bitmap
+            return results
+        if operator_ == "not":
+            operand = self.evaluate_boolean_query(parsed_query[1])
+            if operand is None:
+                return None
+            return self.all_documents_bitmap() - operand
+        left_query, right_query = parsed_query[1], parsed_query[2]
+        if operator_ == "and" and right_query[0] == "not":
+            left_query, right_query = right_query, left_query
+        if operator_ == "and" and left_query[0] == "not":
+            excluded = self.evaluate_boolean_query(left_query[1])
+            results = self.evaluate_boolean_query(right_query)
+            if results is None:
+                return None if excluded is None else \
+                    self.all_documents_bitmap() - excluded
+            return results if excluded is None else results - excluded
+        left = self.evaluate_boolean_query(left_query)
+        right = self.evaluate_boolean_query(right_query)
+        if left is None:
+            return right
+        if right is None:
+            return left
+        return left & right if operator_ == "and" else left | right
+
+    def term_bitmap(self, term):
+        """
+        Document id bitmap of a term, built from its postings list once and
+        kept for later queries.
+        :param term: Term
+        :return: DocIdBitmap, empty if the term is not indexed
+        """
+        if getattr(self, "term_bitmaps", None) is None:
+            self.term_bitmaps = {}
+        if term not in self.term_bitmaps:
+            if self.check_existence(term):
+                self.term_bitmaps[term] = DocIdBitmap.from_doc_ids(
+                    np.frombuffer(self.get_postings_list(term).doc_ids,
+                                  dtype=np.int32))
+            else:
+                self.term_bitmaps[term] = DocIdBitmap()
+        return self.term_bitmaps[term]
+
+    def all_documents_bitmap(self):
+        """
+        Document id bitmap of every document, the complement of NOT
+        :return: DocIdBitmap
+        """
+        if getattr(self, "documents_bitmap", None) is None:
+            self.documents_bitmap = DocIdBitmap.from_range(
+                getattr(self, "num_documents", len(self.documents))) - \
+                DocIdBitmap.from_doc_ids(sorted(getattr(self, "deleted_ids",
+                                                        ())))
+        return self.documents_bitmap
+
     def sort_on_tf(self, query_tokens):
         """
         Sort terms according to the number of documents that contain them.
@@ -378,11 +3340,16 @@ class SearchEngine(DocumentProcessing):
             sorted_terms.append(term_info[0])
         return sorted_terms
 
-    def positional_search(self, query):
+    def positional_search(self, query, match_positions=False):
         """
         Accomodates free text search returning documents that contain terms
-        in the same order as the query.
+        in the same order as the query. Two word queries found in the biword
+        index are answered from it, with every position where the pair ends,
+        and longer queries only check positions in documents that contain
+        their indexed word pairs.
         :param query: Search query
+        :param match_positions: Keep every position where the phrase ends in
+        a document instead of stopping at the first one
         :return: List of documents that match the search criteria
         """
         processed_query = self.pre_process(query, remove_stopwords=True,
@@ -393,176 +3360,409 @@ class SearchEngine(DocumentProcessing):
             if self.check_existence(token) is False:
                 all_terms_exist = False
         if all_terms_exist:
-            if len(processed_query) == 2:
-                posting_list_one = self.get_postings_list(processed_query[0])
-                posting_list_two = self.get_postings_list(processed_query[1])
-                query_results = self.positional_intersect(posting_list_one,
-                                                          posting_list_two)
-            elif len(processed_query) > 2:
-                posting_list_one = self.get_postings_list(
-                    processed_query.pop(0))
-                posting_list_two = self.get_postings_list(
-                    processed_query.pop(0))
-                query_results = self.positional_intersect(posting_list_one,
-                                                          posting_list_two)
-                while len(query_results) > 0 and len(processed_query) > 0:
-                    posting_list_ = self.get_postings_list(
-                        processed_query.pop(0))
-                    query_results = self.positional_intersect(query_results,
-                                                              posting_list_)
+            if len(processed_query) == 1:
+                query_results = self.get_postings_list(processed_query[0])
+            elif len(processed_query) > 1:
+                biword_index = getattr(self, "biword_index", None)
+                biword_lists = []
+                if biword_index is not None:
+                    biword_lists = [
+                        biword_index.get(first, second) for first, second in
+                        zip(processed_query, processed_query[1:])]
+                    biword_lists = [biword_list for biword_list in
+                                    biword_lists if biword_list is not None]
+                if len(processed_query) == 2 and biword_lists:
+                    return biword_lists[0]
+                query_results = self.phrase_intersect(
+                    [self.get_postings_list(token)
+                     for token in processed_query],
+                    first_match_only=not match_positions,
+                    filter_lists=biword_lists)
         else:
             return None
         return query_results
 
+    def phrase_intersect(self, posting_lists, first_match_only=False,
+                         filter_lists=()):
+        """
+        Find documents that contain the terms of a phrase next to each other
+        and in order. Documents containing every term are found by seeking
+        through all lists from the shortest one, then the positions of each
+        term are merged in linear time with the positions where the phrase
+        so far ends.
+        :param posting_lists: Posting lists of the phrase terms in order
+        :param first_match_only: Stop at the first match in each document
+        :param filter_lists: Posting lists that matching documents must also
+        be in, such as biwords of the phrase
+        :return: Posting List of the matching documents holding the positions
+        where the phrase ends
+        """
+        phrase_results = PostingsList()
+        all_lists = list(filter_lists) + list(posting_lists)
+        shortest_list = min(all_lists, key=len)
+        pointers = [0] * len(all_lists)
+        for doc_id in shortest_list.doc_ids:
+            position_lists = []
+            for list_index, posting_list in enumerate(all_lists):
+                pointer = posting_list.seek(doc_id, pointers[list_index])
+                if pointer == len(posting_list):
+                    return phrase_results
+                pointers[list_index] = pointer
+                if posting_list.doc_ids[pointer] != doc_id:
+                    break
+                if list_index >= len(filter_lists):
+                    position_lists.append(posting_list.get_positions(pointer))
+            else:
+                end_positions = self.phrase_end_positions(position_lists,
+                                                          first_match_only)
+                if end_positions:
+                    phrase_results.append(doc_id, end_positions)
+        return phrase_results
+
+    def phrase_end_positions(position_lists, first_match_only=False):
+        """
+        Positions at which a phrase ends in a document. The end positions of
+        the phrase so far are carried forward one term at a time by merging
+        them, shifted by one, with the positions of the next term.
+        :param position_lists: Sorted positions of each phrase term in order
+        :param first_match_only: Stop at the first end of the whole phrase
+        :return: List of positions of the last term that end the phrase
+        """
+        end_positions = list(position_lists[0])
+        last_term = len(position_lists) - 1
+        for term_index in range(1, len(position_lists)):
+            positions = position_lists[term_index]
+            next_end_positions = []
+            pointer_end = 0
+            pointer_term = 0
+            while pointer_end < len(end_positions) and \
+                    pointer_term < len(positions):
+                expected_position = end_positions[pointer_end] + 1
+                if positions[pointer_term] == expected_position:
+                    next_end_positions.append(expected_position)
+                    if first_match_only and term_index == last_term:
+                        return next_end_positions
+                    pointer_end += 1
+                    pointer_term += 1
+                elif positions[pointer_term] < expected_position:
+                    pointer_term += 1
+                else:
+                    pointer_end += 1
+            end_positions = next_end_positions
+            if not end_positions:
+                break
+        return end_positions
+    phrase_end_positions = staticmethod(phrase_end_positions)
+
     def merge_intersect(self, post_list_one, post_list_two):
         """
-        Use merge algorithm to find documents existing in both posting lists.
+        Find documents existing in both posting lists. Every document of the
+        shorter list is looked up in the longer one with a galloping search,
+        so the cost is O(shorter x log longer) instead of walking both.
         :param post_list_one: Posting list of first term
         :param post_list_two: Posting List of second term
         :return: Posting List containing documents existing in both input
         posting lists.
         """
-        intersect_documents = []
-        pointer_one = 0
-        pointer_two = 0
-        while pointer_one < len(post_list_one) and pointer_two < len(
-                post_list_two):
-            if post_list_one[pointer_one].id == post_list_two[pointer_two].id:
-                intersect_documents.append(post_list_two[pointer_two])
-                pointer_one += 1
-                pointer_two += 1
-            elif post_list_one[pointer_one].id > post_list_two[pointer_two].id:
-                pointer_two += 1
-            else:
-                pointer_one += 1
-        return intersect_documents
+        two_is_shorter = len(post_list_two) < len(post_list_one)
+        if two_is_shorter:
+            short_list, long_list = post_list_two, post_list_one
+        else:
+            short_list, long_list = post_list_one, post_list_two
+        long_doc_ids = long_list.doc_ids
+        intersect_indices = []
+        pointer_long = 0
+        for pointer_short, doc_id in enumerate(short_list.doc_ids):
+            pointer_long = long_list.seek(doc_id, pointer_long)
+            if pointer_long == len(long_doc_ids):
+                break
+            if long_doc_ids[pointer_long] == doc_id:
+                if two_is_shorter:
+                    intersect_indices.append(pointer_short)
+                else:
+                    intersect_indices.append(pointer_long)
+        return post_list_two.select(intersect_indices)
 
     def ranked_search(self, query, k=10):
         """
         Search for top 10 documents that match the query using Vector Space
-        Model scores.
+        Model scores. Query terms are visited from the highest to the lowest
+        score upper bound, and once the k-th best partial score is above the
+        upper bound of the unvisited terms no new documents are admitted
+        (MaxScore), so common terms are only looked up for the remaining
+        candidates. Candidates are then scored with the same arithmetic as an
+        exhaustive search and the top k are kept in a bounded min-heap, which
+        gives the same documents in the same order.
         :param query: Search query
         :param k: number of documents to be retrieved
         :return: Top 10 documents that match the search criteria
         """
-        vsm_scores = dict()
         if self.purpose == "bs":
             print("Cannot proceed as Inverted Index supplied does not "
                   "contain term weights.")
             raise Exception
-        else:
-            query_tokens = self.pre_process(query, remove_stopwords=False,
-                                            stemming=True)
-            for q_token in query_tokens:
-                if q_token not in self.terms:
-                    continue
-                else:
-                    q_posting_list = self.get_postings_list(q_token)
-                    query_token_tfidf = (1 + np.log10(1)) * \
-                                        np.log10(len(self.documents) *
-                                         1.0 / len(q_posting_list))
-                    for document_ in q_posting_list:
-                        score = document_.term_weight * query_token_tfidf
-                        if document_.id in vsm_scores.keys():
-                            vsm_scores[document_.id] += score
-                        else:
-                            vsm_scores[document_.id] = score
-            for document_id_ in vsm_scores.keys():
-                vsm_scores[document_id_] = vsm_scores[document_id_] / \
-                    self.docLengths[document_id_]
-            ranked_results = sorted(vsm_scores.items(),
-                                    key=operator.itemgetter(1), reverse=True)
-            if len(ranked_results) > k:
-                result_docs = [ranked_results[rank][0]
-                               for rank in range(0, k)]
+        query_tokens = [q_token for q_token in
+                        self.pre_process(query, remove_stopwords=False,
+                                         stemming=True)
+                        if self.check_existence(q_token)]
+        if len(query_tokens) == 0 or k <= 0:
+            return []
+        doc_lengths = np.asarray(self.docLengths)
+        query_terms = {}
+        for q_token in query_tokens:
+            if q_token not in query_terms:
+                q_posting_list = self.get_postings_list(q_token)
+                query_token_tfidf = (1 + np.log10(1)) * \
+                    np.log10(self.document_count() * 1.0 /
+                             len(q_posting_list))
+                query_terms[q_token] = [
+                    np.frombuffer(q_posting_list.doc_ids, dtype=np.int32),
+                    np.frombuffer(q_posting_list.term_weights,
+                                  dtype=np.float64),
+                    query_token_tfidf, 0]
+            query_terms[q_token][3] += 1
+        upper_bounds = dict(
+            (q_token, count * query_token_tfidf *
+             self.max_normalized_weight(q_token, doc_ids, term_weights,
+                                        doc_lengths) * (1 + SCORE_SLACK))
+            for q_token, (doc_ids, term_weights, query_token_tfidf, count)
+            in query_terms.items())
+        visit_order = sorted(query_terms, key=upper_bounds.get, reverse=True)
+        candidates = np.zeros(0, dtype=np.int32)
+        partial_scores = np.zeros(0)
+        admit_documents = True
+        for visited, q_token in enumerate(visit_order):
+            doc_ids, term_weights, query_token_tfidf, count = \
+                query_terms[q_token]
+            remaining_bound = sum(upper_bounds[unvisited] for unvisited in
+                                  visit_order[visited + 1:])
+            if admit_documents:
+                merged = np.union1d(candidates, doc_ids)
+                merged_scores = np.zeros(len(merged))
+                merged_scores[np.searchsorted(merged, candidates)] = \
+                    partial_scores
+                merged_scores[np.searchsorted(merged, doc_ids)] += \
+                    count * query_token_tfidf * term_weights / \
+                    doc_lengths[doc_ids]
+                candidates, partial_scores = merged, merged_scores
             else:
-                result_docs = [ranked_results[rank][0]
-                               for rank in range(0, len(ranked_results))]
-            return result_docs
+                indices, found = lookup_doc_ids(doc_ids, candidates)
+                partial_scores[found] += count * query_token_tfidf * \
+                    term_weights[indices[found]] / \
+                    doc_lengths[candidates[found]]
+            if len(candidates) < k:
+                continue
+            threshold = np.partition(partial_scores, -k)[-k] * \
+                (1 - SCORE_SLACK)
+            if threshold > remaining_bound:
+                admit_documents = False
+                keep = partial_scores * (1 + SCORE_SLACK) + \
+                    remaining_bound >= threshold
+                candidates = candidates[keep]
+                partial_scores = partial_scores[keep]
+        return self.top_scoring_documents(query_tokens, query_terms,
+                                          candidates, doc_lengths, k)
 
-    def check_existence(self, term):
+    def max_normalized_weight(self, term, doc_ids, term_weights,
+                              doc_lengths):
         """
-        Check if a term exists in memory
-        :param term: Term to be searched for
-        :return: True / False based on whether it exists
+        Largest term weight of a term divided by the document length, the
+        most a document can score per unit of query weight for the term.
+        Computed once per term and kept for later queries.
+        :param term: Term
+        :param doc_ids: Array of document ids of the postings list
+        :param term_weights: Array of term weights of the postings list
+        :param doc_lengths: Array of document lengths indexed by document id
+        :return: Maximum normalized term weight
         """
-        if (term in self.terms):
-            return True
-        return False
+        if getattr(self, "max_normalized_weights", None) is None:
+            self.max_normalized_weights = {}
+        if term not in self.max_normalized_weights:
+            lengths = doc_lengths[doc_ids]
+            normalized = term_weights[lengths > 0] / lengths[lengths > 0]
+            self.max_normalized_weights[term] = \
+                float(normalized.max()) if len(normalized) else 0.0
+        return self.max_normalized_weights[term]
+
+    def top_scoring_documents(self, query_tokens, query_terms, candidates,
+                              doc_lengths, k):
+        """
+        Score candidate documents exactly, adding term scores in query order
+        before dividing by the document length, and keep the best k in a
+        min-heap. Equal scores are ordered by the first query term that
+        contains the document, then by document id.
+        :param query_tokens: Query tokens found in the index, in query order
+        :param query_terms: Dictionary of term to document ids, term weights
+        and query weight
+        :param candidates: Sorted array of candidate document ids
+        :param doc_lengths: Array of document lengths indexed by document id
+        :param k: number of documents to be retrieved
+        :return: List of the top k document ids
+        """
+        scores = np.zeros(len(candidates))
+        first_token = np.full(len(candidates), len(query_tokens))
+        for token_index, q_token in enumerate(query_tokens):
+            doc_ids, term_weights, query_token_tfidf, count = \
+                query_terms[q_token]
+            indices, found = lookup_doc_ids(doc_ids, candidates)
+            scores[found] += term_weights[indices[found]] * query_token_tfidf
+            first_token[found & (first_token > token_index)] = token_index
+        matched = first_token < len(query_tokens)
+        candidates = candidates[matched]
+        first_token = first_token[matched]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = scores[matched] / doc_lengths[candidates]
+        if len(scores) > k:
+            keep = scores >= np.partition(scores, -k)[-k]
+            candidates = candidates[keep]
+            first_token = first_token[keep]
+            scores = scores[keep]
+        heap = []
+        for doc_id, token_index, score in zip(candidates.tolist(),
+                                              first_token.tolist(),
+                                              scores.tolist()):
+            entry = (score, -token_index, -doc_id)
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+            elif entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+        return [-doc_id for score, token_index, doc_id in
+                sorted(heap, reverse=True)]
 
     def positional_intersect(self, post_list_one, post_list_two):
         """
-        Use merge algorithm to find documents that contain two terms in order.
+        Find documents that contain two terms in order.
         :param post_list_one: Posting list of first term
         :param post_list_two: Posting list of second term
         :return: Posting List containing documents that have the two terms
-        in order
-        """
-        intersect_documents = []
-        pointer_one = 0
-        pointer_two = 0
-        while pointer_one < len(post_list_one) and \
-                pointer_two < len(post_list_two):
-            if post_list_one[pointer_one].id == post_list_two[pointer_two].id:
-                position_list_1 = post_list_one[pointer_one].positions
-                position_list_2 = post_list_two[pointer_two].positions
-                pos_point_1 = 0
-                pos_point_2 = 0
-                match_found = False
-                while pos_point_1 < len(position_list_1) and match_found is \
-                        False:
-                    while pos_point_2 < len(position_list_2) and match_found is False:
-                        if position_list_1[pos_point_1] - \
-                                position_list_2[pos_point_2] == -1:
-                            intersect_documents.append(
-                                post_list_two[pointer_two])
-                            match_found = True
-                            break
-                        pos_point_2 += 1
-                    pos_point_2 = 0
-                    pos_point_1 += 1
-                pointer_one += 1
-                pointer_two += 1
-            elif post_list_one[pointer_one].id > post_list_two[pointer_two].id:
-                pointer_two += 1
-            else:
-                pointer_one += 1
-        return intersect_documents
+        in order, holding the positions of the second term that follow the
+        first one
+        """
+        return self.phrase_intersect([post_list_one, post_list_two])
 
-    def save_engine(self, filename):
+    def save_engine(self, filename, document_store=None):
         """
-        Save Search Engine as pickled object
+        Save Search Engine in the binary index format
         :param filename: Absolute path of Search Engine
+        :param document_store: Path of a DocumentStore with the document
+        texts, which are then not copied into the index file
         :return: None
         """
-        pickle.dump(self, open(filename, "wb"))
+        write_index_file(filename, self, document_store)
+        save_biword_index(filename, self)
 
     def load_engine(filename):
         """
-        Load indexed search engine from a pickle file
-        :param filename: Absolute path of pickle file
+        Open an indexed search engine. Index files are memory mapped and
+        read lazily, engines saved as pickle files are unpickled.
+        :param filename: Absolute path of saved engine
         :return: Indexed Search Engine
         """
-        obj = pickle.load(open(filename, "rb"))
+        if not is_index_file(filename):
+            return pickle.load(open(filename, "rb"))
+        obj = SearchEngine.__new__(SearchEngine)
+        attributes = open_index_file(filename)
+        for name in ["purpose", "terms", "term_ids", "documents",
+                     "posting_lists", "num_documents", "deleted_ids"]:
+            setattr(obj, name, attributes[name])
+        if obj.purpose == "vsm":
+            obj.docLengths = attributes["docLengths"]
+        obj.biword_index = BiwordIndex.load(biword_index_file(filename))
         return obj
     load_engine = staticmethod(load_engine)
 
 
-""" Stores training and testing set documents and their class values in a
-Pandas Data Frame.
+""" Documents and class values of the training or testing set, kept as plain
+lists together with their row numbers in the ClassifierDataFrame.
+"""
+
+
+class DocumentSplit:
+    def __init__(self, documents, class_values, indices):
+        """
+        :param documents: List of document texts
+        :param class_values: List of class values of the documents
+        :param indices: Row numbers of the documents in the data frame
+        """
+        self.documents = documents
+        self.class_values = class_values
+        self.indices = indices
+
+    def features_frame(self):
+        """
+        Documents as a single column data frame
+        :return: DataFrame with a document_contents column
+        """
+        return pd.DataFrame({"document_contents": pd.Series(
+            self.documents, dtype=object)})
+
+    def target_frame(self):
+        """
+        Class values as a single column data frame
+        :return: DataFrame with a class column
+        """
+        return pd.DataFrame({"class": pd.Series(self.class_values,
+                                                dtype=object)})
+
+    def __len__(self):
+        return len(self.documents)
+
+
+""" Stores training and testing set documents and their class values. Rows
+are collected in a list of texts and an array of class codes, and the Pandas
+Data Frame is only built when it is asked for. The training and testing sets
+are DocumentSplits, the data frames of the old attributes X_train, y_train,
+X_test and y_test are built from them on use.
 """
 
 
 class ClassifierDataFrame:
     def __init__(self):
         self.columns = ["document_contents", "class"]
-        self.df = pd.DataFrame(columns=self.columns)
-        self.features = None
-        self.target = None
-        self.X_train = None
-        self.y_train = None
-        self.X_test = None
-        self.y_test = None
+        self.documents = list()
+        self.class_codes = array("B")
+        self.class_names = list(CLASS_VALUES)
+        self.frame = None
+        self.train_set = None
+        self.test_set = None
+        self.train_index = None
+        self.test_index = None
+
+    def __setstate__(self, state):
+        """
+        Convert pickles holding the data frames of the training and testing
+        sets into lists and class codes. Pickles written before the row
+        numbers of the split were kept have their split found again by
+        matching the rows of X_train and X_test to the rows of df.
+        :param state: Pickled attributes
+        :return: None
+        """
+        if "df" not in state:
+            self.__dict__.update(state)
+            return
+        self.__init__()
+        df = state["df"]
+        self.extend(list(df["document_contents"]), list(df["class"]))
+        if state.get("train_index") is not None:
+            self.set_split(state["train_index"], state["test_index"])
+        elif state.get("X_train") is not None:
+            rows = dict()
+            for row, row_values in enumerate(zip(self.documents,
+                                                 self.class_values())):
+                rows.setdefault(row_values, []).append(row)
+            try:
+                train_index, test_index = [
+                    np.array([rows[row_values].pop(0) for row_values in
+                              zip(X["document_contents"], y["class"])],
+                             dtype=np.int64)
+                    for X, y in ((state["X_train"], state["y_train"]),
+                                 (state["X_test"], state["y_test"]))]
+            except (KeyError, IndexError):
+                print("Training and testing sets do not match the data "
+                      "frame, splitting it again")
+                self.split_training_testing_set(t_size=0.1)
+            else:
+                self.set_split(train_index, test_index)
 
     def save_dataframe(self, filename):
         """
@@ -592,21 +3792,89 @@ class ClassifierDataFrame:
         """
         try:
             with open(file_name) as document:
-                data_instance = pd.DataFrame([[document.read(), class_value]],
-                                             columns=self.columns)
-                self.df = pd.concat([self.df, data_instance]
-                                    ).reset_index(drop=True)
+                self.add_text(document.read(), class_value)
         except:
             print("Error reading file {} in class {}".format(file_name,
                                                              class_value))
 
-    def split_target_features(self):
+    def add_text(self, document_text, class_value):
+        """
+        Add text of a document to memory
+        :param document_text: Content of document as text
+        :param class_value: Class value it belongs to
+        :return: None
+        """
+        if class_value not in self.class_names:
+            self.class_names.append(class_value)
+        self.documents.append(document_text)
+        self.class_codes.append(self.class_names.index(class_value))
+        self.frame = None
+
+    def extend(self, documents, class_values):
+        """
+        Add the texts of several documents to memory
+        :param documents: Contents of the documents as text
+        :param class_values: Class value of each document
+        :return: None
+        """
+        for document_text, class_value in zip(documents, class_values):
+            self.add_text(document_text, class_value)
+
+    def class_values(self, indices=None):
+        """
+        Class values of the rows
+        :param indices: Row numbers, all rows if it is None
+        :return: List of class values
+        """
+        codes = self.class_codes if indices is None else \
+            [self.class_codes[i] for i in indices]
+        return [self.class_names[code] for code in codes]
+
+    @property
+    def df(self):
+        if self.frame is None:
+            self.frame = pd.DataFrame({
+                "document_contents": pd.Series(self.documents, dtype=object),
+                "class": pd.Series(self.class_values(), dtype=object)},
+                columns=self.columns)
+        return self.frame
+
+    @property
+    def X_train(self):
+        return self.train_set.features_frame()
+
+    @property
+    def y_train(self):
+        return self.train_set.target_frame()
+
+    @property
+    def X_test(self):
+        return self.test_set.features_frame()
+
+    @property
+    def y_test(self):
+        return self.test_set.target_frame()
+
+    def subset(self, indices):
+        """
+        Documents and class values of some of the rows
+        :param indices: Row numbers
+        :return: DocumentSplit
+        """
+        return DocumentSplit([self.documents[i] for i in indices],
+                             self.class_values(indices), indices)
+
+    def set_split(self, train_index, test_index):
         """
-        Split data frame into target and features
+        Set the rows of the training and testing sets
+        :param train_index: Row numbers of the training set
+        :param test_index: Row numbers of the testing set
         :return: None
         """
-        self.features = self.df["document_contents"].copy()
-        self.target = self.df["class"].copy()
+        self.train_index = train_index
+        self.test_index = test_index
+        self.train_set = self.subset(train_index)
+        self.test_set = self.subset(test_index)
 
     def split_training_testing_set(self, t_size):
         """
@@ -614,18 +3882,109 @@ class ClassifierDataFrame:
         :param t_size: Size of testing set
         :return: None
         """
-        self.split_target_features()
+        target = np.array(self.class_values(), dtype=object)
         stratified_split = StratifiedShuffleSplit(n_splits=1,
                                                   test_size=t_size, random_state=7)
-        for train_index, test_index in stratified_split.split(self.features, self.target):
-            self.X_train = pd.DataFrame(np.reshape(self.features.loc[train_index].values, (-1, 1)),
-                                        columns=["document_contents"]).reset_index(drop=True)
-            self.y_train = pd.DataFrame(np.reshape(self.target.loc[train_index].values, (-1, 1)),
-                                        columns=["class"]).reset_index(drop=True)
-            self.X_test = pd.DataFrame(np.reshape(self.features.loc[test_index].values, (-1, 1)),
-                                       columns=["document_contents"]).reset_index(drop=True)
-            self.y_test = pd.DataFrame(np.reshape(self.target.loc[test_index].values, (-1, 1)),
-                                       columns=["class"]).reset_index(drop=True)
+        for train_index, test_index in stratified_split.split(
+                np.zeros(len(target)), target):
+            self.set_split(train_index, test_index)
+
+
+""" Documents tokenized once for training. Tokenization is the expensive part
+of preprocessing, so each document is tokenized a single time and the stop
+word removed and stemmed variants needed by the classifiers and indexes are
+derived from the same lowercase tokens and kept for reuse.
+"""
+
+
+class TokenizedCorpus:
+    def __init__(self, documents, class_values=None, tokens=None):
+        """
+        Tokenize documents
+        :param documents: List of document texts
+        :param class_values: Class value of each document
+        :param tokens: Lowercase tokens of each document if they are already
+        tokenized
+        """
+        self.documents = documents
+        self.class_values = class_values
+        if tokens is None:
+            tokens = [preprocessing_pipeline.tokenize(document)
+                      for document in documents]
+        self.tokens = tokens
+        self.processed_tokens = dict()
+
+    def from_directory(directory, workers=None, detector=None):
+        """
+        Read and tokenize the documents of a directory holding one sub
+        directory per class value.
+        :param directory: Location of documents relative to working directory
+        :param workers: Number of processes used to tokenize documents,
+        documents are tokenized in this process if it is None
+        :param detector: DuplicateDetector, documents duplicating an earlier
+        document are left out if it is given
+        :return: Tokenized corpus
+        """
+        documents = []
+        class_values = []
+        records = directory_records(directory)
+        if detector is not None:
+            records = deduplicate_records(records, detector)
+        for _, class_, text, _ in records:
+            documents.append(text)
+            class_values.append(class_)
+        tokens = None
+        if workers:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                tokens = list(executor.map(
+                    preprocessing_pipeline.tokenize, documents,
+                    chunksize=max(1, len(documents) // (workers * 4))))
+        return TokenizedCorpus(documents, class_values, tokens)
+    from_directory = staticmethod(from_directory)
+
+    def get_tokens(self, remove_stopwords=True, stemming=True):
+        """
+        Processed tokens of every document, computed once per combination
+        of options.
+        :param remove_stopwords: If stop words should be removed
+        :param stemming: If tokens should be stemmed
+        :return: List of processed tokens of each document
+        """
+        key = (remove_stopwords, stemming)
+        if key not in self.processed_tokens:
+            self.processed_tokens[key] = [
+                preprocessing_pipeline.normalize(tokens, remove_stopwords,
+                                                 stemming)
+                for tokens in self.tokens]
+        return self.processed_tokens[key]
+
+    def subset(self, indices):
+        """
+        Corpus made of some of the documents, sharing their tokens
+        :param indices: Positions of the documents to keep
+        :return: Tokenized corpus
+        """
+        indices = list(indices)
+        subset = TokenizedCorpus(
+            [self.documents[i] for i in indices],
+            None if self.class_values is None else
+            [self.class_values[i] for i in indices],
+            [self.tokens[i] for i in indices])
+        for key, processed in self.processed_tokens.items():
+            subset.processed_tokens[key] = [processed[i] for i in indices]
+        return subset
+
+    def class_subset(self, class_value):
+        """
+        Corpus made of the documents of one class value
+        :param class_value: Class value
+        :return: Tokenized corpus
+        """
+        return self.subset([i for i, class_ in enumerate(self.class_values)
+                            if class_ == class_value])
+
+    def __len__(self):
+        return len(self.documents)
 
 
 """ Naive Bayes classifier that classifies documents into class values based on
@@ -634,22 +3993,58 @@ Bayes Rule
 
 
 class NaiveBayesClassifier(DocumentProcessing):
-    def __init__(self, classifier_df):
-        self.raw_data = None
-        self.raw_training_documents = classifier_df.X_train
-        self.training_class_labels = classifier_df.y_train
+    def __init__(self, classifier_df, corpus=None):
+        """
+        :param classifier_df: ClassifierDataFrame with training set
+        :param corpus: TokenizedCorpus of the training documents in the
+        order of the training set, tokenized here if it is None
+        """
+        training_set = classifier_df.train_set
         self.priors = dict()
         self.conditional_probabilities = dict()
         self.total_vocab_count = 0
         self.class_vocab_count = dict()
-        self.class_values = ["business", "sport", "politics",
-                             "entertainment", "tech"]
+        self.class_document_counts = dict()
+        self.class_values = list(CLASS_VALUES)
         self.metrics = dict()
-        self.consolidate_training_set()
+        if corpus is None:
+            corpus = TokenizedCorpus(training_set.documents,
+                                     training_set.class_values)
+        self.corpus = corpus
         self.parse_vocabulary()
-        self.N = self.raw_data.shape[0]
+        self.N = len(training_set)
         self.bernoulli_index = dict()
 
+    def __getstate__(self):
+        """
+        Leave the training corpus out of pickled classifiers
+        :return: Attributes to pickle
+        """
+        state = self.__dict__.copy()
+        state["corpus"] = None
+        return state
+
+    def __setstate__(self, state):
+        """
+        Count the training documents of each class for classifiers pickled
+        before the counts were kept, and drop the training texts that older
+        classifiers kept
+        :param state: Pickled attributes
+        :return: None
+        """
+        self.__dict__.update(state)
+        if "class_document_counts" not in state:
+            if "training_set" in state:
+                class_labels = self.training_set.class_values
+            else:
+                class_labels = list(self.raw_data["class"])
+            self.class_document_counts = {
+                class_value: class_labels.count(class_value)
+                for class_value in self.class_values}
+        for name in ["training_set", "raw_data", "raw_training_documents",
+                     "training_class_labels"]:
+            self.__dict__.pop(name, None)
+
     def save_model(self, filename):
         """
         Save Classifier as a pickled object
@@ -668,15 +4063,6 @@ class NaiveBayesClassifier(DocumentProcessing):
         return obj
     load_model = staticmethod(load_model)
 
-    def consolidate_training_set(self):
-        """
-        Combine target and features into a single data frame.
-        :return: None
-        """
-        consolidated_df = pd.concat([self.raw_training_documents,
-                                     self.training_class_labels], axis=1)
-        self.raw_data = consolidated_df
-
     def get_conditional_probability(self, word, class_value):
         """
         Get P(word|class) for a term.
@@ -685,8 +4071,8 @@ class NaiveBayesClassifier(DocumentProcessing):
         :return: Conditional Probability P(term|class)
         """
         class_df = self.conditional_probabilities[class_value]
-        return float(class_df[class_df.terms == word].loc[:,
-                     "conditional_probability"])
+        return float(class_df[class_df.terms == word][
+            "conditional_probability"].iloc[0])
 
     def get_bernoulli_condition_probability(self, word, class_value):
         """
@@ -696,17 +4082,71 @@ class NaiveBayesClassifier(DocumentProcessing):
         :return: Conditional probability
         """
         class_df = self.conditional_probabilities[class_value]
-        return float(class_df[class_df.terms == word].loc[:,
-                     "bernoulli_probability"])
+        return float(class_df[class_df.terms == word][
+            "bernoulli_probability"].iloc[0])
 
-    def fit(self):
+    def fit(self, engine="sparse"):
         """
         Train the model on training data set
+        :param engine: "sparse" to derive all statistics from one document
+        by term count matrix, "loop" to count terms class by class
+        :return: None
+        """
+        if engine == "sparse":
+            self.fit_count_matrix()
+        else:
+            for class_value in self.class_values:
+                self.build_bernoulli_index(class_value)
+                self.calculate_probabilities(class_value)
+        self.compiled_model = None
+
+    def compile(self):
+        """
+        Compile the trained probabilities into arrays used for prediction
+        :return: Compiled model
+        """
+        if getattr(self, "compiled_model", None) is None:
+            self.compiled_model = CompiledNaiveBayes(self)
+        return self.compiled_model
+
+    def fit_count_matrix(self):
+        """
+        Build a sparse document by term count matrix over the vocabulary of
+        the training set and derive priors, term counts and document
+        frequencies of every class with column sums over its rows.
         :return: None
         """
+        vocabulary = dict()
+        term_indices = array("i")
+        document_offsets = array("q", [0])
+        for tokens in self.corpus.get_tokens():
+            for token in tokens:
+                term_indices.append(vocabulary.setdefault(token,
+                                                          len(vocabulary)))
+            document_offsets.append(len(term_indices))
+        counts = csr_matrix(
+            (np.ones(len(term_indices), dtype=np.int64),
+             np.frombuffer(term_indices, dtype=np.int32),
+             np.frombuffer(document_offsets, dtype=np.int64)),
+            shape=(len(document_offsets) - 1, len(vocabulary)))
+        counts.sum_duplicates()
+        terms = np.array(list(vocabulary), dtype=object)
+        class_labels = np.array(self.corpus.class_values, dtype=object)
         for class_value in self.class_values:
-            self.build_bernoulli_index(class_value)
-            self.calculate_probabilities(class_value)
+            class_counts = counts[class_labels == class_value]
+            num_instances = np.asarray(class_counts.sum(axis=0)).ravel()
+            num_docs = class_counts.getnnz(axis=0)
+            in_class = num_instances > 0
+            N_c = class_counts.shape[0]
+            self.class_document_counts[class_value] = N_c
+            self.priors[class_value] = np.log(N_c / self.N)
+            self.class_vocab_count[class_value] = int(num_instances.sum())
+            self.conditional_probabilities[class_value] = \
+                self.build_conditional_df(terms[in_class],
+                                          num_instances[in_class],
+                                          num_docs[in_class],
+                                          self.class_vocab_count[class_value],
+                                          N_c)
 
     def build_bernoulli_index(self, class_value):
         """
@@ -715,11 +4155,11 @@ class NaiveBayesClassifier(DocumentProcessing):
         :param class_value: Class Value
         :return: None
         """
-        class_docs = list(self.raw_data[self.raw_data["class"] == class_value]
-                          .copy()["document_contents"])
+        class_corpus = self.corpus.class_subset(class_value)
         inverted_index = InvertedIndex(auto_load=False)
-        for class_doc in class_docs:
-            inverted_index.load_data(class_doc, is_text=True)
+        for class_doc, tokens in zip(class_corpus.documents,
+                                     class_corpus.get_tokens()):
+            inverted_index.index_tokens(class_doc, tokens)
         self.bernoulli_index[class_value] = inverted_index
 
     def parse_vocabulary(self):
@@ -727,14 +4167,8 @@ class NaiveBayesClassifier(DocumentProcessing):
         Calculate total number of words in the entire data set.
         :return: None
         """
-        for class_value_ in self.class_values:
-            class_docs = list(self.raw_data[self.raw_data["class"] ==
-                                            class_value_].copy()[
-                              "document_contents"])
-            for class_doc in class_docs:
-                tokens = self.pre_process(class_doc, remove_stopwords=True,
-                                          stemming=True)
-                self.total_vocab_count += len(tokens)
+        for tokens in self.corpus.get_tokens():
+            self.total_vocab_count += len(tokens)
 
     def calculate_probabilities(self, class_value):
         """
@@ -749,39 +4183,45 @@ class NaiveBayesClassifier(DocumentProcessing):
         num_instances = list()
         bernoulli_inv_index = self.bernoulli_index[class_value]
         num_docs = list()
-        class_docs = list(self.raw_data[self.raw_data["class"] == class_value]
-                          .copy()["document_contents"])
-        N_c = len(class_docs)
+        class_tokens = self.corpus.class_subset(class_value).get_tokens()
+        N_c = len(class_tokens)
+        self.class_document_counts[class_value] = N_c
         prior = np.log(N_c / self.N)
         self.priors[class_value] = prior
-        for class_doc in class_docs:
-            tokens = self.pre_process(class_doc, remove_stopwords=True,
-                                      stemming=True)
+        for tokens in class_tokens:
             for token in tokens:
                 voc_count += 1
                 if token not in terms:
                     terms.append(token)
                     num_instances.append(0)
                     num_docs.append(0)
-        for class_doc_ in class_docs:
-            tokens_ = self.pre_process(class_doc_, remove_stopwords=True,
-                                       stemming=True)
+        for tokens_ in class_tokens:
             for token_ in tokens_:
                 term_index = terms.index(token_)
                 posting_list_ = bernoulli_inv_index.get_postings_list(token_)
                 num_docs[term_index] = len(posting_list_)
                 num_instances[term_index] += 1
         self.class_vocab_count[class_value] = voc_count
-        conditional_probs = np.array([terms, num_instances, num_docs])
-        conditional_probs = conditional_probs.T
-        conditional_df = pd.DataFrame(conditional_probs,
-                                      columns=["terms",
-                                               "number_of_instances",
-                                               "number_of_docs"])
-        conditional_df["number_of_instances"] = \
-            conditional_df.number_of_instances.astype(int)
-        conditional_df["number_of_docs"] = \
-            conditional_df.number_of_docs.astype(int)
+        self.conditional_probabilities[class_value] = \
+            self.build_conditional_df(terms, num_instances, num_docs,
+                                      voc_count, N_c)
+
+    def build_conditional_df(self, terms, num_instances, num_docs, voc_count,
+                             N_c):
+        """
+        Build the data frame of conditional probabilities of a class.
+        :param terms: Terms occurring in the class
+        :param num_instances: Number of occurrences of each term in the class
+        :param num_docs: Number of documents of the class containing each term
+        :param voc_count: Number of tokens in the class
+        :param N_c: Number of documents in the class
+        :return: Data frame of terms with multinomial and bernoulli
+        probabilities
+        """
+        conditional_df = pd.DataFrame({
+            "terms": pd.Series(terms, dtype=str),
+            "number_of_instances": np.asarray(num_instances, dtype=int),
+            "number_of_docs": np.asarray(num_docs, dtype=int)})
         conditional_df["conditional_probability"] = (
             conditional_df["number_of_instances"] + 1)/(voc_count +
                                                         self.total_vocab_count * 1.0)
@@ -793,7 +4233,7 @@ class NaiveBayesClassifier(DocumentProcessing):
         conditional_df["bernoulli_complement"] = np.log(conditional_df[
             "bernoulli_complement"])
         conditional_df["bernoulli_probability"] = np.log(conditional_df["bernoulli_probability"])
-        self.conditional_probabilities[class_value] = conditional_df
+        return conditional_df
 
     def calculate_metrics(self, predictions, testing_labels):
         """
@@ -819,43 +4259,7 @@ class NaiveBayesClassifier(DocumentProcessing):
         """
         tokens = self.pre_process(
             pred_doc, remove_stopwords=True, stemming=True)
-        argmax = dict()
-        if mode == "b":  # bernoulli
-            for class_value in self.class_values:
-                class_df = self.conditional_probabilities[class_value]
-                output = self.priors[class_value]
-                probs = class_df.copy()
-                existing_terms_indices = list(probs[probs.terms.isin(
-                    tokens)].index)
-                for existing_term_index in existing_terms_indices:
-                    probs.iloc[existing_term_index, 2] = probs.iloc[
-                        existing_term_index, 1]
-                output += np.sum(probs["bernoulli_complement"])
-
-                # for word in np.array(class_df.terms):
-                #     instance = self.get_bernoulli_condition_probability(
-                #         word, class_value)
-                #     if word in tokens:
-                #         output += np.log(instance)
-                #     else:
-                #         output += np.log(1 - instance)
-                argmax[class_value] = output
-            return max(argmax, key=argmax.get)
-        elif mode == "m":  # multinomial
-            for class_value in self.class_values:
-                class_df = self.conditional_probabilities[class_value]
-                output = self.priors[class_value]
-                for word in tokens:
-                    if word in class_df.terms.unique():
-                        instance = self.get_conditional_probability(
-                            word, class_value)
-                        output += np.log(instance)
-                    else:
-                        output += np.log(
-                            1/(self.class_vocab_count[class_value] +
-                               self.total_vocab_count))
-                argmax[class_value] = output
-            return max(argmax, key=argmax.get)
+        return self.compile().predict([tokens], mode)[0]
 
     def predict_multiple(self, testing_df, mode):
         """
@@ -865,90 +4269,496 @@ class NaiveBayesClassifier(DocumentProcessing):
         :param mode: Bernoulli or Multinomial mode
         :return: Predicted class values for all input documents.
         """
-        predictions = []
         if mode == "m":  # multinomial
-            for document_content in testing_df["document_contents"].values:
-                tokens = self.pre_process(str(document_content), stemming=True)
-                maxima = dict()
-                for class_value in self.class_values:
-                    class_df = self.conditional_probabilities[class_value]
-                    output = self.priors[class_value]
-                    for word in tokens:
-                        if word in class_df.terms.unique():
-                            instance = self.get_conditional_probability(
-                                word, class_value)
-                            output += np.log(instance)
-                        else:
-                            output += np.log(1.0 /
-                                             (self.class_vocab_count[
-                                                  class_value] + self.total_vocab_count))
-                    maxima[class_value] = output
-                predictions.append(max(maxima, key=maxima.get))
-            predictions_df = pd.DataFrame(
-                predictions, columns=["class_predictions"])
-            return predictions_df
-        elif mode == "b":  # bernoulli
-            for document_content in testing_df["document_contents"].values:
-                tokens = self.pre_process(str(document_content))
-                maxima = dict()
-                for class_value in self.class_values:
-                    class_df = self.conditional_probabilities[class_value]
-                    output = self.priors[class_value]
-                    for word in np.array(class_df.terms):
-                        instance = self.get_bernoulli_condition_probability(
-                            word, class_value)
-                        if word in tokens:
-                            output += np.log(instance)
-                        else:
-                            output += np.log(1-instance)
-                    maxima[class_value] = output
-                    print(maxima)
-                predictions.append(max(maxima, key=maxima.get))
-            predictions_df = pd.DataFrame(
-                predictions, columns=["class_predictions"])
-            return predictions_df
+            tokens = [self.pre_process(str(document_content), stemming=True)
+                      for document_content in
+                      testing_df["document_contents"].values]
+        else:  # bernoulli
+            tokens = [self.pre_process(str(document_content))
+                      for document_content in
+                      testing_df["document_contents"].values]
+        predictions_df = pd.DataFrame(self.compile().predict(tokens, mode),
+                                      columns=["class_predictions"])
+        return predictions_df
+
+
+""" Naive Bayes model compiled for prediction. Every term of the training
+vocabulary gets a column, with one extra column for terms never seen in
+training, and the log probabilities of all classes are kept in dense
+classes x columns arrays. A batch of documents is scored with one sparse
+count matrix x dense matrix product followed by an argmax.
+"""
+
+
+class CompiledNaiveBayes:
+    def __init__(self, nb):
+        """
+        :param nb: Trained Naive Bayes classifier
+        """
+        self.class_values = list(nb.class_values)
+        self.term_columns = dict()
+        for class_value in self.class_values:
+            for term in nb.conditional_probabilities[class_value]["terms"]:
+                self.term_columns.setdefault(term, len(self.term_columns))
+        self.unknown_column = len(self.term_columns)
+        num_columns = self.unknown_column + 1
+        self.log_priors = np.array([nb.priors[class_value]
+                                    for class_value in self.class_values])
+        self.multinomial_log_probs = np.zeros((len(self.class_values),
+                                               num_columns))
+        for row, class_value in enumerate(self.class_values):
+            class_df = nb.conditional_probabilities[class_value]
+            denominator = nb.class_vocab_count[class_value] + \
+                nb.total_vocab_count * 1.0
+            self.multinomial_log_probs[row, :] = np.log(1 / denominator)
+            columns = [self.term_columns[term] for term in class_df["terms"]]
+            self.multinomial_log_probs[row, columns] = np.log(
+                class_df["conditional_probability"].values)
+        self.bernoulli_base = self.log_priors.copy()
+        self.bernoulli_deltas = np.zeros((len(self.class_values),
+                                          num_columns))
+        for row, class_value in enumerate(self.class_values):
+            class_df = nb.conditional_probabilities[class_value]
+            columns = [self.term_columns[term] for term in class_df["terms"]]
+            N_c = nb.class_document_counts[class_value]
+            log_probability = np.full(num_columns, np.log(1 / (N_c + 2)))
+            log_complement = np.full(num_columns, np.log(1 - 1 / (N_c + 2)))
+            log_probability[columns] = class_df["bernoulli_probability"].values
+            log_complement[columns] = class_df["bernoulli_complement"].values
+            log_probability[self.unknown_column] = 0
+            log_complement[self.unknown_column] = 0
+            self.bernoulli_base[row] += np.sum(log_complement)
+            self.bernoulli_deltas[row, :] = log_probability - log_complement
+
+    def count_matrix(self, token_lists):
+        """
+        Count the terms of each document in the columns of the model
+        :param token_lists: Processed tokens of each document
+        :return: Sparse documents x columns count matrix
+        """
+        columns = array("i")
+        document_offsets = array("q", [0])
+        term_columns = self.term_columns
+        unknown_column = self.unknown_column
+        for tokens in token_lists:
+            for token in tokens:
+                columns.append(term_columns.get(token, unknown_column))
+            document_offsets.append(len(columns))
+        counts = csr_matrix(
+            (np.ones(len(columns)), np.frombuffer(columns, dtype=np.int32),
+             np.frombuffer(document_offsets, dtype=np.int64)),
+            shape=(len(token_lists), unknown_column + 1))
+        counts.sum_duplicates()
+        return counts
+
+    def scores(self, token_lists, mode="m"):
+        """
+        Log posterior score of every class for a batch of documents. The
+        bernoulli score of a class starts from the sum of log(1 - p) over
+        the training vocabulary, as if no term was present, and adds
+        log p - log(1 - p) for each distinct term present in the document.
+        Terms a class never contains have p = 1 / (N_c + 2), the smoothed
+        document frequency of a term found in none of its documents.
+        :param token_lists: Processed tokens of each document
+        :param mode: Bernoulli ("b") or multinomial ("m") model
+        :return: Documents x classes array of scores
+        """
+        counts = self.count_matrix(token_lists)
+        if mode == "b":
+            counts.data[:] = 1
+            return counts @ self.bernoulli_deltas.T + self.bernoulli_base
+        return counts @ self.multinomial_log_probs.T + self.log_priors
+
+    def predict(self, token_lists, mode="m"):
+        """
+        Predict class values for a batch of documents
+        :param token_lists: Processed tokens of each document
+        :param mode: Bernoulli ("b") or multinomial ("m") model
+        :return: List of predicted class values
+        """
+        if len(token_lists) == 0:
+            return []
+        best_classes = np.argmax(self.scores(token_lists, mode), axis=1)
+        return [self.class_values[index] for index in best_classes]
+
+
+def top_k_documents(doc_ids, scores, k):
+    """
+    Select the k highest scoring documents without sorting all of them.
+    :param doc_ids: Array of document ids
+    :param scores: Array of scores of the documents
+    :param k: Number of documents to select
+    :return: Array of document ids, highest score first
+    """
+    if len(scores) > k:
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return doc_ids[top[np.lexsort((doc_ids[top], -scores[top]))]]
+
+
+""" Approximate nearest neighbour index over document tf-idf vectors using
+random hyperplane locality sensitive hashing. Each table hashes a vector to
+the signs of its projections on a few random hyperplanes, so vectors with a
+small angle between them tend to share a bucket. Only documents sharing a
+bucket with the query, in the query's bucket or in the buckets reached by
+flipping its least certain bits, are scored exactly.
+"""
+
+
+class HyperplaneLSHIndex:
+    def __init__(self, term_doc_matrix, num_tables=10, num_bits=8,
+                 num_probes=2, seed=7):
+        """
+        Hash every document into each table.
+        :param term_doc_matrix: Sparse terms x documents matrix of
+        normalized tf-idf weights
+        :param num_tables: Number of hash tables
+        :param num_bits: Number of hyperplanes, or bits, per table
+        :param num_probes: Number of neighbouring buckets probed per table
+        :param seed: Seed of the random hyperplanes
+        """
+        self.num_tables = num_tables
+        self.num_bits = num_bits
+        self.num_probes = num_probes
+        random_state = np.random.RandomState(seed)
+        self.hyperplanes = random_state.standard_normal(
+            (term_doc_matrix.shape[0], num_tables * num_bits)).astype(
+            np.float32)
+        self.doc_vectors = term_doc_matrix.T.tocsr()
+        self.bit_values = 1 << np.arange(num_bits, dtype=np.int64)
+        keys = self.hash_keys(self.doc_vectors @ self.hyperplanes)
+        self.bucket_doc_ids = np.argsort(keys, axis=0, kind="stable").T
+        self.bucket_keys = np.take_along_axis(keys.T, self.bucket_doc_ids,
+                                              axis=1)
+        self.num_candidates = 0
+
+    def hash_keys(self, projections):
+        """
+        Bucket key of each vector in each table
+        :param projections: Vectors x (tables * bits) array of projections
+        :return: Vectors x tables array of keys
+        """
+        bits = np.asarray(projections).reshape(
+            -1, self.num_tables, self.num_bits) > 0
+        return bits @ self.bit_values
+
+    def candidates(self, projection):
+        """
+        Documents sharing a probed bucket with a query in any table
+        :param projection: Projections of the query on all hyperplanes
+        :return: Array of candidate document ids
+        """
+        projection = np.asarray(projection).reshape(self.num_tables,
+                                                    self.num_bits)
+        keys = (projection > 0) @ self.bit_values
+        uncertain_bits = np.argsort(np.abs(projection), axis=1)[
+            :, :self.num_probes]
+        found = []
+        for table in range(self.num_tables):
+            probe_keys = [keys[table]] + [keys[table] ^ (1 << int(bit))
+                                          for bit in uncertain_bits[table]]
+            table_keys = self.bucket_keys[table]
+            for probe_key in probe_keys:
+                low = np.searchsorted(table_keys, probe_key, side="left")
+                high = np.searchsorted(table_keys, probe_key, side="right")
+                found.append(self.bucket_doc_ids[table][low:high])
+        return np.unique(np.concatenate(found))
+
+    def nearest_documents(self, queries, k):
+        """
+        Score the candidates of each query exactly and keep the best k.
+        :param queries: Sparse queries x terms matrix
+        :param k: Number of nearest documents
+        :return: List of arrays of document ids, nearest first
+        """
+        projections = np.asarray(queries @ self.hyperplanes)
+        nearest = []
+        for row in range(queries.shape[0]):
+            candidate_ids = self.candidates(projections[row])
+            self.num_candidates += len(candidate_ids)
+            scores = np.asarray(self.doc_vectors[candidate_ids] @
+                                queries[row].T.toarray()).ravel()
+            scored = scores > 0
+            nearest.append(top_k_documents(candidate_ids[scored],
+                                           scores[scored], k))
+        return nearest
 
 
 class KNN(DocumentProcessing):
-    def __init__(self, vsm_engine, cl_df):
+    def __init__(self, vsm_engine, cl_df, k=5):
+        """
+        :param vsm_engine: Search Engine built for vector space model on the
+        training documents
+        :param cl_df: ClassifierDataFrame with training set
+        :param k: Number of nearest documents voting on the class value
+        """
         self.search_engine = vsm_engine
         self.classifier_df = cl_df
         self.id_matching = dict()
+        self.k = k
+        self.term_doc_matrix = None
+        self.label_codes = None
+        self.approximate = False
+        self.ann_index = None
 
-    def fit(self):
+    def __getstate__(self):
+        """
+        Leave the classifier data frame out of pickled classifiers, the
+        class values of the training documents are kept in id_matching and
+        their texts are read from the search engine's documents.
+        :return: Attributes to pickle
+        """
+        state = self.__dict__.copy()
+        state["classifier_df"] = None
+        return state
+
+    def fit(self, corpus=None):
         """
         Consolidate training set from Classifer_DataFrame and compute id
         matching from the search engine document index
+        :param corpus: TokenizedCorpus the search engine was built from,
+        whose class values are used directly when given
+        :return: None
+        """
+        if corpus is not None:
+            self.id_matching = dict(enumerate(corpus.class_values))
+        elif self.classifier_df is None:
+            raise ValueError("A TokenizedCorpus is needed to fit a loaded "
+                             "classifier")
+        else:
+            train_set = self.classifier_df.train_set
+            document_ids = dict()
+            for doc_id, document in enumerate(self.search_engine.documents):
+                document_ids.setdefault(document, doc_id)
+            for document, class_value in zip(train_set.documents,
+                                             train_set.class_values):
+                self.id_matching[document_ids[document]] = class_value
+        self.build_document_vectors()
+
+    def build_document_vectors(self):
+        """
+        Build a sparse terms x documents matrix of the search engine's tf-idf
+        weights divided by document lengths, so that the product with a
+        query vector gives the cosine scores of ranked_search, and an array
+        of the class code of every document.
+        :return: None
+        """
+        engine = self.search_engine
+        num_documents = len(engine.documents)
+        term_offsets = array("q", [0])
+        doc_ids = []
+        term_weights = []
+        for postings_list in engine.posting_lists:
+            doc_ids.append(np.frombuffer(postings_list.doc_ids,
+                                         dtype=np.int32))
+            term_weights.append(np.frombuffer(postings_list.term_weights,
+                                              dtype=np.float64))
+            term_offsets.append(term_offsets[-1] + len(postings_list))
+        doc_ids = np.concatenate(doc_ids) if doc_ids else np.zeros(
+            0, dtype=np.int32)
+        term_weights = np.concatenate(term_weights) if term_weights else \
+            np.zeros(0)
+        doc_lengths = np.asarray([engine.docLengths[doc_id] for doc_id in
+                                  range(num_documents)]
+                                 if isinstance(engine.docLengths, dict)
+                                 else engine.docLengths, dtype=np.float64)
+        self.term_doc_matrix = csr_matrix(
+            (term_weights / doc_lengths[doc_ids], doc_ids,
+             np.frombuffer(term_offsets, dtype=np.int64)),
+            shape=(len(term_offsets) - 1, num_documents))
+        self.document_frequencies = np.diff(self.term_doc_matrix.indptr)
+        self.label_codes = np.full(num_documents, UNKNOWN_CLASS_CODE,
+                                   dtype=np.uint8)
+        for doc_id, class_ in self.id_matching.items():
+            self.label_codes[doc_id] = ClassificationLabels.encode_class(
+                class_)
+
+    def query_matrix(self, documents):
+        """
+        Weight the tokens of documents the way ranked_search weights a query,
+        each occurrence of a term adding its inverse document frequency.
+        :param documents: List of document texts
+        :return: Sparse documents x terms matrix
+        """
+        engine = self.search_engine
+        num_documents = len(engine.documents)
+        columns = array("i")
+        document_offsets = array("q", [0])
+        for document in documents:
+            for token in self.pre_process(document, remove_stopwords=False,
+                                          stemming=True):
+                term_id = engine.term_ids.get(token)
+                if term_id is not None:
+                    columns.append(term_id)
+            document_offsets.append(len(columns))
+        columns = np.frombuffer(columns, dtype=np.int32)
+        query_weights = np.log10(num_documents * 1.0 /
+                                 self.document_frequencies[columns])
+        queries = csr_matrix(
+            (query_weights, columns,
+             np.frombuffer(document_offsets, dtype=np.int64)),
+            shape=(len(documents), self.term_doc_matrix.shape[0]))
+        queries.sum_duplicates()
+        return queries
+
+    def nearest_documents(self, documents, k=None, approximate=None):
+        """
+        Find the k documents with the highest cosine scores for each of a
+        batch of documents with one sparse matrix product.
+        :param documents: List of document texts
+        :param k: Number of nearest documents, defaults to self.k
+        :param approximate: Only score candidates from the approximate
+        nearest neighbour index, defaults to self.approximate. The index is
+        built with default parameters if build_ann_index was not called.
+        :return: List of arrays of document ids, nearest first
+        """
+        if getattr(self, "term_doc_matrix", None) is None:
+            self.build_document_vectors()
+        k = k or getattr(self, "k", 5)
+        if approximate is None:
+            approximate = getattr(self, "approximate", False)
+        queries = self.query_matrix(documents)
+        if approximate:
+            if getattr(self, "ann_index", None) is None:
+                self.build_ann_index()
+            nearest = self.ann_index.nearest_documents(queries, k)
+            missed = [row for row in range(len(nearest))
+                      if len(nearest[row]) == 0]
+            if missed:
+                exact = self.exact_nearest_documents(queries[missed], k)
+                for row, nearest_doc_ids in zip(missed, exact):
+                    nearest[row] = nearest_doc_ids
+            return nearest
+        return self.exact_nearest_documents(queries, k)
+
+    def exact_nearest_documents(self, queries, k):
+        """
+        Score every document for each query with one sparse matrix product.
+        :param queries: Sparse queries x terms matrix
+        :param k: Number of nearest documents
+        :return: List of arrays of document ids, nearest first
+        """
+        scores = queries @ self.term_doc_matrix
+        nearest = []
+        for row in range(scores.shape[0]):
+            nearest.append(top_k_documents(
+                scores.indices[scores.indptr[row]:scores.indptr[row + 1]],
+                scores.data[scores.indptr[row]:scores.indptr[row + 1]], k))
+        return nearest
+
+    def build_ann_index(self, num_tables=10, num_bits=8, num_probes=2,
+                        seed=7):
+        """
+        Build the approximate nearest neighbour index used when predicting
+        with approximate=True. More tables or probes raise recall, more bits
+        make buckets smaller and predictions faster.
+        :param num_tables: Number of hash tables
+        :param num_bits: Number of hyperplanes, or bits, per table
+        :param num_probes: Number of neighbouring buckets probed per table
+        :param seed: Seed of the random hyperplanes
         :return: None
         """
-        consolidated_train_set = pd.concat([self.classifier_df.X_train,
-                                            self.classifier_df.y_train],
-                                           axis=1)
-        documents = self.search_engine.documents
-        for row in consolidated_train_set.values:
-            doc_id = documents.index(row[0])
-            self.id_matching[doc_id] = row[1]
+        if getattr(self, "term_doc_matrix", None) is None:
+            self.build_document_vectors()
+        self.ann_index = HyperplaneLSHIndex(self.term_doc_matrix, num_tables,
+                                            num_bits, num_probes, seed)
+
+    def measure_agreement(self, classifier_df=None):
+        """
+        Compare approximate predictions with exact predictions on the
+        testing set of a ClassifierDataFrame.
+        :param classifier_df: ClassifierDataFrame, defaults to the one the
+        classifier was created with, which is not kept in pickled
+        classifiers
+        :return: Dictionary with the fraction of documents classified the
+        same way, the time taken by both modes and the mean number of
+        candidates scored per document in approximate mode. Documents with
+        no candidates fall back to exact scoring. The approximate index is
+        built with default parameters if build_ann_index was not called.
+        """
+        classifier_df = classifier_df or self.classifier_df
+        if classifier_df is None:
+            raise ValueError("A ClassifierDataFrame is needed to measure the "
+                             "agreement of a loaded classifier")
+        documents = [str(document) for document in
+                     classifier_df.test_set.documents]
+        if getattr(self, "ann_index", None) is None:
+            self.build_ann_index()
+        start_time = time.time()
+        exact = [self.predict_single(document, approximate=False)
+                 for document in documents]
+        exact_time = time.time() - start_time
+        self.ann_index.num_candidates = 0
+        start_time = time.time()
+        approximate = [self.vote(self.nearest_documents(
+            [document], approximate=True)[0]) for document in documents]
+        approximate_time = time.time() - start_time
+        agreement = np.mean([exact_class == approximate_class for
+                             exact_class, approximate_class in
+                             zip(exact, approximate)]) if documents else 1.0
+        return {"agreement": float(agreement),
+                "exact_seconds": exact_time,
+                "approximate_seconds": approximate_time,
+                "mean_candidates": self.ann_index.num_candidates /
+                max(1, len(documents))}
+
+    def vote(self, nearest_doc_ids):
+        """
+        Majority class value of the nearest documents, ties going to the
+        class value of the nearer document.
+        :param nearest_doc_ids: Document ids, nearest first
+        :return: Class value or None if there are no nearest documents
+        """
+        class_value_counts = dict()
+        for doc_id in nearest_doc_ids:
+            class_ = ClassificationLabels.decode_class(
+                self.label_codes[doc_id])
+            if class_ is None:
+                continue
+            class_value_counts[class_] = class_value_counts.get(class_, 0) + 1
+        if not class_value_counts:
+            return None
+        return max(class_value_counts, key=class_value_counts.get)
 
-    def predict_single(self, document, is_dir=False):
+    def predict_single(self, document, is_dir=False, approximate=None):
         """
         Use vector space model to retrieve closest documents and classify
         new document based on majority of class values from k close documents.
         :param document: Absolute path of document to be classified
+        :param approximate: Use the approximate nearest neighbour index,
+        defaults to self.approximate
         :return: Class label predicted by the classifier
         """
-        class_value_counts = dict()
         if is_dir == True:
             doc_text = open(document, "r").read()
         else:
             doc_text = document
-        nearest_docs = self.search_engine.ranked_search(doc_text, k=5)
-        for doc_id in nearest_docs:
-            class_ = self.id_matching[doc_id]
-            if class_ in self.id_matching.keys():
-                class_value_counts[class_] += 1
-            else:
-                class_value_counts[class_] = 1
-        return max(class_value_counts, key=class_value_counts.get)
+        return self.vote(self.nearest_documents(
+            [doc_text], approximate=approximate)[0])
+
+    def predict_multiple(self, documents, batch_size=256, approximate=None):
+        """
+        Classify documents from any iterable in batches, one sparse matrix
+        product per batch.
+        :param documents: Iterable of document texts
+        :param batch_size: Number of documents classified together
+        :param approximate: Use the approximate nearest neighbour index,
+        defaults to self.approximate
+        :return: Generator of predicted class values in input order
+        """
+        batch = []
+        for document in documents:
+            batch.append(document)
+            if len(batch) == batch_size:
+                for nearest_doc_ids in self.nearest_documents(
+                        batch, approximate=approximate):
+                    yield self.vote(nearest_doc_ids)
+                batch = []
+        if batch:
+            for nearest_doc_ids in self.nearest_documents(
+                    batch, approximate=approximate):
+                yield self.vote(nearest_doc_ids)
 
     def save_model(self, filename):
         """
@@ -969,6 +4779,340 @@ class KNN(DocumentProcessing):
     load_model = staticmethod(load_model)
 
 
+LABELS_FILE_MAGIC = b"IRLABEL\0"
+LABELS_FORMAT_VERSION = 1
+LABELS_HEADER = struct.Struct("<8sIQ")
+
+
+""" Precomputed Naive Bayes and KNN class values of every indexed document,
+stored as one byte class code per document id so that search results are
+classified without touching the document text.
+"""
+
+
+class ClassificationLabels:
+    def __init__(self, nb_codes, knn_codes):
+        """
+        :param nb_codes: uint8 array of Naive Bayes class codes indexed by
+        document id
+        :param knn_codes: uint8 array of KNN class codes indexed by
+        document id
+        """
+        self.nb_codes = nb_codes
+        self.knn_codes = knn_codes
+
+    def encode_class(class_value):
+        """
+        Class code of a class value
+        :param class_value: Class value or None
+        :return: Index of the class value in CLASS_VALUES
+        """
+        if class_value is None:
+            return UNKNOWN_CLASS_CODE
+        return CLASS_VALUES.index(class_value)
+    encode_class = staticmethod(encode_class)
+
+    def decode_class(class_code):
+        """
+        Class value of a class code
+        :param class_code: Class code
+        :return: Class value or None if the class is unknown
+        """
+        if class_code == UNKNOWN_CLASS_CODE:
+            return None
+        return CLASS_VALUES[class_code]
+    decode_class = staticmethod(decode_class)
+
+    def from_classifiers(search_engine, nb, knn):
+        """
+        Classify every document of a search engine
+        :param search_engine: Search Engine whose document ids are used
+        :param nb: Trained Naive Bayes classifier
+        :param knn: Trained KNN classifier
+        :return: Classification labels
+        """
+        documents = search_engine.documents
+        nb_codes, knn_codes = ClassificationLabels.classify_documents(
+            documents, range(len(documents)), nb, knn)
+        return ClassificationLabels(nb_codes, knn_codes)
+    from_classifiers = staticmethod(from_classifiers)
+
+    def classify_documents(documents, doc_ids, nb, knn):
+        """
+        Class codes of some documents
+        :param documents: Document texts indexed by document id
+        :param doc_ids: Ids of the documents to classify
+        :param nb: Trained Naive Bayes classifier
+        :param knn: Trained KNN classifier
+        :return: uint8 arrays of the Naive Bayes and KNN class codes of the
+        documents
+        """
+        doc_ids = list(doc_ids)
+        nb_codes = np.full(len(doc_ids), UNKNOWN_CLASS_CODE, dtype=np.uint8)
+        knn_codes = nb_codes.copy()
+        positions = [position for position, doc_id in enumerate(doc_ids)
+                     if documents[doc_id] is not None]
+        nb_predictions = nb.compile().predict(
+            [nb.pre_process(documents[doc_ids[position]],
+                            remove_stopwords=True, stemming=True)
+             for position in positions], "m")
+        knn_predictions = knn.predict_multiple(
+            documents[doc_ids[position]] for position in positions)
+        for position, nb_class, knn_class in zip(positions, nb_predictions,
+                                                  knn_predictions):
+            nb_codes[position] = ClassificationLabels.encode_class(nb_class)
+            knn_codes[position] = ClassificationLabels.encode_class(
+                knn_class)
+        return nb_codes, knn_codes
+    classify_documents = staticmethod(classify_documents)
+
+    def extend_from_classifiers(self, search_engine, nb, knn):
+        """
+        Classify the documents added to a search engine after these labels
+        were computed
+        :param search_engine: Search Engine whose document ids are used
+        :param nb: Trained Naive Bayes classifier
+        :param knn: Trained KNN classifier
+        :return: Classification labels of all documents
+        """
+        nb_codes, knn_codes = ClassificationLabels.classify_documents(
+            search_engine.documents,
+            range(len(self), len(search_engine.documents)), nb, knn)
+        return ClassificationLabels(
+            np.concatenate([np.asarray(self.nb_codes, dtype=np.uint8),
+                            nb_codes]),
+            np.concatenate([np.asarray(self.knn_codes, dtype=np.uint8),
+                            knn_codes]))
+
+    def from_text_keyed(documents, nb_classifications, knn_classifications):
+        """
+        Convert label maps keyed on document text into classification labels
+        :param documents: Document texts indexed by document id
+        :param nb_classifications: Dictionary of text to Naive Bayes class
+        :param knn_classifications: Dictionary of text to KNN class
+        :return: Classification labels
+        """
+        nb_codes = np.full(len(documents), UNKNOWN_CLASS_CODE, dtype=np.uint8)
+        knn_codes = nb_codes.copy()
+        for doc_id, document in enumerate(documents):
+            nb_codes[doc_id] = ClassificationLabels.encode_class(
+                nb_classifications.get(document))
+            knn_codes[doc_id] = ClassificationLabels.encode_class(
+                knn_classifications.get(document))
+        return ClassificationLabels(nb_codes, knn_codes)
+    from_text_keyed = staticmethod(from_text_keyed)
+
+    def get(self, doc_id):
+        """
+        Class values of a document
+        :param doc_id: Document ID
+        :return: Naive Bayes class value and KNN class value, None for
+        documents added after the labels were computed
+        """
+        if doc_id >= len(self.nb_codes):
+            return None, None
+        return (self.decode_class(self.nb_codes[doc_id]),
+                self.decode_class(self.knn_codes[doc_id]))
+
+    def __len__(self):
+        return len(self.nb_codes)
+
+    def save(self, filename):
+        """
+        Save labels as a header followed by the Naive Bayes and KNN codes
+        :param filename: Absolute path of labels file
+        :return: None
+        """
+        handle, temp_filename = open_replacement(filename)
+        try:
+            handle.write(LABELS_HEADER.pack(LABELS_FILE_MAGIC,
+                                            LABELS_FORMAT_VERSION,
+                                            len(self.nb_codes)))
+            handle.write(np.asarray(self.nb_codes, dtype=np.uint8).tobytes())
+            handle.write(np.asarray(self.knn_codes, dtype=np.uint8).tobytes())
+        except BaseException:
+            discard_replacement(handle, temp_filename)
+            raise
+        finish_replacement(handle, temp_filename, filename)
+
+    def load(filename):
+        """
+        Memory map a labels file
+        :param filename: Absolute path of labels file
+        :return: Classification labels
+        """
+        with open(filename, "rb") as handle:
+            mapping = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, num_documents = LABELS_HEADER.unpack_from(mapping, 0)
+        if magic != LABELS_FILE_MAGIC or version != LABELS_FORMAT_VERSION:
+            raise ValueError("{} is not a supported labels file".format(
+                filename))
+        nb_codes = np.frombuffer(mapping, dtype=np.uint8, count=num_documents,
+                                 offset=LABELS_HEADER.size)
+        knn_codes = np.frombuffer(mapping, dtype=np.uint8,
+                                  count=num_documents,
+                                  offset=LABELS_HEADER.size + num_documents)
+        return ClassificationLabels(nb_codes, knn_codes)
+    load = staticmethod(load)
+
+
+BOOLEAN_ENGINE_FILE = "pickled_objects/Boolean_Search_Engine.index"
+VSM_ENGINE_FILE = "pickled_objects/VSM_Search_Engine.index"
+CLASSIFICATIONS_FILE = "pickled_objects/classifications.labels"
+BIWORD_MIN_FREQUENCY = 5
+STEM_CACHE_FILE = "pickled_objects/stem_cache.pickle"
+DOCUMENT_STORE_FILE = "pickled_objects/documents.store"
+KNN_DOCUMENT_STORE_FILE = "pickled_objects/training_set.store"
+DUPLICATES_REPORT_FILE = "pickled_objects/duplicates.tsv"
+KNN_DUPLICATES_REPORT_FILE = "pickled_objects/training_set_duplicates.tsv"
+NB_CLASSIFICATIONS_FILE = "pickled_objects/nb_classifications.pickle"
+KNN_CLASSIFICATIONS_FILE = "pickled_objects/knn_classifications.pickle"
+NAIVE_BAYES_FILE = "pickled_objects/Naive_Bayes.pickle"
+KNN_FILE = "pickled_objects/KNN.pickle"
+
+
+def load_pickle(filename):
+    """
+    Load a pickled object
+    :param filename: Absolute path of pickled file
+    :return: Unpickled object
+    """
+    with open(filename, "rb") as handle:
+        return pickle.load(handle)
+
+
+""" Keeps search engines and classification label maps loaded for the lifetime
+of the process so that they are not read from disk for every query. A
+resource is loaded again when the modification time or size of its file
+changes.
+"""
+
+
+class ResourceRegistry:
+    def __init__(self):
+        self.resources = dict()
+        self.lock = threading.Lock()
+
+    def get(self, filename, loader):
+        """
+        Retrieve a resource, loading it if it is not loaded yet or its file
+        changed since it was loaded. If a changed file cannot be loaded,
+        such as a file that is still being written by an older version of
+        this module, the resource loaded before is kept and loading is tried
+        again on the next call.
+        :param filename: Path of the resource file
+        :param loader: Function loading the resource from its file
+        :return: Loaded resource
+        """
+        with self.lock:
+            cached = self.resources.get(filename)
+            try:
+                file_stat = os.stat(filename)
+                signature = (file_stat.st_mtime_ns, file_stat.st_size)
+                if cached is None or cached[0] != signature:
+                    cached = (signature, loader(filename))
+                    self.resources[filename] = cached
+            except Exception as error:
+                if cached is None:
+                    raise
+                print("Error reloading {}, keeping the loaded version: "
+                      "{}".format(filename, error))
+        return cached[1]
+
+    def get_engine(self, filename):
+        """
+        Retrieve a saved search engine
+        :param filename: Path of saved search engine
+        :return: Search Engine
+        """
+        return self.get(filename, SearchEngine.load_engine)
+
+    def get_labels(self, filename):
+        """
+        Retrieve saved classification labels
+        :param filename: Path of labels file
+        :return: Classification labels
+        """
+        return self.get(filename, ClassificationLabels.load)
+
+    def get_pickle(self, filename):
+        """
+        Retrieve a pickled object
+        :param filename: Path of pickled file
+        :return: Unpickled object
+        """
+        return self.get(filename, load_pickle)
+
+    def clear(self):
+        """
+        Drop all loaded resources
+        :return: None
+        """
+        with self.lock:
+            self.resources.clear()
+
+
+resources = ResourceRegistry()
+
+
+def preload_resources():
+    """
+    Load search engines, classification label maps and cached stems used by
+    run() ahead of the first query.
+    :return: None
+    """
+    resources.get_engine(BOOLEAN_ENGINE_FILE)
+    resources.get_engine(VSM_ENGINE_FILE)
+    resources.get_labels(CLASSIFICATIONS_FILE)
+    if os.path.exists(STEM_CACHE_FILE):
+        preprocessing_pipeline.load_stem_cache(STEM_CACHE_FILE)
+
+
+def convert_classification_pickles():
+    """
+    Convert label maps keyed on document text, pickled before labels were
+    stored by document id, into the labels file used by run().
+    :return: None
+    """
+    search_engine = SearchEngine.load_engine(VSM_ENGINE_FILE)
+    labels = ClassificationLabels.from_text_keyed(
+        search_engine.documents, load_pickle(NB_CLASSIFICATIONS_FILE),
+        load_pickle(KNN_CLASSIFICATIONS_FILE))
+    labels.save(CLASSIFICATIONS_FILE)
+
+
+def classify_added_documents():
+    """
+    Classify the documents added to the saved search engines since the
+    labels file was written, and save the labels of all documents.
+    :return: None
+    """
+    search_engine = SearchEngine.load_engine(VSM_ENGINE_FILE)
+    labels = ClassificationLabels.load(CLASSIFICATIONS_FILE)
+    if len(labels) < len(search_engine.documents):
+        labels = labels.extend_from_classifiers(
+            search_engine, NaiveBayesClassifier.load_model(NAIVE_BAYES_FILE),
+            KNN.load_model(KNN_FILE))
+        labels.save(CLASSIFICATIONS_FILE)
+
+
+def classify_results(classifications, doc_ids, labels):
+    """
+    Add retrieved documents to the classes predicted for them by the Naive
+    Bayes and KNN classifiers.
+    :param classifications: Dictionary of class value to set of document ids
+    :param doc_ids: Retrieved document ids
+    :param labels: Classification labels of the documents
+    :return: None
+    """
+    for doc_id in doc_ids:
+        classifications["all"].add(doc_id)
+        nb_class, knn_class = labels.get(doc_id)
+        for class_value in (nb_class, knn_class):
+            if class_value is not None:
+                classifications[class_value].add(doc_id)
+
+
 def run(mode, input):
     """
     Provide query or document to be searched or classified and retrieve
@@ -987,17 +5131,14 @@ def run(mode, input):
             "entertainment": set(),
             "tech": set()
         }
-        search_engine = SearchEngine.load_engine("pickled_objects/Boolean_Search_Engine.pickle")
+        search_engine = resources.get_engine(BOOLEAN_ENGINE_FILE)
         query = input
-        processed_query = search_engine.pre_process(query,
-                                                    remove_stopwords=True,
-                                                    stemming=True)
-        all_terms_exists = True
-        for q in processed_query:
-            if q not in search_engine.terms:
-                all_terms_exists = False
-                break
-        if len(processed_query) == 0 or all_terms_exists is False:
+        try:
+            results = search_engine.boolean_query(query)
+        except ValueError as error:
+            print(error)
+            results = []
+        if len(results) == 0:
             classifications["all"].add(0)
             classifications["politics"].add(0)
             classifications["business"].add(0)
@@ -1006,29 +5147,16 @@ def run(mode, input):
             classifications["tech"].add(0)
             temp_docs = ["No documents found"]
             return classifications, temp_docs
-        results = search_engine.boolean_and_query(query)
 
         with open("query_result.txt", "w+") as handle:
-            for result in results:
-                handle.write("Document Number: {}\n".format(result.id))
-                handle.write(search_engine.documents[result.id] + "\n\n")
-            handle.write("Documents IDs : \n {}".format([doc.id for doc in results]))
+            for doc_id in results:
+                handle.write("Document Number: {}\n".format(doc_id))
+                handle.write(search_engine.documents[doc_id] + "\n\n")
+            handle.write("Documents IDs : \n {}".format(results))
             handle.write("Total Number of Documents found: {}\n".format
                          (len(results)))
-        for result in results:
-            document_content = search_engine.documents[result.id]
-            classifications["all"].add(result.id)
-            nb_classifications = pickle.load(open(
-                "pickled_objects/nb_classifications.pickle", "rb"))
-            nb_class = nb_classifications[document_content]
-            knn_classifications = pickle.load(open(
-                "pickled_objects/knn_classifications.pickle", "rb"))
-            knn_class = knn_classifications[document_content]
-            if nb_class == knn_class:
-                classifications[nb_class].add(result.id)
-            else:
-                classifications[nb_class].add(result.id)
-                classifications[knn_class].add(result.id)
+        classify_results(classifications, results,
+                         resources.get_labels(CLASSIFICATIONS_FILE))
         return classifications, search_engine.documents
     elif mode == "--ps":
         classifications = {
@@ -1039,7 +5167,7 @@ def run(mode, input):
             "entertainment": set(),
             "tech": set()
         }
-        search_engine = SearchEngine.load_engine("pickled_objects/Boolean_Search_Engine.pickle")
+        search_engine = resources.get_engine(BOOLEAN_ENGINE_FILE)
         query = input
         results = search_engine.positional_search(query)
         with open("query_result.txt", "w+") as handle:
@@ -1049,20 +5177,8 @@ def run(mode, input):
             handle.write("Documents IDs : \n {}".format([doc.id for doc in results]))
             handle.write("Total Number of Documents found: {}\n".format
                          (len(results)))
-        for result in results:
-            document_content = search_engine.documents[result.id]
-            classifications["all"].add(result.id)
-            nb_classifications = pickle.load(open(
-                "pickled_objects/nb_classifications.pickle", "rb"))
-            nb_class = nb_classifications[document_content]
-            knn_classifications = pickle.load(open(
-                "pickled_objects/knn_classifications.pickle", "rb"))
-            knn_class = knn_classifications[document_content]
-            if nb_class == knn_class:
-                classifications[nb_class].add(result.id)
-            else:
-                classifications[nb_class].add(result.id)
-                classifications[knn_class].add(result.id)
+        classify_results(classifications, results.doc_ids,
+                         resources.get_labels(CLASSIFICATIONS_FILE))
         return classifications, search_engine.documents
     elif mode == "--vsm":
         classifications = {
@@ -1075,15 +5191,14 @@ def run(mode, input):
         }
         # nb = NaiveBayesClassifier.load_model("pickled_objects/Naive_Bayes.pickle")
         # knn_model = KNN.load_model("pickled_objects/KNN.pickle")
-        search_engine = SearchEngine.load_engine(
-            "pickled_objects/VSM_Search_Engine.pickle")
+        search_engine = resources.get_engine(VSM_ENGINE_FILE)
         query = input
         existing_term = False
         processed_query = search_engine.pre_process(query,
                                                     remove_stopwords=False,
                                                     stemming=True)
         for q in processed_query:
-            if q in search_engine.terms:
+            if search_engine.check_existence(q):
                 existing_term = True
                 break
         if (len(processed_query) == 0 or existing_term is False):
@@ -1101,20 +5216,8 @@ def run(mode, input):
                 handle.write("Document Number: {}\n".format(result))
                 handle.write(search_engine.documents[result] + "\n\n")
             handle.write("Documents IDs : \n {}".format(results))
-        for result in results:
-            document_content = search_engine.documents[result]
-            classifications["all"].add(result)
-            nb_classifications = pickle.load(open(
-                "pickled_objects/nb_classifications.pickle", "rb"))
-            nb_class = nb_classifications[document_content]
-            knn_classifications = pickle.load(open(
-                "pickled_objects/knn_classifications.pickle", "rb"))
-            knn_class = knn_classifications[document_content]
-            if nb_class == knn_class:
-                classifications[nb_class].add(result)
-            else:
-                classifications[nb_class].add(result)
-                classifications[knn_class].add(result)
+        classify_results(classifications, results,
+                         resources.get_labels(CLASSIFICATIONS_FILE))
         return classifications, search_engine.documents
 
 
@@ -1152,35 +5255,58 @@ def split_write_docs(df, set_="train"):
             print("Completed {} out of {} documents".format(cur_doc_no, total_docs))
 
 
-def train_all_models():
+def train_all_models(workers=None):
     """
     Index inverted indexes using documents.
     Load Search Engines.
     Train classifiers.
     Save all indexes, search engines and models as pickled files
+    :param workers: Number of processes used to tokenize documents, they
+    are tokenized in this process if it is None
     :return:
     """
-    boolean_inv_index = InvertedIndex("documents", purpose="bs")
-    vsm_inv_index = InvertedIndex("documents", purpose="vsm")
+    detector = DuplicateDetector()
+    corpus = TokenizedCorpus.from_directory("documents", workers=workers,
+                                            detector=detector)
+    print(detector.summary())
+    detector.write_report(DUPLICATES_REPORT_FILE)
+    boolean_inv_index = InvertedIndex(purpose="bs", corpus=corpus,
+                                      biword_threshold=BIWORD_MIN_FREQUENCY)
+    vsm_inv_index = InvertedIndex(purpose="vsm", corpus=corpus)
     boolean_search_engine = SearchEngine(boolean_inv_index)
     VSM_search_engine = SearchEngine(vsm_inv_index)
-    knn_inv_index = InvertedIndex("training_set", purpose="vsm")
+    knn_detector = DuplicateDetector()
+    knn_corpus = TokenizedCorpus.from_directory("training_set",
+                                                workers=workers,
+                                                detector=knn_detector)
+    print(knn_detector.summary())
+    knn_detector.write_report(KNN_DUPLICATES_REPORT_FILE)
+    knn_inv_index = InvertedIndex(purpose="vsm", corpus=knn_corpus)
     knn_engine = SearchEngine(knn_inv_index)
     cl_df = vsm_inv_index.classifier_df
-    nb = NaiveBayesClassifier(cl_df)
+    nb = NaiveBayesClassifier(cl_df, corpus.subset(cl_df.train_index))
     nb.fit()
     knn = KNN(knn_engine, cl_df)
-    knn.fit()
+    knn.fit(knn_corpus)
+
+    DocumentStore.write(DOCUMENT_STORE_FILE, corpus.documents)
+    DocumentStore.write(KNN_DOCUMENT_STORE_FILE, knn_corpus.documents)
+    knn_engine.documents = DocumentStore(KNN_DOCUMENT_STORE_FILE)
 
     cl_df.save_dataframe("pickled_objects/Classifier_DF.pickle")
     boolean_inv_index.save_index(
-        "pickled_objects/Boolean_Inverted_Index.pickle")
+        "pickled_objects/Boolean_Inverted_Index.index", DOCUMENT_STORE_FILE)
     boolean_search_engine.save_engine(
-        "pickled_objects/Boolean_Search_Engine.pickle")
-    vsm_inv_index.save_index("pickled_objects/VSM_Inverted_Index.pickle")
-    VSM_search_engine.save_engine("pickled_objects/VSM_Search_Engine.pickle")
-    nb.save_model("pickled_objects/Naive_Bayes.pickle")
-    knn.save_model("pickled_objects/KNN.pickle")
+        "pickled_objects/Boolean_Search_Engine.index", DOCUMENT_STORE_FILE)
+    vsm_inv_index.save_index("pickled_objects/VSM_Inverted_Index.index",
+                             DOCUMENT_STORE_FILE)
+    VSM_search_engine.save_engine("pickled_objects/VSM_Search_Engine.index",
+                                  DOCUMENT_STORE_FILE)
+    nb.save_model(NAIVE_BAYES_FILE)
+    knn.save_model(KNN_FILE)
+    labels = ClassificationLabels.from_classifiers(VSM_search_engine, nb, knn)
+    labels.save(CLASSIFICATIONS_FILE)
+    preprocessing_pipeline.save_stem_cache(STEM_CACHE_FILE)
 
 # train_all_models()
 # print(pd.__version__)
\ No newline at end of file
@@ -0,0 +1,154 @@
+import os
+import pickle
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+from sklearn.model_selection import StratifiedShuffleSplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+from search_engine import ClassifierDataFrame, NaiveBayesClassifier, \
+    InvertedIndex, SearchEngine, KNN, directory_records
+
+TEST_DOCUMENTS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "test_documents")
+
+
+def read_test_documents():
+    """
+    Texts and class values of the test documents in a fixed order
+    :return: List of texts and list of class values
+    """
+    documents = []
+    class_values = []
+    for class_ in sorted(os.listdir(TEST_DOCUMENTS)):
+        class_directory = os.path.join(TEST_DOCUMENTS, class_)
+        for name in sorted(os.listdir(class_directory)):
+            with open(os.path.join(class_directory, name)) as document:
+                documents.append(document.read())
+            class_values.append(class_)
+    return documents, class_values
+
+
+def old_classifier_df_pickle(documents, class_values, t_size=0.2):
+    """
+    Pickle of a ClassifierDataFrame as written before the rows were kept in
+    lists: the data frames of the whole set and of the training and testing
+    sets, and no row numbers of the split.
+    :param documents: Document texts
+    :param class_values: Class value of each document
+    :param t_size: Size of testing set
+    :return: Pickled bytes
+    """
+    columns = ["document_contents", "class"]
+    df = pd.DataFrame(columns=columns)
+    for document, class_value in zip(documents, class_values):
+        df = pd.concat([df, pd.DataFrame([[document, class_value]],
+                                         columns=columns)]
+                       ).reset_index(drop=True)
+    features = df["document_contents"].copy()
+    target = df["class"].copy()
+    split = StratifiedShuffleSplit(n_splits=1, test_size=t_size,
+                                   random_state=7)
+    train_index, test_index = next(split.split(features, target))
+    state = {"columns": columns, "df": df, "features": features,
+             "target": target}
+    for name, frame, index in (("X_train", features, train_index),
+                               ("y_train", target, train_index),
+                               ("X_test", features, test_index),
+                               ("y_test", target, test_index)):
+        state[name] = pd.DataFrame(
+            np.reshape(frame.loc[index].values, (-1, 1)),
+            columns=[frame.name]).reset_index(drop=True)
+    obj = ClassifierDataFrame.__new__(ClassifierDataFrame)
+    obj.__dict__.update(state)
+    return pickle.dumps(obj), state
+
+
+class ClassifierDataFramePickleTest(unittest.TestCase):
+    def setUp(self):
+        self.documents, self.class_values = read_test_documents()
+        self.pickled, self.state = old_classifier_df_pickle(
+            self.documents, self.class_values)
+
+    def test_split_is_kept(self):
+        cdf = pickle.loads(self.pickled)
+        self.assertEqual(cdf.documents, self.documents)
+        self.assertEqual(cdf.train_set.documents,
+                         list(self.state["X_train"]["document_contents"]))
+        self.assertEqual(cdf.train_set.class_values,
+                         list(self.state["y_train"]["class"]))
+        self.assertEqual(cdf.test_set.documents,
+                         list(self.state["X_test"]["document_contents"]))
+        self.assertEqual(list(cdf.X_train["document_contents"]),
+                         list(self.state["X_train"]["document_contents"]))
+        self.assertEqual(sorted(list(cdf.train_index) +
+                                list(cdf.test_index)),
+                         list(range(len(self.documents))))
+
+    def test_naive_bayes_trains_on_converted_pickle(self):
+        cdf = pickle.loads(self.pickled)
+        nb = NaiveBayesClassifier(cdf)
+        nb.fit()
+        self.assertEqual(nb.N, len(self.state["X_train"]))
+
+
+class KNNPickleTest(unittest.TestCase):
+    def test_old_knn_pickle_predicts(self):
+        documents, class_values = read_test_documents()
+        pickled, _ = old_classifier_df_pickle(documents, class_values)
+        cdf = pickle.loads(pickled)
+        index = InvertedIndex(purpose="vsm", records=directory_records(
+            TEST_DOCUMENTS))
+        engine = SearchEngine(index)
+        id_matching = dict(enumerate(index.document_classes))
+        # KNN pickled before k, approximate search and document vectors
+        # were added only has these attributes
+        knn = KNN.__new__(KNN)
+        knn.__dict__.update({"search_engine": engine, "classifier_df": cdf,
+                             "id_matching": id_matching})
+        knn = pickle.loads(pickle.dumps(knn))
+        self.assertIn(knn.predict_single(documents[0]), class_values)
+        self.assertEqual(len(knn.nearest_documents([documents[0]])[0]), 5)
+
+
+class PickledTextsTest(unittest.TestCase):
+    def setUp(self):
+        self.documents, self.class_values = read_test_documents()
+        self.cdf = ClassifierDataFrame()
+        self.cdf.extend(self.documents, self.class_values)
+        self.cdf.split_training_testing_set(t_size=0.2)
+
+    def assert_no_texts(self, pickled):
+        for document in self.documents:
+            self.assertNotIn(document[:200].encode("utf-8"), pickled)
+
+    def test_naive_bayes_pickle_has_no_texts(self):
+        nb = NaiveBayesClassifier(self.cdf)
+        nb.fit()
+        pickled = pickle.dumps(nb)
+        self.assert_no_texts(pickled)
+        loaded = pickle.loads(pickled)
+        self.assertEqual(loaded.class_document_counts,
+                         nb.class_document_counts)
+        self.assertEqual(loaded.predict_single(self.documents[0], "m"),
+                         nb.predict_single(self.documents[0], "m"))
+
+    def test_knn_pickle_has_no_classifier_df(self):
+        index = InvertedIndex(purpose="vsm", records=directory_records(
+            TEST_DOCUMENTS))
+        knn = KNN(SearchEngine(index), self.cdf)
+        knn.id_matching = dict(enumerate(index.document_classes))
+        knn.build_document_vectors()
+        loaded = pickle.loads(pickle.dumps(knn))
+        self.assertIsNone(loaded.classifier_df)
+        self.assertEqual(loaded.predict_single(self.documents[0]),
+                         knn.predict_single(self.documents[0]))
+        self.assertRaises(ValueError, loaded.measure_agreement)
+        self.assertRaises(ValueError, loaded.fit)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -123,4 +123,5 @@ def technologyResults():
     return render_template('technologyResults.html', result=list_values)
 
 if __name__ == '__main__':
+    search_engine.preload_resources()
     app.run(debug=True)